@@ -4,6 +4,17 @@ import os
 import sys
 import logging
 import argparse
+
+# The REST API is served by gevent. Patch the blocking standard library calls before any thread, lock or
+# subprocess is created, so requests waiting on I/O or subprocesses such as PLANTS yield to other requests.
+# CPU bound Python and pandas work is not interrupted and blocks all requests while it runs.
+if __name__ == '__main__':
+    api_mode_parser = argparse.ArgumentParser(add_help=False)
+    api_mode_parser.add_argument('-a', '--api_mode', default='wamp')
+    if api_mode_parser.parse_known_args()[0].api_mode == 'rest':
+        from gevent import monkey
+        monkey.patch_all()
+
 import connexion
 
 from flask_cors import CORS
@@ -25,6 +36,10 @@ except ImportError:
 
 from mdstudio_smartcyp import __module__, __package_path__, __author__, __date__, __copyright__
 from mdstudio_smartcyp.utils import PeriodicCleanup
+from mdstudio_smartcyp.storage import run_packer
+from mdstudio_smartcyp.scheduling import admission_controller
+from mdstudio_smartcyp.combined_prediction import som_result_cache, artifact_writer
+from mdstudio_smartcyp.jobs import job_manager
 
 # Init basic logging
 logging.basicConfig(level=logging.INFO)
@@ -61,6 +76,21 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--result_storage_time',
                         help='Maximum time (hours) results are saved before cleanup. 0 will not clean',
                         type=int, default=0)
+    parser.add_argument('-c', '--cache_size',
+                        help='Maximum number of SOM predictions kept in memory for repeated requests. 0 will not cache',
+                        type=int, default=256)
+    parser.add_argument('-s', '--store_artifacts',
+                        help='Store intermediate SOM prediction results for reanalysis: not (off), directly (sync) '
+                             'or write-behind after returning the prediction (async)',
+                        choices=['off', 'sync', 'async'], default='sync')
+    parser.add_argument('-z', '--pack_results',
+                        help='Compress completed docking runs at rest: not (off), before returning the results (sync) '
+                             'or by a background thread after returning the results (async)',
+                        choices=['off', 'sync', 'async'], default='async')
+    parser.add_argument('-q', '--max_queued_work',
+                        help='Maximum work (dockings) accepted per endpoint before rejecting requests as overloaded. '
+                             'Four times the available CPUs by default, 0 will not limit',
+                        type=int, default=None)
     parser.add_argument('-p', '--http_port',
                         help='HTTP network port the service connects to',
                         type=int, default=8081)
@@ -76,6 +106,16 @@ if __name__ == '__main__':
             p = PeriodicCleanup(args.base_work_dir, args.result_storage_time)
             p.start()
 
+    # Stored SOM predictions expire together with their docking results
+    som_result_cache.configure(max_size=args.cache_size, ttl=args.result_storage_time * 3600)
+    artifact_writer.configure(args.store_artifacts)
+    run_packer.configure(args.pack_results)
+    if args.max_queued_work is not None:
+        admission_controller.configure(max_work=args.max_queued_work)
+
+    # Restart asynchronous jobs interrupted by a previous shutdown
+    job_manager.recover()
+
     # Start service REST or WAMP API
     if args.api_mode == 'wamp':
         logging.debug('Start {0} WAMP interface at {1}'.format(__module__, __package_path__))
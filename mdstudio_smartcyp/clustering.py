@@ -15,10 +15,12 @@ style.use('ggplot')  # Because of AttributeError: Unknown property color_cycle b
 
 import matplotlib.pyplot as plt
 
+from mdstudio_smartcyp.storage import structure_coordinates
+
 
 def coords_from_mol2(mol2_files):
     """
-    Extract XYZ coordinates from a mol2 file
+    Extract XYZ coordinates from a mol2 file or packed docking pose
 
     :param mol2_files: mol2 file paths to import
     :type mol2_files:  list
@@ -28,20 +30,9 @@ def coords_from_mol2(mol2_files):
     sets = []
     for mol2 in mol2_files:
 
-        with open(mol2, 'r') as structure_file:
-            read = False
-            coords = []
-            for line in structure_file.readlines():
-                line = line.strip()
-                if line.endswith('ATOM'):
-                    read = True
-                elif line.endswith('BOND'):
-                    break
-                elif read:
-                    line = line.split()
-                    coords.append(list(map(float, line[2:5])))
-            if coords:
-                sets.append(coords)
+        coords = structure_coordinates(mol2)
+        if len(coords):
+            sets.append(coords)
 
     return numpy.array(sets)
 
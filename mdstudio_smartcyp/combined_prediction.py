@@ -5,19 +5,31 @@ Combining SMARTCyp SOM prediction with PLANTS docking based SOM predictions
 """
 
 import os
+import json
+import atexit
+import shutil
+import hashlib
 import logging
 import pandas
 import numpy
 
+from collections import OrderedDict
 from fnmatch import fnmatch
-from interact import System
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+from interact import System, __version__ as __interact_version__
+from interact.core.topology_dataframe import TopologyDataFrame
 from interact.interactions.charged import eval_heme_coordination
 
-from mdstudio_smartcyp import __module__, __package_path__
+from mdstudio_smartcyp import (__module__, __package_path__, __version__, __smartcyp_version__,
+                               __plants_version__)
 from mdstudio_smartcyp.smartcyp_run import SmartCypRunner
-from mdstudio_smartcyp.plants_run import PlantsDocking
-from mdstudio_smartcyp.utils import (parse_tripos_atom, merge_protein_ligand_mol2,
-                                     hydrophobic_atom_count, molecular_weight)
+from mdstudio_smartcyp.plants_run import PlantsDocking, settings as plants_settings
+from mdstudio_smartcyp.utils import (parse_tripos, tripos_atom_array, mol2_to_pdb_string, mol2_hash, prepare_work_dir,
+                                     hydrophobic_atom_count, molecular_weight, Queue, StringIO, MDStudioException)
+from mdstudio_smartcyp.storage import (read_structure, read_run_file, run_file_exists, pack_results, run_packer,
+                                       ResultCache, ArtifactWriter)
+from mdstudio_smartcyp.scheduling import propagate_context, JobControl
 
 logger = logging.getLogger(__module__)
 
@@ -34,6 +46,24 @@ cyp_conf = {
 
 smartcyp_isform_scores = {'3A4': 'Energy', '2C9': '2Cscore', '2D6': '2D6score'}
 
+# Tool versions a SOM prediction depends on
+tool_versions = {'mdstudio_smartcyp': __version__, 'smartcyp': __smartcyp_version__, 'plants': __plants_version__,
+                 'mdinteract': __interact_version__}
+
+# Completed SOM predictions, configured from the command line by __main__
+som_result_cache = ResultCache(max_size=256)
+
+# Persistence of intermediate SOM prediction results, configured from the command line by __main__
+artifact_writer = ArtifactWriter(mode='sync')
+atexit.register(run_packer.flush)
+atexit.register(artifact_writer.flush)
+
+# MDInteract protein topologies of recently used CYP conformations, shared
+# read-only. Topologies are build under a lock per conformation.
+protein_topologies = ResultCache(max_size=16, copy_values=False)
+_topology_locks = {}
+_topology_lock = Lock()
+
 
 class CombinedPrediction(object):
     """
@@ -56,17 +86,22 @@ class CombinedPrediction(object):
     :param smartcyp_score_label: SMARTCyp output 'score' values to use for
                                  prediction
     :type smartcyp_score_label:  :py:str
+    :param ensemble_docking:     dock against all conformations of the CYP
+                                 isoform concurrently and pool the SOM
+                                 evidence instead of using the decision tree
+    :type ensemble_docking:      :py:bool
     :param kwargs:               additional docking configuration parameters
     :type kwargs:                :py:dict
     """
 
     def __init__(self, log=logger, base_work_dir=None, cyp='3A4', smartcyp_score_label=None, explicit_oxygen=False,
-                 **kwargs):
+                 ensemble_docking=False, **kwargs):
 
         self.log = log
         self.base_work_dir = base_work_dir
         self.docking_config = kwargs
         self.explicit_oxygen = explicit_oxygen
+        self.ensemble_docking = ensemble_docking
         self._workdir = None
 
         self.cyp = self.format_isoform(cyp)
@@ -96,7 +131,7 @@ class CombinedPrediction(object):
 
         return isoforms[0]
 
-    def cyp_decision_tree(self, lig_mol2_atoms):
+    def cyp_decision_tree(self, lig_mol2_atoms, as_file=False):
         """
         Determine best CYP isoform structure conformation to use based on the
         decision trees from previous research that use ligand molecular weight
@@ -116,10 +151,13 @@ class CombinedPrediction(object):
         variant including an explicit oxygen covalently bonded to the Heme FE is
         returned.
 
-        :param lig_mol2_atoms:  Tripos MOL2 atom records as returned by `parse_tripos_atom`
-        :type lig_mol2_atoms:   :py:dict
+        :param lig_mol2_atoms:  parsed Tripos MOL2 of the ligand as returned by `parse_tripos`
+        :type lig_mol2_atoms:   :mdstudio_smartcyp:utils:TriposMol2
+        :param as_file:         return conformation file name instead of the
+                                protein structure
+        :type as_file:          :py:bool
 
-        :return:                Path to protein structure
+        :return:                Protein structure or conformation file name
         :rtype:                 :py:str
         """
 
@@ -140,10 +178,83 @@ class CombinedPrediction(object):
         self.log.info('Use {0} conformation {1}, MW: {2:.3f} and hydrophobic atom count: {3}, explicit O: {4}'.format(
             self.cyp, choice, molw, n_hydrophob, self.explicit_oxygen))
 
+        if as_file:
+            return choice
+
         protein = open(os.path.join(__package_path__, 'data/{0}'.format(choice)), 'r').read()
         return protein
 
-    def combine_docking_smartcyp(self, hemecoor, pose_count):
+    def cyp_conformations(self, as_file=False):
+        """
+        Return all protein structure conformations for the CYP isoform as
+        used for ensemble docking.
+
+        If the class 'explicit_oxygen' argument is enabled then the CYP isoform
+        variants including an explicit oxygen covalently bonded to the Heme FE
+        are returned.
+
+        :param as_file:         return conformation file names instead of
+                                the protein structures
+        :type as_file:          :py:bool
+
+        :return:                Protein structures or conformation file names
+        :rtype:                 :py:list
+        """
+
+        conf_selector = 'conf_ox' if self.explicit_oxygen else 'conf'
+        choices = []
+        for conf in cyp_conf[self.cyp]:
+            if conf[conf_selector] not in choices:
+                choices.append(conf[conf_selector])
+
+        self.log.info('Use {0} conformation ensemble {1}, explicit O: {2}'.format(self.cyp, ', '.join(choices),
+                                                                                  self.explicit_oxygen))
+
+        if as_file:
+            return choices
+
+        return [open(os.path.join(__package_path__, 'data/{0}'.format(choice)), 'r').read() for choice in choices]
+
+    def prediction_key(self, ligand, lig_mol2_atoms, filter_clusters=True, pose_hits=False):
+        """
+        Canonical key identifying the result of a `run` in the
+        `som_result_cache`.
+
+        The key is a hash over the ligand structure (`mol2_hash`), the CYP
+        conformation(s) docked against, all PLANTS settings including
+        defaults, the prediction options and the SMARTCyp, PLANTS,
+        MDInteract and package versions.
+
+        :param ligand:           ligand in Tripos MOL2 format
+        :type ligand:            :py:str
+        :param lig_mol2_atoms:   parsed Tripos MOL2 of the ligand as
+                                 returned by `parse_tripos`
+        :type lig_mol2_atoms:    :mdstudio_smartcyp:utils:TriposMol2
+        :param filter_clusters:  filter docking poses on clusters
+        :type filter_clusters:   :py:bool
+        :param pose_hits:        include sparse per-pose SOM hits in results
+        :type pose_hits:         :py:bool
+
+        :return:                 SHA1 hex digest
+        :rtype:                  :py:str
+        """
+
+        if self.ensemble_docking:
+            conformations = self.cyp_conformations(as_file=True)
+        else:
+            conformations = [self.cyp_decision_tree(lig_mol2_atoms, as_file=True)]
+
+        docking_config = dict([(key, value) for key, value in plants_settings.items() if key not in
+                               ('base_work_dir', 'workdir', 'exec_path', 'protein_file', 'ligand_file')])
+        docking_config.update(self.docking_config)
+
+        identity = {'ligand': mol2_hash(ligand), 'cyp': self.cyp, 'conformations': conformations,
+                    'docking': docking_config, 'smartcyp_score_label': self.smartcyp_score_label,
+                    'filter_clusters': filter_clusters, 'pose_hits': pose_hits, 'versions': tool_versions}
+
+        return hashlib.sha1(json.dumps(identity, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def combine_docking_smartcyp(self, hemecoor, pose_count, pose_hits=False):
         """
         Combine SMARTCyp reactivity based SOM prediction with docking based
         prediction.
@@ -162,141 +273,819 @@ class CombinedPrediction(object):
           higher by NaN. Normalize the resulting values by dividing the
           minimum value by all values.
 
+        SOM counts are aggregated over unique (atom serial, pose) pairs.
+        If `pose_hits` the per-pose hits are added in sparse form as a
+        'Poses' column listing the PATH of every pose in which the atom was
+        identified as SOM.
+
         :param hemecoor:    MDInteract heme coordination evaluation for docking
                             poses
         :type hemecoor:     :pandas:DataFrame
         :param pose_count:  number of evaluated docking poses (population)
         :type pose_count:   :py:int
+        :param pose_hits:   include sparse per-pose SOM hits
+        :type pose_hits:    :py:bool
 
         :return:            accumulated SOM prediction
         :rtype:             :pandas:DataFrame
         """
 
-        ec = ['Docking', 'SMARTCyp']
-        poses = list(hemecoor['pose'].unique())
-        docmat = pandas.DataFrame(0, index=self.smartcyp_results['Atom_id'], columns=poses + ec)
-
-        # Add MDInteract predicted SOMS for each docking pose to docmat
-        for pose in poses:
-            pred = hemecoor[hemecoor['pose'] == pose]['source', 'serial']
-            if not pred.empty:
-                docmat.loc[pred, pose] = 1
+        atom_ids = self.smartcyp_results['Atom_id']
+        hits = pandas.DataFrame({'serial': hemecoor['source', 'serial'].values,
+                                 'pose': hemecoor['pose'].values}).drop_duplicates()
 
         # Normalize som counts
-        norm = docmat[poses].sum(axis=1) / pose_count
-        docmat['Docking'] = norm / max(norm)
+        counts = hits.groupby('serial').size().reindex(atom_ids, fill_value=0)
+        norm = counts.values / float(pose_count)
+        if norm.max() > 0:
+            norm = norm / norm.max()
+        docmat = pandas.DataFrame({'Docking': norm}, index=atom_ids)
+
+        # Sparse per-pose SOM hits as list of pose paths per atom
+        if pose_hits:
+            pose_paths = dict(zip(self.docking_results['POSE'], self.docking_results['PATH']))
+            hits['path'] = hits['pose'].map(pose_paths)
+            sparse = hits.sort_values('pose').groupby('serial')['path'].apply(list)
+            docmat['Poses'] = [sparse.get(atom, []) for atom in atom_ids]
 
         # Replace SMARTCyp score values equal to or above 999 with NaN
-        self.smartcyp_results.loc[self.smartcyp_results[self.smartcyp_score_label] >= 999,
-                                  self.smartcyp_score_label] = numpy.nan
+        scores = self.smartcyp_results[self.smartcyp_score_label]
+        scores = scores.where(scores < 999, numpy.nan)
 
         # Add SMARTCyp prediction. Normalize defined score column
-        norm_smartcyp_score = (self.smartcyp_results[self.smartcyp_score_label].min() /
-                               self.smartcyp_results[self.smartcyp_score_label])
+        norm_smartcyp_score = scores.min() / scores
         docmat['SMARTCyp'] = norm_smartcyp_score.values
 
-        # Change index and columns
-        docmat.columns = list(self.docking_results[self.docking_results['POSE'].isin(poses)]['PATH']) + ec
+        # Change index
         docmat.index = self.smartcyp_results.index
 
         return docmat
 
-    def run(self, ligand, filter_clusters=True):
+    def select_poses(self, docking_results, filter_clusters=True):
         """
-        Run combined SOM prediction
+        Select the docking poses to evaluate for heme coordination.
 
-        * Determine Cyp isoform using decision tree
-        * Run SMARTCyp
-        * Run PLANTS docking
-        * Run MDInteract heme coordination on docking poses
-        * Combine and return prediction results
+        If `filter_clusters` only poses assigned to a cluster (CLUSTER != 0)
+        are selected. Poses that are discarded here are never converted to
+        the PDB ensemble nor evaluated.
 
+        :param docking_results:  docking results to select poses from
+        :type docking_results:   :pandas:DataFrame
+        :param filter_clusters:  filter docking poses on clusters
+        :type filter_clusters:   :py:bool
+
+        :return:                 selected docking results
+        :rtype:                  :pandas:DataFrame
+        """
+
+        selection = docking_results
+        if filter_clusters:
+            selection = selection[selection['CLUSTER'] != 0]
+
+        self.log.info('Selected {0} out of {1} docking poses for heme-coordination evaluation'.format(
+            len(selection), len(docking_results)))
+
+        return selection
+
+    def run_docking(self, protein, ligand):
+        """
+        Run a PLANTS docking of the ligand in the CYP binding site
+
+        :param protein:          protein in Tripos MOL2 format
+        :type protein:           :py:str
         :param ligand:           ligand in Tripos MOL2 format
         :type ligand:            :py:str
-        :param filter_clusters:  filter docking psoes on clusters
+
+        :return:                 PlantsDocking instance and docking results
+        :rtype:                  :py:tuple
+        """
+
+        docking = PlantsDocking(log=self.log, base_work_dir=self.base_work_dir,
+                                bindingsite_center=[-0.989, 3.261, 0.826], **self.docking_config)
+        # Packed once the SOM prediction artifacts are stored
+        if not docking.run(protein, ligand, pack=False):
+            return
+
+        docking_results = pandas.DataFrame.from_dict(docking.get_results(), orient='index')
+        docking_results['POSE'] = [int(f.split('_')[-1]) for f in docking_results.index]
+
+        return docking, docking_results
+
+    def eval_heme_coordination(self, docking, protein, selection, lig_mol2_atoms):
+        """
+        Run MDInteract heme coordination detection on selected docking poses
+
+        Docking poses are evaluated one at a time against the cached protein
+        topology, only the coordinates of the current pose are loaded. The
+        contacts of every pose are reduced to the ligand atoms coordinating
+        the heme directly.
+
+        :param docking:          PlantsDocking instance
+        :type docking:           :mdstudio_smartcyp:plants_run:PlantsDocking
+        :param protein:          docking protein in Tripos MOL2 format
+        :type protein:           :py:str
+        :param selection:        docking results for poses to evaluate
+        :type selection:         :pandas:DataFrame
+        :param lig_mol2_atoms:   parsed Tripos MOL2 of the ligand
+        :type lig_mol2_atoms:    :mdstudio_smartcyp:utils:TriposMol2
+
+        :return:                 heme coordinating ligand atoms for all poses
+        :rtype:                  :pandas:DataFrame
+        """
+
+        # Protein topology of the conformation is cached, only the ligand is attached
+        poses = list(selection['PATH'])
+        pose_ids = list(selection['POSE'])
+        topology, lig_xyz = build_topology(read_structure(os.path.join(docking.base_work_dir, poses[0])),
+                                           record='HETATM', chain='B')
+
+        prot_topology, prot_xyz = protein_topology(protein)
+        topology['chainID'] += prot_topology['chainID'].max() + 1
+        topology = TopologyDataFrame(pandas.concat([prot_topology, topology], ignore_index=True))
+
+        # Run heme-coordination detection
+        lig_resname = set([name[0:3] for name in tripos_atom_array(lig_mol2_atoms)['subst_name'].tolist()])
+        rings = None
+        serials = []
+        hit_poses = []
+        for pose_id, pose in zip(pose_ids, poses):
+
+            logging.info('Evaluate heme-coordination on docking pose: {0}'.format(pose_id))
+
+            lig_xyz = pdb_coordinates(read_structure(os.path.join(docking.base_work_dir, pose)))
+            topology.set_coord(numpy.vstack([prot_xyz, lig_xyz]))
+            topology.distances()
+            ls = topology[topology['resName'].isin(lig_resname)]
+
+            if rings is None:
+                rings = ls.find_rings()
+
+            cf = ls.contacts(ls.neighbours())
+            cf = eval_heme_coordination(cf, topology, rings=rings)
+
+            hits = numpy.unique(cf.loc[cf['contact'] != 'nd', ('source', 'serial')].values)
+            serials.extend(hits)
+            hit_poses.extend([pose_id] * len(hits))
+
+        return _hemecoor(serials, hit_poses)
+
+    def store_artifacts(self, docking, docking_results, hemecoor, filter_clusters=True):
+        """
+        Store the intermediate results of a SOM prediction in the docking
+        results directory allowing a later `reanalyse`.
+
+        Results are persisted by the `artifact_writer` according to its
+        mode: not at all, directly or write-behind by a background thread.
+        The results are not modified after they are stored. The docking run
+        is packed by the `run_packer` after the artifacts are written.
+
+        :param docking:          PlantsDocking instance
+        :type docking:           :mdstudio_smartcyp:plants_run:PlantsDocking
+        :param docking_results:  docking results including pose 'EVALUATED'
+                                 state
+        :type docking_results:   :pandas:DataFrame
+        :param hemecoor:         heme coordination of all evaluated poses
+        :type hemecoor:          :pandas:DataFrame
+        :param filter_clusters:  filter docking poses on clusters
         :type filter_clusters:   :py:bool
+        """
 
-        :return:                 combined prediction results
-        :rtype:                  :py:dict
+        som_config = {'cyp': self.cyp, 'smartcyp_score_label': self.smartcyp_score_label,
+                      'filter_clusters': filter_clusters}
+        for key in ('threshold', 'criterion', 'min_cluster_size'):
+            som_config[key] = docking.config.get(key)
+
+        if artifact_writer.mode == 'off':
+            run_packer.write(pack_results, docking.workdir)
+            return
+
+        artifact_writer.write(write_artifacts, docking.workdir, som_config, self.smartcyp_results, docking_results,
+                              hemecoor, self.combined)
+
+    def run_smartcyp(self, ligand):
+        """
+        Run SMARTCyp reactivity based SOM prediction for the ligand
+
+        :param ligand:           ligand in Tripos MOL2 format
+        :type ligand:            :py:str
+
+        :return:                 SMARTCyp results
+        :rtype:                  :pandas:DataFrame
         """
 
-        # Run SMARTCyp
         self.log.info('Run SMARTCyp for CYP: {0} using score data: {1}'.format(self.cyp, self.smartcyp_score_label))
 
         smartcyp = SmartCypRunner()
         smartcyp_results = smartcyp.run(ligand, is_smiles=False)
+        smartcyp.delete()
+
         if smartcyp_results['result'] is None:
             self.log.error('Error running SMARTCyp')
             return
 
         # Import SMARTCyp results as Pandas DataFrame
-        self.smartcyp_results = pandas.DataFrame.from_dict(smartcyp_results['result'], orient='index')
+        return pandas.DataFrame.from_dict(smartcyp_results['result'], orient='index')
+
+    def run(self, ligand, filter_clusters=True, pose_hits=False, smartcyp_results=None, ligand_atoms=None,
+            use_cache=True):
+        """
+        Run combined SOM prediction
+
+        * Return a stored result from `som_result_cache` if available
+        * Determine Cyp isoform using decision tree or use all isoform
+          conformations for ensemble docking
+        * Run SMARTCyp
+        * Run PLANTS docking, concurrently for each ensemble conformation
+        * Run MDInteract heme coordination on docking poses
+        * Combine and return prediction results, SOM evidence of all
+          ensemble dockings is pooled
 
-        # Determine protein conformation to use
-        lig_mol2_atoms = parse_tripos_atom(ligand)
-        protein = self.cyp_decision_tree(lig_mol2_atoms)
+        SMARTCyp results and parsed ligand atoms may be shared between
+        predictions for different isoforms of the same ligand. SMARTCyp is
+        only run when `smartcyp_results` is not defined.
 
-        # Perform PLANTS docking
-        docking = PlantsDocking(base_work_dir=self.base_work_dir, bindingsite_center=[-0.989, 3.261, 0.826],
-                                **self.docking_config)
-        success = docking.run(protein, ligand)
+        :param ligand:           ligand in Tripos MOL2 format
+        :type ligand:            :py:str
+        :param filter_clusters:  filter docking psoes on clusters
+        :type filter_clusters:   :py:bool
+        :param pose_hits:        include sparse per-pose SOM hits in results
+        :type pose_hits:         :py:bool
+        :param smartcyp_results: precomputed SMARTCyp results
+        :type smartcyp_results:  :pandas:DataFrame
+        :param ligand_atoms:     parsed Tripos MOL2 of the ligand as
+                                 returned by `parse_tripos`
+        :type ligand_atoms:      :mdstudio_smartcyp:utils:TriposMol2
+        :param use_cache:        lookup and store the prediction in the
+                                 `som_result_cache`
+        :type use_cache:         :py:bool
 
-        if success:
-            self.docking_results = pandas.DataFrame.from_dict(docking.get_results(), orient='index')
-            self.docking_results['POSE'] = [int(f.split('_')[-1]) for f in self.docking_results.index]
+        :return:                 combined prediction results
+        :rtype:                  :py:dict
+        """
+
+        lig_mol2_atoms = parse_tripos(ligand) if ligand_atoms is None else ligand_atoms
+
+        # Return stored prediction
+        cache_key = None
+        if use_cache:
+            cache_key = self.prediction_key(ligand, lig_mol2_atoms, filter_clusters=filter_clusters,
+                                            pose_hits=pose_hits)
+            prediction = som_result_cache.get(cache_key)
+            if prediction is not None:
+                self.log.info('Return stored SOM prediction for CYP {0}'.format(self.cyp))
+                return prediction
+
+        # Run SMARTCyp
+        if smartcyp_results is None:
+            smartcyp_results = self.run_smartcyp(ligand)
+            if smartcyp_results is None:
+                return
+
+        self.smartcyp_results = smartcyp_results.copy()
+
+        # Determine protein conformation(s) to use
+        if self.ensemble_docking:
+            proteins = self.cyp_conformations()
         else:
+            proteins = [self.cyp_decision_tree(lig_mol2_atoms)]
+
+        # Perform PLANTS docking, concurrently for a conformation ensemble
+        pool = ThreadPool(processes=len(proteins))
+        jobs = [pool.apply_async(propagate_context(self.run_docking), (protein, ligand)) for protein in proteins]
+        pool.close()
+        pool.join()
+
+        # Remove the dockings of all conformations if any failed or raised
+        dockings = [job.get() if job.successful() else None for job in jobs]
+        if not all(dockings):
             self.log.error('Failed to run PLANTS docking')
-            docking.delete()
+            for docking in dockings:
+                if docking:
+                    docking[0].delete()
+            for job in jobs:
+                if not job.successful():
+                    job.get()
             return
 
+        # Make pose identifiers unique over all dockings
+        offset = 0
+        for docking, docking_results in dockings:
+            docking_results['POSE'] += offset
+            offset = docking_results['POSE'].max()
+        self.docking_results = pandas.concat([docking_results for docking, docking_results in dockings])
+
+        # Run heme-coordination detection on the selected poses of every docking
+        hemecoor = []
+        pose_count = 0
+        for protein, (docking, docking_results) in zip(proteins, dockings):
+
+            # Select poses to evaluate
+            selection = self.select_poses(docking_results, filter_clusters=filter_clusters)
+            docking_results['EVALUATED'] = docking_results['POSE'].isin(selection['POSE'])
+            if selection.empty:
+                hemecoor.append(_hemecoor())
+                continue
+
+            pose_count += len(selection)
+            hemecoor.append(self.eval_heme_coordination(docking, protein, selection, lig_mol2_atoms))
+
+        if not pose_count:
+            self.log.error('No docking poses selected for SOM prediction')
+            return
+
+        self.combined = self.combine_docking_smartcyp(pandas.concat(hemecoor), pose_count, pose_hits=pose_hits)
+
         # Store results data in docking results dir
-        self.smartcyp_results.to_csv(os.path.join(docking.workdir, 'smartcyp.csv'))
-        self.docking_results.to_csv(os.path.join(docking.workdir, 'docking.csv'))
+        for (docking, docking_results), docking_hemecoor in zip(dockings, hemecoor):
+            self.store_artifacts(docking, docking_results, docking_hemecoor, filter_clusters=filter_clusters)
 
-        # Prepare PDB ensemble and system MOL2
-        poses = list(self.docking_results['PATH'])
-        ensemble_pdb = os.path.join(docking.workdir, 'ensemble.pdb')
-        with open(ensemble_pdb, 'w') as epdb:
-            epdb.write(docking.get_structures(poses, output_format='pdb', include_protein=True))
+        prediction = self.combined.to_dict(orient='index')
+        if cache_key:
+            som_result_cache.set(cache_key, prediction)
 
-        system_mol2 = os.path.join(docking.workdir, 'system.mol2')
-        with open(system_mol2, 'w') as smol:
-            ligp = os.path.join(docking.base_work_dir, poses[0])
-            smol.write(merge_protein_ligand_mol2(protein, open(ligp).read()))
+        return prediction
 
-        # Run heme-coordination detection
-        molsys = System(ensemble_pdb, mol2file=system_mol2)
-        lig_resname = set([n['subst_name'][0:3] for n in lig_mol2_atoms.values()])
-        rings = None
-        combined = []
-        for frame, nr in molsys.iter_frames(auto_chunk=False):
+    def reanalyse(self, paths, filter_clusters=True, pose_hits=False, poses=None, smartcyp_score_label=None):
+        """
+        Recompute a combined SOM prediction from the artifacts stored in the
+        docking results directories by a previous `run`.
+
+        Only the stages downstream of a changed parameter are recomputed:
+
+        * SMARTCyp score label: combination only
+        * Clustering (threshold, criterion, min_cluster_size): poses are
+          reclustered from the stored docking poses
+        * Pose selection (filter_clusters, poses): heme coordination is only
+          evaluated for selected poses that were not evaluated before
+
+        :param paths:                docking results directories or pose
+                                     paths in them. Multiple directories for
+                                     an ensemble docking
+        :type paths:                 :py:str, :py:list
+        :param filter_clusters:      filter docking poses on clusters
+        :type filter_clusters:       :py:bool
+        :param pose_hits:            include sparse per-pose SOM hits in
+                                     results
+        :type pose_hits:             :py:bool
+        :param poses:                restrict prediction to these pose paths
+        :type poses:                 :py:list
+        :param smartcyp_score_label: SMARTCyp output 'score' values to use.
+                                     Label of the original prediction by
+                                     default
+        :type smartcyp_score_label:  :py:str
+
+        :return:                     combined prediction results
+        :rtype:                      :py:dict
+        :raises:                     MDStudioException, results (no longer)
+                                     available or not stored
+        """
 
-            logging.info('Evaluate heme-coordination on docking pose: {0}'.format(nr + 1))
+        if not isinstance(paths, (list, tuple)):
+            paths = [paths]
 
-            frame.distances()
-            ls = frame[frame['resName'].isin(lig_resname)]
+        # Artifacts of recent predictions may still be queued for writing
+        artifact_writer.flush()
 
-            if rings is None:
-                rings = ls.find_rings()
+        workdirs = []
+        for path in paths:
+            workdir = os.path.dirname(path) if path.endswith('.mol2') else path.rstrip('/')
+            if workdir not in workdirs:
+                workdirs.append(workdir)
 
-            cf = ls.contacts(ls.neighbours())
-            cf = eval_heme_coordination(cf, molsys.topology, rings=rings)
-            cf['pose'] = nr + 1
+        dockings = []
+        hemecoor = []
+        pose_count = 0
+        for workdir in workdirs:
 
-            f = cf[cf['contact'] != 'nd']
-            if not f.empty:
-                combined.append(f)
+            docking = PlantsDocking(log=self.log, base_work_dir=self.base_work_dir, **self.docking_config)
+            docking.workdir = workdir
 
-        hemecoor = pandas.concat(combined)
-        hemecoor.to_csv(os.path.join(docking.workdir, 'hemecoor.csv'))
+            som_config_file = os.path.join(docking.workdir, 'som_config.json')
+            if not run_file_exists(som_config_file):
+                raise MDStudioException('No SOM prediction results stored in: {0}'.format(workdir))
 
-        pose_count = len(self.docking_results)
-        if filter_clusters:
-            clustered_poses = list(self.docking_results[self.docking_results['CLUSTER'] != 0]['POSE'])
-            pose_count = len(clustered_poses)
-            hemecoor = hemecoor[hemecoor['pose'].isin(clustered_poses)]
+            som_config = json.loads(read_run_file(som_config_file))
+
+            self.cyp = som_config['cyp']
+            self.smartcyp_score_label = smartcyp_score_label or som_config['smartcyp_score_label']
+            if self.smartcyp_results is None:
+                self.smartcyp_results = pandas.read_csv(
+                    StringIO(read_run_file(os.path.join(docking.workdir, 'smartcyp.csv'))), index_col=0)
+
+            results = pandas.read_csv(StringIO(read_run_file(os.path.join(docking.workdir, 'docking.csv'))),
+                                      index_col=0)
+            evaluated = read_hemecoor(os.path.join(docking.workdir, 'hemecoor.csv'))
+
+            # Redo clustering if clustering parameters changed, stored parameters by default
+            for key in ('threshold', 'criterion', 'min_cluster_size'):
+                if key not in self.docking_config and som_config.get(key) is not None:
+                    docking.config[key] = som_config[key]
+
+            if any([som_config.get(key) != docking.config.get(key) for key in
+                    ('threshold', 'criterion', 'min_cluster_size')]):
 
-        self.combined = self.combine_docking_smartcyp(hemecoor, pose_count)
-        self.combined.to_csv(os.path.join(docking.workdir, 'prediction.csv'))
+                self.log.info('Clustering parameters changed, recluster docking poses in: {0}'.format(workdir))
+                clusters = docking.get_results(list(results['PATH']))
+                if not clusters:
+                    raise MDStudioException('Unable to recluster docking poses in: {0}'.format(workdir))
+
+                for key in ('CLUSTER', 'MEAN'):
+                    results[key] = [clusters[pose][key] for pose in results.index]
+
+            # Select poses and evaluate heme coordination for new poses only
+            selection = self.select_poses(results, filter_clusters=filter_clusters)
+            if poses is not None:
+                selection = selection[selection['PATH'].isin(poses)]
+
+            missing = selection[~selection['EVALUATED'].astype(bool)]
+            if not missing.empty:
+                self.log.info('Evaluate heme-coordination for {0} new docking poses'.format(len(missing)))
+
+                protein = read_structure(os.path.join(docking.workdir, 'protein.mol2'))
+                lig_mol2_atoms = parse_tripos(read_structure(os.path.join(docking.base_work_dir,
+                                                                          missing['PATH'].iloc[0])))
+
+                evaluated = pandas.concat([evaluated, self.eval_heme_coordination(docking, protein, missing,
+                                                                                  lig_mol2_atoms)])
+                results.loc[results['POSE'].isin(missing['POSE']), 'EVALUATED'] = True
+
+            pose_count += len(selection)
+            dockings.append((docking, results, evaluated))
+            hemecoor.append(evaluated[evaluated['pose'].isin(selection['POSE'])])
+
+        if not pose_count:
+            self.log.error('No docking poses selected for SOM prediction')
+            return
+
+        self.docking_results = pandas.concat([results for docking, results, evaluated in dockings])
+        self.combined = self.combine_docking_smartcyp(pandas.concat(hemecoor), pose_count, pose_hits=pose_hits)
+
+        # Update results data in docking results dir
+        for docking, results, evaluated in dockings:
+            self.store_artifacts(docking, results, evaluated, filter_clusters=filter_clusters)
 
         return self.combined.to_dict(orient='index')
+
+
+def write_artifacts(workdir, som_config, smartcyp_results, docking_results, hemecoor, combined=None):
+    """
+    Write intermediate SOM prediction results to the docking results
+    directory. The SOM prediction configuration is written last marking the
+    artifacts complete after which the docking run is packed by the
+    `run_packer`.
+
+    :param workdir:          docking results directory
+    :type workdir:           :py:str
+    :param som_config:       SOM prediction configuration
+    :type som_config:        :py:dict
+    :param smartcyp_results: SMARTCyp results
+    :type smartcyp_results:  :pandas:DataFrame
+    :param docking_results:  docking results
+    :type docking_results:   :pandas:DataFrame
+    :param hemecoor:         heme coordination of all evaluated poses
+    :type hemecoor:          :pandas:DataFrame
+    :param combined:         combined SOM prediction
+    :type combined:          :pandas:DataFrame
+    """
+
+    smartcyp_results.to_csv(os.path.join(workdir, 'smartcyp.csv'))
+    docking_results.to_csv(os.path.join(workdir, 'docking.csv'))
+    hemecoor.to_csv(os.path.join(workdir, 'hemecoor.csv'))
+    if combined is not None:
+        combined.to_csv(os.path.join(workdir, 'prediction.csv'))
+
+    with open(os.path.join(workdir, 'som_config.json'), 'w') as config_file:
+        json.dump(som_config, config_file)
+
+    run_packer.write(pack_results, workdir)
+
+
+def build_topology(mol2, record='ATOM', chain='A'):
+    """
+    Build a MDInteract topology for a structure in Tripos MOL2 format
+
+    The structure is converted to PDB and loaded together with the MOL2
+    SYBYL atom types in the same way as an ensemble PDB file is loaded by
+    `interact.System`.
+
+    :param mol2:    structure in Tripos MOL2 format
+    :type mol2:     :py:str
+    :param record:  PDB record type, ATOM or HETATM
+    :type record:   :py:str
+    :param chain:   PDB chain identifier
+    :type chain:    :py:str
+
+    :return:        topology and atom coordinates in nm
+    :rtype:         :pandas:DataFrame, :numpy:ndarray
+    """
+
+    workdir = prepare_work_dir(prefix='topology-')
+    try:
+        pdbfile = os.path.join(workdir, 'structure.pdb')
+        with open(pdbfile, 'w') as pdb:
+            pdb.write(mol2_to_pdb_string(parse_tripos(mol2), record=record, chain=chain))
+            pdb.write('END\n')
+
+        mol2file = os.path.join(workdir, 'structure.mol2')
+        with open(mol2file, 'w') as mol:
+            mol.write(mol2)
+
+        molsys = System(pdbfile, mol2file=mol2file)
+        return pandas.DataFrame(molsys.topology, copy=True), pdb_coordinates(mol2)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def protein_topology(protein):
+    """
+    MDInteract topology of a CYP protein conformation
+
+    Protein topology, SYBYL atom types and coordinates do not change between
+    dockings to the same conformation. They are build once per conformation
+    and cached in the `protein_topologies` LRU store. Cached topologies are
+    shared without copying and should not be modified, the coordinates are
+    returned as read-only array.
+
+    :param protein: protein in Tripos MOL2 format
+    :type protein:  :py:str
+
+    :return:        topology and atom coordinates in nm
+    :rtype:         :pandas:DataFrame, :numpy:ndarray
+    """
+
+    key = hashlib.sha1(protein.encode('utf-8')).hexdigest()
+    topology = protein_topologies.get(key)
+    if topology is not None:
+        return topology
+
+    # Only concurrent requests for the same conformation wait for the build
+    with _topology_lock:
+        lock = _topology_locks.setdefault(key, Lock())
+
+    with lock:
+        topology = protein_topologies.get(key)
+        if topology is None:
+            logger.info('Build protein topology for conformation: {0}'.format(key))
+            topology, xyz = build_topology(protein)
+            xyz.flags.writeable = False
+            topology = (topology, xyz)
+            protein_topologies.set(key, topology)
+
+    with _topology_lock:
+        _topology_locks.pop(key, None)
+
+    return topology
+
+
+def pdb_coordinates(mol2):
+    """
+    Atom coordinates of a structure at PDB precision, identical to the
+    coordinates loaded from the PDB file written by `mol2_to_pdb_string`
+
+    :param mol2:    structure in Tripos MOL2 format
+    :type mol2:     :py:str
+
+    :return:        atom coordinates in nm
+    :rtype:         :numpy:ndarray
+    """
+
+    xyz = parse_tripos(mol2).coordinates
+    xyz = numpy.array([float('{0:.3f}'.format(value)) for value in xyz.ravel().tolist()]).reshape(xyz.shape)
+
+    return (xyz / 10).astype(numpy.float32)
+
+
+def _hemecoor(serials=(), poses=()):
+    """
+    :param serials: serial of ligand atoms coordinating the heme
+    :type serials:  :py:list
+    :param poses:   docking pose of every coordinating atom
+    :type poses:    :py:list
+
+    :return:        heme coordinating atoms by docking pose
+    :rtype:         :pandas:DataFrame
+    """
+
+    return pandas.DataFrame({('source', 'serial'): numpy.asarray(serials, dtype=int),
+                             ('pose', ''): numpy.asarray(poses, dtype=int)},
+                            columns=pandas.MultiIndex.from_tuples([('source', 'serial'), ('pose', '')]))
+
+
+def read_hemecoor(csvfile):
+    """
+    Import heme coordination results stored by `CombinedPrediction`
+
+    :param csvfile: hemecoor.csv file path, may be packed by `pack_run`
+    :type csvfile:  :py:str
+
+    :return:        heme coordination contacts
+    :rtype:         :pandas:DataFrame
+    """
+
+    hemecoor = pandas.read_csv(StringIO(read_run_file(csvfile)), header=[0, 1], index_col=0)
+    hemecoor.columns = pandas.MultiIndex.from_tuples([(top, '' if sub.startswith('Unnamed') else sub)
+                                                      for top, sub in hemecoor.columns])
+
+    return hemecoor
+
+
+def multi_isoform_prediction(ligand, isoforms, log=logger, filter_clusters=True, pose_hits=False, **kwargs):
+    """
+    Combined SOM prediction for multiple CYP isoforms
+
+    SMARTCyp is run and the ligand is parsed only once. The results are
+    shared by the isoform specific predictions of which the PLANTS dockings
+    run concurrently. Isoform predictions stored in the `som_result_cache`
+    are not rerun and SMARTCyp is skipped if all of them are stored.
+
+    :param ligand:           ligand in Tripos MOL2 format
+    :type ligand:            :py:str
+    :param isoforms:         CYP isoforms to make prediction for
+    :type isoforms:          :py:list
+    :param log:              Python logger instance
+    :type log:               :py:logging
+    :param filter_clusters:  filter docking psoes on clusters
+    :type filter_clusters:   :py:bool
+    :param pose_hits:        include sparse per-pose SOM hits in results
+    :type pose_hits:         :py:bool
+    :param kwargs:           additional CombinedPrediction arguments
+    :type kwargs:            :py:dict
+
+    :return:                 combined prediction results keyed by isoform,
+                             None for failed isoform predictions
+    :rtype:                  :py:dict
+    """
+
+    predictions = {}
+    for isoform in isoforms:
+        sompred = CombinedPrediction(log=log, cyp=isoform, **kwargs)
+        if sompred.cyp is not None:
+            predictions[sompred.cyp] = sompred
+
+    if not predictions:
+        log.error('No supported CYP isoforms in: {0}'.format(', '.join(isoforms)))
+        return
+
+    # Stored isoform predictions
+    ligand_atoms = parse_tripos(ligand)
+
+    results = {}
+    cache_keys = {}
+    for isoform, sompred in predictions.items():
+        cache_keys[isoform] = sompred.prediction_key(ligand, ligand_atoms, filter_clusters=filter_clusters,
+                                                     pose_hits=pose_hits)
+        results[isoform] = som_result_cache.get(cache_keys[isoform])
+        if results[isoform] is not None:
+            log.info('Return stored SOM prediction for CYP {0}'.format(isoform))
+
+    predictions = dict([(isoform, sompred) for isoform, sompred in predictions.items() if results[isoform] is None])
+    if not predictions:
+        return results
+
+    # Shared stages
+    smartcyp_results = list(predictions.values())[0].run_smartcyp(ligand)
+    if smartcyp_results is None:
+        return
+
+    # Run isoform predictions concurrently
+    pool = ThreadPool(processes=len(predictions))
+    try:
+        jobs = {}
+        for isoform, sompred in predictions.items():
+            jobs[isoform] = pool.apply_async(propagate_context(sompred.run), (ligand, ),
+                                             {'filter_clusters': filter_clusters, 'pose_hits': pose_hits,
+                                              'smartcyp_results': smartcyp_results, 'ligand_atoms': ligand_atoms,
+                                              'use_cache': False})
+
+        for isoform, job in jobs.items():
+            try:
+                results[isoform] = job.get()
+            except MDStudioException as error:
+                log.error('SOM prediction for CYP {0} failed: {1}'.format(isoform, repr(error)))
+                results[isoform] = None
+
+            if results[isoform] is not None:
+                som_result_cache.set(cache_keys[isoform], results[isoform])
+
+        if any([result is not None for result in results.values()]):
+            return results
+    finally:
+        pool.close()
+        pool.join()
+
+
+def batch_som_prediction(ligands, cyp='3A4', max_workers=4, log=logger, filter_clusters=True, pose_hits=False,
+                         **kwargs):
+    """
+    Combined SOM prediction for a library of ligands
+
+    Ligands are consumed lazily from `ligands`, for instance the generator
+    returned by `read_molecules`, and scheduled over a pool of at most
+    `max_workers` concurrent predictions. At most twice that number of
+    ligands is held in memory at any time. Identical ligands in flight, based
+    on their `mol2_hash`, are predicted only once, repeats later in the
+    library are served by the `som_result_cache`. Results are yielded per
+    ligand as soon as they complete and thus not necessarily in input order.
+    A ligand that fails is reported with its 'error' and does not stop the
+    batch. Closing the generator early kills the PLANTS, SMARTCyp and SPORES
+    processes of the predictions still running.
+
+    :param ligands:          ligands as (name, Tripos MOL2) tuples or as
+                             (offset, name, Tripos MOL2) tuples yielded by
+                             `read_molecules`
+    :type ligands:           :py:list
+    :param cyp:              CYP isoform(s) to make prediction for
+    :type cyp:               :py:str, :py:list
+    :param max_workers:      maximum number of concurrent ligand predictions
+    :type max_workers:       :py:int
+    :param log:              Python logger instance
+    :type log:               :py:logging
+    :param filter_clusters:  filter docking psoes on clusters
+    :type filter_clusters:   :py:bool
+    :param pose_hits:        include sparse per-pose SOM hits in results
+    :type pose_hits:         :py:bool
+    :param kwargs:           additional CombinedPrediction arguments
+    :type kwargs:            :py:dict
+
+    :return:                 per ligand results with input 'index', source
+                             'offset' if known, ligand 'name', 'status',
+                             prediction 'output' and 'error' if it failed
+    :rtype:                  :py:dict generator
+    """
+
+    def predict(key, ligand):
+
+        try:
+            with control:
+                if isinstance(cyp, (list, tuple)):
+                    prediction = multi_isoform_prediction(ligand, cyp, log=log, filter_clusters=filter_clusters,
+                                                          pose_hits=pose_hits, **kwargs)
+                else:
+                    sompred = CombinedPrediction(log=log, cyp=cyp, **kwargs)
+                    prediction = sompred.run(ligand, filter_clusters=filter_clusters, pose_hits=pose_hits)
+        except Exception as error:
+            log.error('SOM prediction failed: {0}'.format(repr(error)))
+            return key, None, str(error)
+
+        return key, prediction, None
+
+    ligands = iter(ligands)
+    max_workers = max(1, max_workers)
+    completed = Queue()
+    in_flight = OrderedDict()
+    count = 0
+    pool = None
+
+    # Stop the external processes of running predictions when the batch is
+    # closed before it finished, e.g. by a client disconnecting
+    control = JobControl()
+    try:
+        while True:
+
+            # Keep the pool busy without reading the full library
+            while ligands is not None and len(in_flight) < 2 * max_workers:
+                try:
+                    entry = tuple(next(ligands))
+                except StopIteration:
+                    ligands = None
+                    break
+
+                offset, name, ligand = entry if len(entry) == 3 else (None, ) + entry
+                key = mol2_hash(ligand)
+                if key not in in_flight:
+                    if pool is None:
+                        pool = ThreadPool(processes=max_workers)
+                    in_flight[key] = []
+                    pool.apply_async(propagate_context(predict), (key, ligand), callback=completed.put)
+                in_flight[key].append((count, offset, name))
+                count += 1
+
+            if not in_flight:
+                break
+
+            key, prediction, error = completed.get()
+            for index, offset, name in in_flight.pop(key):
+                result = {'index': index, 'name': name, 'status': 'completed' if prediction else 'failed',
+                          'output': prediction}
+                if offset is not None:
+                    result['offset'] = offset
+                if error is not None:
+                    result['error'] = error
+                yield result
+    finally:
+        control.cancel()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if count:
+        log.info('Batch SOM prediction finished for {0} ligands'.format(count))
+
+
+def som_cache_info():
+    """
+    :return: SOM prediction result cache size, configuration and hit rate
+    :rtype:  :py:dict
+    """
+
+    return som_result_cache.stats()
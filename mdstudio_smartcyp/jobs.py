@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous jobs for long running PLANTS docking and SOM prediction runs.
+
+A job is submitted with the request of the 'docking' or 'som_prediction'
+endpoint and returns a job ID right away. The job runs in a background
+worker and its status and result are polled using the job ID. Jobs are
+stored as JSON files in the `JOB_STORE` directory of the base working
+directory, unfinished jobs are restarted when the service restarts.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+from mdstudio_smartcyp import __module__
+from mdstudio_smartcyp.plants_run import PlantsDocking
+from mdstudio_smartcyp.combined_prediction import CombinedPrediction, multi_isoform_prediction
+from mdstudio_smartcyp.utils import (mol_validate_file_object, JOB_STORE, FINISHED_JOB_STATES as FINISHED_STATES,
+                                     MDStudioException)
+from mdstudio_smartcyp.scheduling import admission_controller, available_cpus, JobControl, JobCancelled, Workload
+
+logger = logging.getLogger(__module__)
+
+
+def docking_job(request):
+    """
+    Run a PLANTS docking for a 'docking' endpoint request
+
+    :param request: docking request with 'protein_file' and 'ligand_file'
+                    path_file objects
+    :type request:  :py:dict
+
+    :return:        docking results or None if the docking failed
+    :rtype:         :py:dict
+    """
+
+    protein_file = mol_validate_file_object(request['protein_file'])
+    ligand_file = mol_validate_file_object(request['ligand_file'])
+
+    base_dir = os.environ.get('BASE_WORK_DIR', request.get('base_work_dir'))
+    config = dict([(key, value) for key, value in request.items() if key not in
+                   ('protein_file', 'ligand_file', 'base_work_dir', 'progress_topic')])
+
+    docking = PlantsDocking(base_work_dir=base_dir, **config)
+    if docking.run(protein_file['content'], ligand_file['content']):
+        return docking.get_results()
+
+    return None
+
+
+def som_prediction_job(request):
+    """
+    Run a combined SOM prediction for a 'som_prediction' endpoint request
+
+    :param request: SOM prediction request with 'ligand_file' path_file
+                    object
+    :type request:  :py:dict
+
+    :return:        SOM prediction or None if the prediction failed
+    :rtype:         :py:dict
+    """
+
+    ligand_file = mol_validate_file_object(request['ligand_file'])
+
+    base_dir = os.environ.get('BASE_WORK_DIR', request.get('base_work_dir'))
+    config = dict([(key, value) for key, value in request.items() if key not in
+                   ('ligand_file', 'base_work_dir', 'cyp', 'filter_clusters', 'pose_hits')])
+
+    cyp = request.get('cyp', '3A4')
+    if isinstance(cyp, list) and len(cyp) == 1:
+        cyp = cyp[0]
+
+    if isinstance(cyp, list):
+        return multi_isoform_prediction(ligand_file['content'], cyp, base_work_dir=base_dir,
+                                        filter_clusters=request.get('filter_clusters', True),
+                                        pose_hits=request.get('pose_hits', False), **config)
+
+    sompred = CombinedPrediction(base_work_dir=base_dir, cyp=cyp, **config)
+    return sompred.run(ligand_file['content'], filter_clusters=request.get('filter_clusters', True),
+                       pose_hits=request.get('pose_hits', False))
+
+
+def job_cost(endpoint, request):
+    """
+    Estimated work of a job for the `admission_controller`
+
+    :param endpoint:    job endpoint name
+    :type endpoint:     :py:str
+    :param request:     job request
+    :type request:      :py:dict
+
+    :return:            number of dockings
+    :rtype:             :py:int
+    """
+
+    if endpoint == 'som_prediction' and isinstance(request.get('cyp'), list):
+        return max(len(request['cyp']), 1)
+
+    return 1
+
+
+class JobStore(object):
+    """
+    Job records stored as one JSON file per job in a directory.
+
+    Files are written to a temporary file first and moved in place so
+    readers never see a partially written job. The job result is stored
+    in a separate file to keep status polling cheap.
+    """
+
+    def __init__(self, path):
+        """
+        :param path:    job store directory, created if needed
+        :type path:     :py:str
+        """
+
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, job_id, suffix='json'):
+
+        # Job IDs are generated by the JobManager, reject anything else
+        if not job_id or not all(char.isalnum() for char in job_id):
+            raise MDStudioException('Invalid job ID: {0}'.format(job_id))
+
+        return os.path.join(self.path, '{0}.{1}'.format(job_id, suffix))
+
+    def _write(self, path, data):
+
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(handle, 'w') as tmp_file:
+            json.dump(data, tmp_file)
+        os.rename(tmp_path, path)
+
+    def save(self, job):
+        """
+        :param job: job record
+        :type job:  :py:dict
+        """
+
+        self._write(self._file(job['job_id']), job)
+
+    def save_result(self, job_id, result):
+        """
+        :param job_id:  job ID
+        :type job_id:   :py:str
+        :param result:  JSON serializable job result
+        """
+
+        self._write(self._file(job_id, suffix='result.json'), result)
+
+    def load(self, job_id):
+        """
+        :param job_id:  job ID
+        :type job_id:   :py:str
+
+        :return:        job record or None for unknown jobs
+        :rtype:         :py:dict
+        """
+
+        path = self._file(job_id)
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as job_file:
+            return json.load(job_file)
+
+    def load_result(self, job_id):
+        """
+        :param job_id:  job ID
+        :type job_id:   :py:str
+
+        :return:        job result or None
+        """
+
+        path = self._file(job_id, suffix='result.json')
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as result_file:
+            return json.load(result_file)
+
+    def jobs(self):
+        """
+        Iterate over all stored job records
+        """
+
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.json') and not name.endswith('.result.json'):
+                job = self.load(name[:-len('.json')])
+                if job is not None:
+                    yield job
+
+
+class JobManager(object):
+    """
+    Run 'docking' and 'som_prediction' requests as asynchronous jobs.
+
+    Submitted jobs hold their work in the `admission_controller` under the
+    endpoint name until they finish, the same as synchronous requests, and
+    run as 'bulk' `Workload` in a pool of worker threads. Cancelling a job
+    kills its running PLANTS, SMARTCyp or SPORES processes, releasing their
+    `job_scheduler` slots.
+    """
+
+    functions = {'docking': docking_job, 'som_prediction': som_prediction_job}
+
+    def __init__(self, path=None, max_workers=None, max_attempts=2):
+        """
+        :param path:            job store directory, `JOB_STORE` in the
+                                BASE_WORK_DIR or system temp directory by
+                                default
+        :type path:             :py:str
+        :param max_workers:     maximum number of concurrently running jobs,
+                                the available CPUs by default
+        :type max_workers:      :py:int
+        :param max_attempts:    maximum number of times a job is started,
+                                jobs interrupted by a service restart are
+                                started again until this number is reached
+        :type max_attempts:     :py:int
+        """
+
+        self.path = path
+        self.max_workers = max_workers or available_cpus()
+        self.max_attempts = max_attempts
+
+        self._store = None
+        self._pool = None
+        self._controls = {}
+        self._lock = Lock()
+
+    @property
+    def store(self):
+        """
+        Job store, created on first use
+        """
+
+        if self._store is None:
+            self._store = JobStore(self.path or os.path.join(
+                os.environ.get('BASE_WORK_DIR') or tempfile.gettempdir(), JOB_STORE))
+
+        return self._store
+
+    def _start(self, job, cost, start):
+
+        control = JobControl()
+        with self._lock:
+            self._controls[job['job_id']] = control
+            if self._pool is None:
+                self._pool = ThreadPool(processes=self.max_workers)
+
+        self._pool.apply_async(self._run, (job, control, cost, start))
+
+    def _run(self, job, control, cost, start):
+
+        result = None
+        try:
+            with self._lock:
+                if control.cancelled.is_set():
+                    return
+
+                job.update({'status': 'running', 'started': time.time(), 'attempts': job['attempts'] + 1})
+                self.store.save(job)
+
+            with control, Workload('bulk'):
+                result = self.functions[job['endpoint']](job['request'])
+
+            job['status'] = 'completed' if result else 'failed'
+        except JobCancelled:
+            job['status'] = 'cancelled'
+        except Exception as error:
+            logger.error('Job {0} failed: {1}'.format(job['job_id'], repr(error)))
+            job.update({'status': 'failed', 'error': str(error)})
+        finally:
+            admission_controller.release(job['endpoint'], cost=cost, start=start)
+
+            with self._lock:
+                del self._controls[job['job_id']]
+                if control.cancelled.is_set():
+                    job['status'] = 'cancelled'
+                elif result:
+                    self.store.save_result(job['job_id'], result)
+
+                job['finished'] = time.time()
+                self.store.save(job)
+
+        logger.info('Job {0} {1} in {2:.1f} sec.'.format(job['job_id'], job['status'],
+                                                          job['finished'] - job['started']))
+
+    def submit(self, endpoint, request):
+        """
+        Submit a job
+
+        :param endpoint:    endpoint to run the request for, 'docking' or
+                            'som_prediction'
+        :type endpoint:     :py:str
+        :param request:     JSON serializable endpoint request
+        :type request:      :py:dict
+
+        :return:            job record
+        :rtype:             :py:dict
+        :raises:            Overloaded, endpoint over capacity
+        """
+
+        if endpoint not in self.functions:
+            raise MDStudioException('No asynchronous jobs for endpoint: {0}'.format(endpoint))
+
+        cost = job_cost(endpoint, request)
+        start = admission_controller.acquire(endpoint, cost=cost)
+
+        job = {'job_id': uuid.uuid4().hex, 'endpoint': endpoint, 'request': request, 'status': 'queued',
+               'submitted': time.time(), 'started': None, 'finished': None, 'attempts': 0, 'error': None}
+        try:
+            self.store.save(job)
+        except Exception:
+            admission_controller.release(endpoint, cost=cost)
+            raise
+
+        self._start(job, cost, start)
+        logger.info('Submitted {0} job {1}'.format(endpoint, job['job_id']))
+
+        return self.status(job['job_id'])
+
+    def status(self, job_id):
+        """
+        :param job_id:  job ID
+        :type job_id:   :py:str
+
+        :return:        job record without request or None for unknown jobs
+        :rtype:         :py:dict
+        """
+
+        job = self.store.load(job_id)
+        if job is not None:
+            del job['request']
+
+        return job
+
+    def result(self, job_id):
+        """
+        :param job_id:  job ID
+        :type job_id:   :py:str
+
+        :return:        result of a completed job or None
+        """
+
+        return self.store.load_result(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. Queued jobs are not started, running jobs are stopped
+        by killing their external processes.
+
+        :param job_id:  job ID
+        :type job_id:   :py:str
+
+        :return:        job record or None for unknown jobs
+        :rtype:         :py:dict
+        """
+
+        with self._lock:
+            job = self.store.load(job_id)
+            if job is None or job['status'] in FINISHED_STATES:
+                return self.status(job_id)
+
+            control = self._controls.get(job_id)
+            if control is not None:
+                control.cancel()
+
+            job.update({'status': 'cancelled', 'finished': time.time()})
+            self.store.save(job)
+
+        logger.info('Cancelled job {0}'.format(job_id))
+        return self.status(job_id)
+
+    def recover(self):
+        """
+        Restart jobs left queued or running by a previous service process.
+        Jobs are started again until `max_attempts` is reached.
+
+        :return:    IDs of the restarted jobs
+        :rtype:     :py:list
+        """
+
+        recovered = []
+        for job in self.store.jobs():
+            if job['status'] in FINISHED_STATES or job['job_id'] in self._controls:
+                continue
+
+            if job['attempts'] >= self.max_attempts:
+                job.update({'status': 'failed', 'finished': time.time(),
+                            'error': 'Interrupted {0} times by a service restart'.format(job['attempts'])})
+                self.store.save(job)
+                continue
+
+            job['status'] = 'queued'
+            self.store.save(job)
+
+            # Recovered jobs were admitted before the restart
+            cost = job_cost(job['endpoint'], job['request'])
+            self._start(job, cost, admission_controller.acquire(job['endpoint'], cost=cost, force=True))
+            recovered.append(job['job_id'])
+
+        if recovered:
+            logger.info('Restarted {0} interrupted jobs'.format(len(recovered)))
+
+        return recovered
+
+
+job_manager = JobManager()
@@ -6,6 +6,10 @@ PLANTS_CONF_FILE_TEMPLATE = textwrap.dedent("""
     # Scoring function and search settings
     scoring_function             {scoring_function}
     search_speed                 {search_speed}
+    aco_ants                     {aco_ants}
+    aco_evap                     {aco_evap}
+    aco_sigma                    {aco_sigma}
+    seed                         {seed}
     rescore_mode                 {rescore_mode}
     outside_binding_site_penalty {outside_binding_site_penalty}
     enable_sulphur_acceptors     {enable_sulphur_acceptors}
@@ -11,14 +11,24 @@ Classes for protein-ligand docking using the PLANTS software:
 
 import logging
 import os
+import re
 import json
 import copy
 import glob
+import random
+import shutil
+
+from threading import Event, Thread, Lock
+from multiprocessing.pool import ThreadPool
 
 from mdstudio_smartcyp import __module__, __package_path__, __plants_path__, __plants_version__, __plants_citation__
 from mdstudio_smartcyp.plants_conf import PLANTS_CONF_FILE_TEMPLATE
-from mdstudio_smartcyp.utils import (_schema_to_data, RunnerBaseClass, prepare_work_dir, create_multi_mol2,
-                                     create_multi_pdb, import_plants_csv, atom_count, MDStudioException)
+from mdstudio_smartcyp.utils import (_schema_to_data, prepare_work_dir, atom_count, stage_input, read_molecules,
+                                     parse_tripos, rotatable_bond_count, Queue, Empty, StringIO, MDStudioException)
+from mdstudio_smartcyp.storage import (create_multi_mol2, create_multi_pdb, iter_multi_mol2, iter_multi_pdb,
+                                       iter_structure_archive, import_plants_csv, pack_results, run_packer,
+                                       open_pose_archive, structure_exists, crop_protein, read_structure)
+from mdstudio_smartcyp.scheduling import RunnerBaseClass, propagate_context, JobControl, JobCancelled
 from mdstudio_smartcyp.clustering import coords_from_mol2, ClusterStructures
 
 logger = logging.getLogger(__module__)
@@ -26,6 +36,10 @@ logger = logging.getLogger(__module__)
 PLANTS_DOCKING_SCHEMA = os.path.join(__package_path__, 'schemas/endpoints/docking_request.v1.json')
 settings = _schema_to_data(json.load(open(PLANTS_DOCKING_SCHEMA)))
 
+# Number of speed4 search shards equivalent to the search_speed budget
+SEARCH_SHARDS = {'speed1': 4, 'speed2': 2, 'speed4': 1}
+SHARD_SEARCH_SPEED = 'speed4'
+
 
 def plants_version_info():
     """
@@ -40,11 +54,410 @@ def plants_version_info():
 
     info_dict = {'version': __plants_version__,
                  'citation': __plants_citation__,
-                 'default_settings': default_settings}
+                 'default_settings': default_settings,
+                 'search_policy': search_policy.stats()}
 
     return info_dict
 
 
+def top_scores(shard_dirs, count):
+    """
+    Best docking scores over the PLANTS results of search shards
+
+    :param shard_dirs:  shard output directories
+    :type shard_dirs:   :py:list
+    :param count:       number of scores
+    :type count:        :py:int
+
+    :return:            lowest TOTAL_SCORE values in ascending order
+    :rtype:             :py:list
+    """
+
+    scores = []
+    for shard_dir in shard_dirs:
+        scores.extend(row['TOTAL_SCORE'] for row in import_plants_csv(shard_dir).values()
+                      if row.get('TOTAL_SCORE') is not None)
+
+    return sorted(scores)[:count]
+
+
+def scores_converged(previous, current, tolerance):
+    """
+    Independent searches converged if they reproduce the same top scores
+
+    :param previous:    top scores of the finished search shards
+    :type previous:     :py:list
+    :param current:     top scores of a new search shard
+    :type current:      :py:list
+    :param tolerance:   maximum difference of any of the top scores
+    :type tolerance:    :py:float
+
+    :return:            the top scores converged
+    :rtype:             :py:bool
+    """
+
+    if not previous or not current:
+        return False
+
+    return max(abs(a - b) for a, b in zip(previous, current)) <= tolerance
+
+
+def merge_shards(workdir, shard_dirs, max_poses):
+    """
+    Merge the PLANTS results of search shards into the docking directory
+    as if written by a single PLANTS run.
+
+    For every ligand entry, the best `max_poses` poses of all shards by
+    TOTAL_SCORE are renumbered by rank and moved to the docking directory
+    together with their rows in the PLANTS CSV files. The best ranking keeps
+    the best pose per ligand entry. Other output files are taken from the
+    shard with the best pose. The shard directories are removed.
+
+    :param workdir:     docking directory
+    :type workdir:      :py:str
+    :param shard_dirs:  finished shard output directories
+    :type shard_dirs:   :py:list
+    :param max_poses:   maximum number of poses to keep per ligand entry
+    :type max_poses:    :py:int
+
+    :return:            number of merged poses
+    :rtype:             :py:int
+    """
+
+    entries = {}
+    for shard_dir in shard_dirs:
+        for name, row in import_plants_csv(shard_dir).items():
+            entry = re.sub(r'_conf_\d+$', '', name)
+            entries.setdefault(entry, []).append((row.get('TOTAL_SCORE', 0), shard_dir, name))
+
+    # Renumber conformations by rank per ligand entry
+    poses = []
+    names = {}
+    for entry in sorted(entries):
+        entry_poses = sorted(entries[entry], key=lambda pose: pose[0])[:max_poses]
+        width = max(2, len(str(len(entry_poses))))
+        for rank, (score, shard_dir, name) in enumerate(entry_poses, start=1):
+            names[(shard_dir, name)] = '{0}_conf_{1:0{2}d}'.format(entry, rank, width)
+            shutil.move(os.path.join(shard_dir, name + '.mol2'),
+                        os.path.join(workdir, names[(shard_dir, name)] + '.mol2'))
+        poses.extend(entry_poses)
+
+    for csv_file in ('features.csv', 'ranking.csv', 'bestranking.csv'):
+        header = None
+        rows = {}
+        for shard_dir in shard_dirs:
+            path = os.path.join(shard_dir, csv_file)
+            if not os.path.exists(path):
+                continue
+
+            with open(path) as shard_csv:
+                lines = shard_csv.read().splitlines()
+            if lines:
+                header = lines[0]
+                for line in lines[1:]:
+                    rows[(shard_dir, line.split(',')[0])] = line.split(',')[1:]
+
+        if header is None:
+            continue
+
+        # Best ranking is the best pose per ligand entry
+        written = set()
+        with open(os.path.join(workdir, csv_file), 'w') as merged_csv:
+            merged_csv.write(header + '\n')
+            for score, shard_dir, name in sorted(poses, key=lambda pose: pose[0]):
+                entry = re.sub(r'_conf_\d+$', '', name)
+                if (shard_dir, name) in rows and not (csv_file == 'bestranking.csv' and entry in written):
+                    merged_csv.write(','.join([names[(shard_dir, name)]] + rows[(shard_dir, name)]) + '\n')
+                    written.add(entry)
+
+    if poses:
+        best_shard = min(poses, key=lambda pose: pose[0])[1]
+        for name in os.listdir(best_shard):
+            path = os.path.join(workdir, name)
+            if not name.endswith('.csv') and not os.path.exists(path):
+                shutil.move(os.path.join(best_shard, name), path)
+
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    return len(poses)
+
+
+class SearchBudgetPolicy(object):
+    """
+    Select the PLANTS search budget, `search_speed` and `aco_ants`, from the
+    ligand complexity, a quality tier and an optional runtime target. The
+    requested `aco_evap` and `aco_sigma` are passed to PLANTS unchanged.
+
+    Ligands are classified as rigid, medium or flexible by their number of
+    rotatable bonds and heavy atoms. The quality tier ('fast', 'standard' or
+    'thorough') selects a budget per class from `budgets`, ordered from
+    cheap to expensive. With a `target_runtime` the budget is lowered until
+    the predicted runtime fits the target.
+
+    Runtime is predicted as `unit_time` times the cost of a docking: heavy
+    atoms times (1 + rotatable bonds) times the speed4 search equivalents
+    times ants relative to the PLANTS default of 20 times the iteration
+    scaling `aco_sigma`, summed over the ligands. Predicted and actual
+    runtimes of adaptive dockings are logged by `record` and calibrate
+    `unit_time` as exponential moving average.
+
+    :param unit_time:   initial runtime in seconds per unit of cost
+    :type unit_time:    :py:float
+    """
+
+    # Search budgets as (search_speed, aco_ants) from cheap to expensive
+    budgets = [('speed4', 10), ('speed4', 20), ('speed2', 20), ('speed1', 20), ('speed1', 30)]
+
+    # Budget index per quality tier for rigid, medium and flexible ligands
+    tiers = {'fast': (0, 1, 2), 'standard': (1, 2, 3), 'thorough': (2, 3, 4)}
+
+    def __init__(self, unit_time=0.02):
+
+        self.unit_time = unit_time
+        self.runs = 0
+        self.mean_error = None
+        self._lock = Lock()
+
+    @staticmethod
+    def complexity(ligand):
+        """
+        :param ligand:  ligand structures in Tripos MOL2 format
+        :type ligand:   :py:str
+
+        :return:        heavy atom and rotatable bond count per ligand
+        :rtype:         :py:list
+        """
+
+        molecules = []
+        for offset, name, molecule in read_molecules(StringIO(ligand), fmt='mol2'):
+            mol2 = parse_tripos(molecule)
+            heavy_atoms = sum(1 for atom_type in mol2.atoms['atom_type'].tolist() if atom_type.split('.')[0] != 'H')
+            molecules.append((heavy_atoms, rotatable_bond_count(mol2)))
+
+        return molecules
+
+    @staticmethod
+    def cost(molecules, search_speed, aco_ants, aco_sigma=1.0):
+        """
+        :param molecules:       heavy atom and rotatable bond count per
+                                ligand as returned by `complexity`
+        :type molecules:        :py:list
+        :param search_speed:    PLANTS search speed
+        :type search_speed:     :py:str
+        :param aco_ants:        number of ants
+        :type aco_ants:         :py:int
+        :param aco_sigma:       PLANTS iteration scaling factor
+        :type aco_sigma:        :py:float
+
+        :return:                docking cost
+        :rtype:                 :py:float
+        """
+
+        return sum(heavy_atoms * (1 + rotatable_bonds) for heavy_atoms, rotatable_bonds in molecules) * \
+            SEARCH_SHARDS.get(search_speed, 1) * aco_ants / 20.0 * aco_sigma
+
+    def predict(self, molecules, search_speed, aco_ants, aco_sigma=1.0):
+        """
+        :return:    predicted docking runtime in seconds
+        :rtype:     :py:float
+        """
+
+        return self.unit_time * self.cost(molecules, search_speed, aco_ants, aco_sigma)
+
+    def select(self, ligand, quality='standard', target_runtime=None, aco_sigma=1.0):
+        """
+        Select the search budget for docking a ligand
+
+        :param ligand:          ligand structures in Tripos MOL2 format
+        :type ligand:           :py:str
+        :param quality:         quality tier, 'fast', 'standard' or
+                                'thorough'
+        :type quality:          :py:str
+        :param target_runtime:  runtime target in seconds, none if 0
+        :type target_runtime:   :py:float
+        :param aco_sigma:       requested PLANTS iteration scaling factor
+        :type aco_sigma:        :py:float
+
+        :return:                PLANTS 'search_speed' and 'aco_ants', the
+                                'aco_sigma' used for the prediction and the
+                                ligand complexity and predicted runtime
+        :rtype:                 :py:dict
+        """
+
+        if quality not in self.tiers:
+            raise MDStudioException('Unknown search quality tier: {0}'.format(quality))
+
+        molecules = self.complexity(ligand)
+        heavy_atoms = max([heavy_atoms for heavy_atoms, rotatable_bonds in molecules] or [0])
+        rotatable_bonds = max([rotatable_bonds for heavy_atoms, rotatable_bonds in molecules] or [0])
+
+        if rotatable_bonds <= 2 and heavy_atoms <= 30:
+            ligand_class = 0
+        elif rotatable_bonds <= 7 and heavy_atoms <= 50:
+            ligand_class = 1
+        else:
+            ligand_class = 2
+
+        index = self.tiers[quality][ligand_class]
+        while target_runtime and index > 0 and \
+                self.predict(molecules, *self.budgets[index], aco_sigma=aco_sigma) > target_runtime:
+            index -= 1
+
+        search_speed, aco_ants = self.budgets[index]
+        return {'search_speed': search_speed, 'aco_ants': aco_ants, 'aco_sigma': aco_sigma, 'molecules': molecules,
+                'predicted_runtime': self.predict(molecules, search_speed, aco_ants, aco_sigma)}
+
+    def record(self, budget, runtime):
+        """
+        Log predicted and actual runtime of a docking and calibrate the
+        runtime per unit of cost
+
+        :param budget:  search budget as returned by `select`
+        :type budget:   :py:dict
+        :param runtime: actual PLANTS runtime in seconds
+        :type runtime:  :py:float
+        """
+
+        cost = self.cost(budget['molecules'], budget['search_speed'], budget['aco_ants'], budget['aco_sigma'])
+        logger.info('PLANTS search budget {0}, {1} ants for ligands {2} (heavy atoms, rotatable bonds): predicted '
+                    'runtime {3:.1f} sec., actual {4:.1f} sec.'.format(budget['search_speed'], budget['aco_ants'],
+                                                                       budget['molecules'],
+                                                                       budget['predicted_runtime'], runtime))
+        if cost <= 0:
+            return
+
+        with self._lock:
+            error = abs(runtime - budget['predicted_runtime']) / max(runtime, 1e-6)
+            self.mean_error = error if self.mean_error is None else 0.8 * self.mean_error + 0.2 * error
+            self.unit_time = 0.8 * self.unit_time + 0.2 * runtime / cost
+            self.runs += 1
+
+    def stats(self):
+        """
+        :return:    calibrated runtime per unit of cost, number of recorded
+                    dockings and mean relative prediction error
+        :rtype:     :py:dict
+        """
+
+        with self._lock:
+            return {'unit_time': self.unit_time, 'runs': self.runs, 'mean_error': self.mean_error}
+
+
+class DockingProgress(object):
+    """
+    Publish the progress of a running PLANTS docking.
+
+    PLANTS writes the poses of a ligand to the docking directory as soon as
+    the search for that ligand finishes and reports scores on stdout while
+    searching. The docking directory is polled every `interval` seconds for
+    new pose files, each published once as a 'pose' event with its path ID,
+    MOL2 structure and score, if already in the PLANTS ranking. Every
+    improvement of the best score on stdout is published as a 'score'
+    event.
+
+    :param workdir:     PLANTS docking directory
+    :type workdir:      :py:str
+    :param callback:    function called with every progress event
+    :type callback:     :py:function
+    :param interval:    docking directory poll interval in seconds
+    :type interval:     :py:float
+    """
+
+    score_regex = re.compile(r'score\D*?(-?\d+\.\d+)', re.IGNORECASE)
+
+    def __init__(self, workdir, callback, interval=1.0):
+
+        self.workdir = workdir
+        self.callback = callback
+        self.interval = interval
+
+        self.best_score = None
+        self.published = set()
+        self._sizes = {}
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start polling the docking directory
+        """
+
+        self._stop.clear()
+        self._thread = Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop polling and publish the poses not published yet
+        """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.poll(final=True)
+
+    def _watch(self):
+
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def output(self, line):
+        """
+        Parse a PLANTS stdout line for the best score so far
+
+        :param line:    stdout line
+        :type line:     :py:str
+        """
+
+        match = self.score_regex.search(line)
+        if match:
+            score = float(match.group(1))
+            if self.best_score is None or score < self.best_score:
+                self.best_score = score
+                self.callback({'event': 'score', 'score': score})
+
+    def poll(self, final=False):
+        """
+        Publish new pose files. A pose is published once its file size is
+        unchanged since the previous poll, or directly when `final`.
+
+        :param final:   the docking finished, all pose files are complete
+        :type final:    :py:bool
+        """
+
+        poses = sorted(path for path in glob.glob(os.path.join(self.workdir, '*_entry_*_conf_*.mol2'))
+                       if path not in self.published)
+        if not poses:
+            return
+
+        try:
+            ranking = import_plants_csv(self.workdir, poses)
+        except (IOError, IndexError, ValueError):
+            ranking = {}
+
+        docking_dir_name = os.path.basename(self.workdir)
+        for path in poses:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+
+            if not final and self._sizes.get(path) != size:
+                self._sizes[path] = size
+                continue
+
+            with open(path) as pose_file:
+                structure = pose_file.read()
+
+            name = os.path.splitext(os.path.basename(path))[0]
+            row = ranking.get(name, {})
+            self.published.add(path)
+            self.callback({'event': 'pose', 'pose': name, 'PATH': os.path.join(docking_dir_name, name + '.mol2'),
+                           'score': row.get('TOTAL_SCORE'), 'structure': structure})
+
+
 class PlantsDocking(RunnerBaseClass):
     """
     Class for running a protein-ligand docking using the PLANTS docking
@@ -77,6 +490,8 @@ class PlantsDocking(RunnerBaseClass):
     :type kwargs:         :py:dict
     """
 
+    tool = 'plants'
+
     def __init__(self, log=logger, base_work_dir=None, **kwargs):
 
         self.log = log
@@ -121,11 +536,17 @@ class PlantsDocking(RunnerBaseClass):
             if self.workdir:
                 rel_paths = [path for path in glob.glob(os.path.join(self.workdir, '*_entry_*_conf_*.mol2'))]
 
+                # Poses may be packed while listing them
+                archive = open_pose_archive(self.workdir)
+                if archive is not None:
+                    rel_paths = sorted(set(rel_paths) | set([os.path.join(self.workdir, '{0}.mol2'.format(name))
+                                                             for name in archive.names]))
+
         if isinstance(rel_paths, str):
             rel_paths = [rel_paths]
 
         if isinstance(rel_paths, (list, tuple)):
-            rel_paths = [os.path.join(self.base_work_dir, path) if not os.path.exists(path) else path for
+            rel_paths = [os.path.join(self.base_work_dir, path) if not structure_exists(path) else path for
                          path in rel_paths]
 
             # Cannot combine results from different docking runs
@@ -133,7 +554,7 @@ class PlantsDocking(RunnerBaseClass):
                 raise MDStudioException('Unable to combine results for more then one docking run')
 
             # Do the results still exist
-            if any([not os.path.exists(path) for path in rel_paths]):
+            if any([not structure_exists(path) for path in rel_paths]):
                 raise MDStudioException('Docking results (no longer) exist: {0}'.format(os.path.basename(rel_paths[0])))
 
         if rel_paths:
@@ -250,7 +671,8 @@ class PlantsDocking(RunnerBaseClass):
 
         return results
 
-    def get_structures(self, structures, output_format='mol2', include_protein=False, create_ensemble=True):
+    def get_structures(self, structures, output_format='mol2', include_protein=False, create_ensemble=True,
+                       stream=False, archive=None):
         """
         Return docked poses in MOL2 or PDB file format. If `create_ensemble`
         all poses will be concatenated as single multi-molecule (ensemble)
@@ -270,6 +692,14 @@ class PlantsDocking(RunnerBaseClass):
         :type include_protein:  :py:bool
         :param create_ensemble: concatenate multiple docked poses as a single
                                 multi-molecule ensemble file.
+        :param stream:          return the ensemble as generator of file
+                                chunks to write to file or response instead
+                                of a single string.
+        :type stream:           :py:bool
+        :param archive:         return the individual structure files as
+                                'tar' or 'zip' archive generated as byte
+                                chunks. The protein is included once.
+        :type archive:          :py:str
 
         :return:                list of multiple molecular structures or one
                                 single (ensemble) structure in MOL2 or PDB
@@ -285,17 +715,24 @@ class PlantsDocking(RunnerBaseClass):
 
         self.log.debug('Return {0} structures for {1}'.format(len(structures), self.workdir))
 
-        # Return structure ensemble in PDB or MOL2 format
+        # Return structures as archive or as ensemble in PDB or MOL2 format
+        if archive:
+            return iter_structure_archive(structures, archive=archive, output_format=output_format, protein=protein)
+
         if output_format == 'mol2':
             if create_ensemble:
+                if stream:
+                    return iter_multi_mol2(structures, protein=protein)
                 return create_multi_mol2(structures, protein=protein)
             return [create_multi_mol2([mol], protein=protein) for mol in structures]
         elif output_format == 'pdb':
             if create_ensemble:
+                if stream:
+                    return iter_multi_pdb(structures, protein=protein)
                 return create_multi_pdb(structures, protein=protein)
             return [create_multi_pdb([mol], protein=protein) for mol in structures]
 
-    def run(self, protein, ligand, mode='screen'):
+    def run(self, protein, ligand, mode='screen', progress=None, pack=True):
         """
         Run a PLANTS docking for a given protein and ligand in mol2
         format in either 'screen' or 'rescore' mode.
@@ -317,16 +754,45 @@ class PlantsDocking(RunnerBaseClass):
                   default to enable seperate clustering and result retrieval
                   by the user.
 
-        :param protein: protein 3D structure in mol2 format
-        :type protein:  str
-        :param ligand:  ligand 3D structure in mol2 format
-        :type ligand:   str
-        :param mode:    PLANTS execution mode as either virtual
-                        screening 'screen' or rescoring 'rescore'
-        :type mode:     str
-
-        :return:        boolean to indicate successful docking
-        :rtype:         bool
+        After a successful run the docking pose files are packed into a
+        single `PoseArchive` and the other run files are compressed by
+        `pack_results` through the `run_packer`, by default in the
+        background after returning, unless `pack` is False because the
+        caller adds files to the run first. Poses remain available by their
+        path ID. The protein is
+        staged from the content-addressed blob store by `stage_input`.
+        If `crop_protein` is set, PLANTS reads the protein cropped to the
+        binding site by `crop_protein` instead.
+
+        If `search_policy` is 'adaptive', `search_speed` and `aco_ants` are
+        selected by the `SearchBudgetPolicy` for the ligand, `search_quality`
+        and `target_runtime`.
+
+        If `converge` is set, the `search_speed` budget is split in
+        `SHARD_SEARCH_SPEED` search shards run by `run_shards` that stop
+        once the top ranked scores converged.
+
+        Without a `seed` in the configuration a random seed is drawn, the
+        seed used is logged and written to the PLANTS configuration file.
+
+        A `progress` callback receives the `DockingProgress` events of the
+        running docking: docking poses as soon as PLANTS writes them and
+        improvements of the best score.
+
+        :param protein:  protein 3D structure in mol2 format
+        :type protein:   str
+        :param ligand:   ligand 3D structure in mol2 format
+        :type ligand:    str
+        :param mode:     PLANTS execution mode as either virtual
+                         screening 'screen' or rescoring 'rescore'
+        :type mode:      str
+        :param progress: function called with docking progress events
+        :type progress:  :py:function
+        :param pack:     pack the docking run files once completed
+        :type pack:      :py:bool
+
+        :return:         boolean to indicate successful docking
+        :rtype:          bool
         """
 
         # Check required PLANTS configuration arguments
@@ -349,9 +815,8 @@ class PlantsDocking(RunnerBaseClass):
         if os.path.isfile(protein):
             self.config['protein_file'] = protein
         else:
-            with open(os.path.join(self.workdir, 'protein.mol2'), 'w') as protein_file:
-                protein_file.write(protein)
-                self.config['protein_file'] = 'protein.mol2'
+            stage_input(protein, os.path.join(self.workdir, 'protein.mol2'))
+            self.config['protein_file'] = 'protein.mol2'
 
         if os.path.isfile(ligand):
             self.config['ligand_file'] = ligand
@@ -366,14 +831,169 @@ class PlantsDocking(RunnerBaseClass):
             self.delete()
             raise MDStudioException('Ligand structure contains more atoms than protein structure. Swapped input?')
 
+        # Crop the protein to the binding site plus margin, the full protein is retained for analysis
+        if self.config.get('crop_protein'):
+            cropped = crop_protein(read_structure(os.path.join(self.workdir, self.config['protein_file'])),
+                                   self.config['bindingsite_center'],
+                                   self.config['bindingsite_radius'] + self.config.get('crop_margin', 6))
+            stage_input(cropped, os.path.join(self.workdir, 'protein_cropped.mol2'))
+            self.config['protein_file'] = 'protein_cropped.mol2'
+
+        # Adapt the search budget to the ligand complexity
+        budget = None
+        if self.config.get('search_policy') == 'adaptive' and mode == 'screen':
+            with open(os.path.join(self.workdir, self.config['ligand_file'])) as ligand_file:
+                budget = search_policy.select(ligand_file.read(), quality=self.config.get('search_quality', 'standard'),
+                                              target_runtime=self.config.get('target_runtime'),
+                                              aco_sigma=self.config['aco_sigma'])
+            self.config['search_speed'] = budget['search_speed']
+            self.config['aco_ants'] = budget['aco_ants']
+
+        if not self.config.get('seed'):
+            self.config['seed'] = random.randint(1, 2 ** 30)
+        self.log.info('PLANTS random seed {0}'.format(self.config['seed']))
+
         # Write PLANTS configuration file
         conf_file = os.path.join(self.workdir, 'plants.config')
         with open(conf_file, 'w') as conf:
             conf.write(PLANTS_CONF_FILE_TEMPLATE.format(**self.config))
 
-        success = self.cmd_runner([exec_path, '--mode', mode, 'plants.config'])
+        # Split the search in shards to stop at convergence
+        shards = 1
+        if self.config.get('converge') and mode == 'screen':
+            shards = SEARCH_SHARDS.get(self.config['search_speed'], 1)
+
+        watcher = None
+        if progress is not None:
+            watcher = DockingProgress(self.workdir, progress)
+            watcher.start()
+
+        try:
+            if shards > 1:
+                success = self.run_shards(exec_path, shards, watcher=watcher)
+            else:
+                success = self.cmd_runner([exec_path, '--mode', mode, 'plants.config'],
+                                          output_callback=watcher.output if watcher else None)
+        finally:
+            if watcher is not None:
+                watcher.stop()
+
         if not success or not len(glob.glob(os.path.join(self.workdir, '*_entry_*_conf_*.mol2'))):
             success = False
             self.delete()
+            return success
+
+        # Calibrate the search budget runtime model on complete searches
+        if budget is not None and shards == 1:
+            search_policy.record(budget, self.runtime)
+
+        # Pack the pose files into a single pose archive and compress the remaining run files
+        if pack:
+            run_packer.write(pack_results, self.workdir)
 
         return success
+
+    def run_shards(self, exec_path, shards, watcher=None):
+        """
+        Run a PLANTS screening as independent search shards stopped once
+        the docking converged.
+
+        Every shard is an independent search with its own random seed, the
+        configured `seed` plus the shard index minus one. The shards start
+        in stages: the first two run concurrently as far as the
+        `job_scheduler` slots for PLANTS allow, as convergence needs two
+        finished shards to compare. Every time a shard finishes, its
+        `converge_top` best scores are compared to those of the shards
+        finished before. When none differ more than `converge_tolerance`,
+        the running shard is cancelled and no further shard is started,
+        otherwise the next shard starts. The results of the finished shards
+        are merged into the docking directory by `merge_shards`.
+
+        :param exec_path:   PLANTS executable
+        :type exec_path:    :py:str
+        :param shards:      number of search shards
+        :type shards:       :py:int
+        :param watcher:     docking progress publishing 'score' events and a
+                            'shard' event for every finished shard
+        :type watcher:      :mdstudio_smartcyp:plants_run:DockingProgress
+
+        :return:            boolean to indicate successful docking
+        :rtype:             :py:bool
+        """
+
+        control = JobControl()
+        outer = JobControl.current()
+        completed = Queue()
+
+        def run_shard(index):
+            shard_dir = os.path.join(self.workdir, 'shard-{0}'.format(index))
+            success = False
+            try:
+                conf_file = 'plants-shard-{0}.config'.format(index)
+                with open(os.path.join(self.workdir, conf_file), 'w') as conf:
+                    conf.write(PLANTS_CONF_FILE_TEMPLATE.format(**dict(self.config, search_speed=SHARD_SEARCH_SPEED,
+                                                                       seed=self.config['seed'] + index - 1,
+                                                                       output_dir=os.path.basename(shard_dir))))
+
+                with control:
+                    success = self.cmd_runner([exec_path, '--mode', 'screen', conf_file],
+                                              output_callback=watcher.output if watcher else None)
+            except JobCancelled:
+                success = False
+            finally:
+                completed.put((shard_dir, success and len(glob.glob(os.path.join(shard_dir, '*_conf_*.mol2'))) > 0))
+
+        # Start two shards, later shards only while the docking did not converge
+        pool = ThreadPool(processes=min(2, shards))
+        started = running = min(2, shards)
+        for index in range(1, started + 1):
+            pool.apply_async(propagate_context(run_shard), (index, ))
+
+        finished = []
+        converged = False
+        while running:
+            while True:
+                try:
+                    shard_dir, success = completed.get(timeout=1)
+                    break
+                except Empty:
+                    if outer is not None and outer.cancelled.is_set():
+                        control.cancel()
+            running -= 1
+
+            if success and not converged:
+                top = self.config.get('converge_top', 5)
+                scores = top_scores([shard_dir], top)
+                converged = scores_converged(top_scores(finished, top), scores,
+                                             self.config.get('converge_tolerance', 1.0))
+                finished.append(shard_dir)
+                if watcher is not None:
+                    watcher.callback({'event': 'shard', 'shards': len(finished), 'scores': scores,
+                                      'converged': converged})
+
+                if converged and len(finished) < shards:
+                    self.log.info('Docking converged after {0} of {1} search shards'.format(len(finished), shards))
+                    control.cancel()
+
+            if not converged and started < shards and not control.cancelled.is_set():
+                started += 1
+                running += 1
+                pool.apply_async(propagate_context(run_shard), (started, ))
+
+        pool.close()
+        pool.join()
+
+        if outer is not None and outer.cancelled.is_set():
+            finished = []
+
+        merged = merge_shards(self.workdir, finished, self.config['cluster_structures'])
+        for shard_dir in glob.glob(os.path.join(self.workdir, 'shard-*')):
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+        if outer is not None:
+            outer.check()
+
+        return merged > 0
+
+
+search_policy = SearchBudgetPolicy()
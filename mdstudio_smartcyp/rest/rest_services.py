@@ -7,18 +7,86 @@ REST service methods the module exposes.
 """
 
 import os
+import json
+import itertools
 
+from threading import Thread
+from functools import wraps
+from flask import Response, stream_with_context
 from werkzeug import FileStorage
 
 from mdstudio_smartcyp.smartcyp_run import SmartCypRunner
 from mdstudio_smartcyp.plants_run import PlantsDocking
 from mdstudio_smartcyp.spores_run import SporesRunner
-from mdstudio_smartcyp.utils import mol_validate_file_object, MDStudioException
-from mdstudio_smartcyp.combined_prediction import CombinedPrediction
+from mdstudio_smartcyp.utils import mol_validate_file_object, read_molecules, Queue, MDStudioException
+from mdstudio_smartcyp.scheduling import admission_controller, Workload, JobControl, Overloaded
+from mdstudio_smartcyp.combined_prediction import CombinedPrediction, multi_isoform_prediction, batch_som_prediction
+from mdstudio_smartcyp.jobs import job_manager
 
+archive_mimetypes = {'tar': 'application/x-tar', 'zip': 'application/zip'}
 
+
+def overloaded_response(error):
+    """
+    HTTP 503 Service Unavailable response for a request rejected by the
+    `admission_controller`
+
+    :param error:   admission control rejection
+    :type error:    :mdstudio_smartcyp:scheduling:Overloaded
+    """
+
+    return error.message, 503, {'Retry-After': str(error.retry_after)}
+
+
+def admitted(endpoint, cost=None):
+    """
+    Admit requests to a REST endpoint through the `admission_controller`
+    for the duration of the call. Streamed responses stay admitted until
+    the response is closed, also when the client disconnects before the
+    stream started. Over capacity, requests are rejected by an
+    `overloaded_response`.
+
+    :param endpoint:    endpoint name
+    :type endpoint:     :py:str
+    :param cost:        function estimating the work of a request from the
+                        request parameters, 1 by default
+    :type cost:         :py:function
+    """
+
+    def decorator(func):
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            work = cost(kwargs) if cost else 1
+            try:
+                start = admission_controller.acquire(endpoint, cost=work)
+            except Overloaded as error:
+                return overloaded_response(error)
+
+            def release():
+                admission_controller.release(endpoint, cost=work, start=start)
+
+            try:
+                response = func(*args, **kwargs)
+            except Exception:
+                release()
+                raise
+
+            if isinstance(response, Response) and response.is_streamed:
+                response.call_on_close(release)
+            else:
+                release()
+
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+@admitted('som_prediction', cost=lambda kwargs: len(kwargs['cyp']) if isinstance(kwargs.get('cyp'), list) else 1)
 def som_prediction(ligand_file, base_work_dir=None, cyp='3A4', filter_clusters=True, explicit_oxygen=False,
-                   smartcyp_score_label=None, **kwargs):
+                   smartcyp_score_label=None, pose_hits=False, ensemble_docking=False, **kwargs):
     """
     Run a REST based SOM prediction run
 
@@ -27,8 +95,9 @@ def som_prediction(ligand_file, base_work_dir=None, cyp='3A4', filter_clusters=T
     :param base_work_dir:        optional work directory to (temporary) store
                                  PLANTS docking results.
     :type base_work_dir:         :py:str
-    :param cyp:                  CYP isoform to make prediction for
-    :type cyp:                   :py:str
+    :param cyp:                  CYP isoform(s) to make prediction for. Results
+                                 are keyed by isoform for multiple isoforms
+    :type cyp:                   :py:str, :py:list
     :param filter_clusters:      make prediction for clustered docking results
                                  only
     :type filter_clusters:       :py:bool
@@ -38,6 +107,12 @@ def som_prediction(ligand_file, base_work_dir=None, cyp='3A4', filter_clusters=T
     :param smartcyp_score_label: SMARTCyp output 'score' values to use for
                                  prediction
     :type smartcyp_score_label:  :py:str
+    :param pose_hits:            include the docking poses in which each atom
+                                 was identified as SOM
+    :type pose_hits:             :py:bool
+    :param ensemble_docking:     dock against all conformations of the CYP
+                                 isoform and pool the SOM predictions
+    :type ensemble_docking:      :py:bool
     :param kwargs:               additional docking configuration parameters
     :type kwargs:                :py:dict
 
@@ -52,9 +127,20 @@ def som_prediction(ligand_file, base_work_dir=None, cyp='3A4', filter_clusters=T
         return 'Unsupported protein file structure: {0}'.format(type(ligand_file)), 401
 
     # Run combined structure/reactivity prediction
-    sompred = CombinedPrediction(base_work_dir=os.environ.get('BASE_WORK_DIR', base_work_dir), cyp=cyp,
-                                 explicit_oxygen=explicit_oxygen, smartcyp_score_label=smartcyp_score_label, **kwargs)
-    prediction = sompred.run(ligand_file, filter_clusters=filter_clusters)
+    base_work_dir = os.environ.get('BASE_WORK_DIR', base_work_dir)
+    if isinstance(cyp, list) and len(cyp) == 1:
+        cyp = cyp[0]
+
+    if isinstance(cyp, list):
+        prediction = multi_isoform_prediction(ligand_file, cyp, base_work_dir=base_work_dir,
+                                              filter_clusters=filter_clusters, pose_hits=pose_hits,
+                                              explicit_oxygen=explicit_oxygen, ensemble_docking=ensemble_docking,
+                                              smartcyp_score_label=smartcyp_score_label, **kwargs)
+    else:
+        sompred = CombinedPrediction(base_work_dir=base_work_dir, cyp=cyp, explicit_oxygen=explicit_oxygen,
+                                     ensemble_docking=ensemble_docking, smartcyp_score_label=smartcyp_score_label,
+                                     **kwargs)
+        prediction = sompred.run(ligand_file, filter_clusters=filter_clusters, pose_hits=pose_hits)
 
     if prediction:
         return prediction
@@ -62,10 +148,185 @@ def som_prediction(ligand_file, base_work_dir=None, cyp='3A4', filter_clusters=T
     return 'SOM prediction failed', 401
 
 
-def plants_docking(protein_file, ligand_file, base_work_dir=None, **kwargs):
+@admitted('som_prediction_batch', cost=lambda kwargs: kwargs.get('max_workers', 4))
+def som_prediction_batch(ligand_file, base_work_dir=None, cyp='3A4', max_workers=4, start_offset=0, **kwargs):
+    """
+    Run a REST based SOM prediction for a library of ligands
+
+    Results are streamed back as newline delimited JSON (NDJSON), one line
+    per ligand as soon as its prediction completes. The uploaded library is
+    read one ligand at a time, every result contains the byte 'offset' of the
+    ligand in the library from which an interrupted batch can be resumed.
+    The REST service patches the standard library for gevent at startup:
+    while this request waits on I/O or the prediction subprocesses, other
+    requests are served. CPU bound Python and pandas work of a prediction
+    blocks all requests until it finished.
+
+    :param ligand_file:          ligand library as multi MOL2 file
+    :type ligand_file:           :py:str
+    :param base_work_dir:        optional work directory to (temporary) store
+                                 PLANTS docking results.
+    :type base_work_dir:         :py:str
+    :param cyp:                  CYP isoform(s) to make prediction for.
+    :type cyp:                   :py:str, :py:list
+    :param max_workers:          maximum number of ligands predicted
+                                 concurrently
+    :type max_workers:           :py:int
+    :param start_offset:         byte offset in the library to start from
+    :type start_offset:          :py:int
+    :param kwargs:               additional SOM prediction and docking
+                                 configuration parameters
+    :type kwargs:                :py:dict
+
+    :return:                     per ligand SOM prediction results
+    :rtype:                      :flask:Response
+    """
+
+    if isinstance(ligand_file, FileStorage):
+        ligands = read_molecules(ligand_file.stream, fmt='mol2', start=start_offset)
+    else:
+        return 'Unsupported ligand file structure: {0}'.format(type(ligand_file)), 401
+
+    first = next(ligands, None)
+    if first is None:
+        return 'No ligand structures in ligand file', 401
+
+    if isinstance(cyp, list) and len(cyp) == 1:
+        cyp = cyp[0]
+
+    # Batch is admitted with its concurrency until the response is closed
+    results = batch_som_prediction(itertools.chain([first], ligands), cyp=cyp, max_workers=max_workers,
+                                   base_work_dir=os.environ.get('BASE_WORK_DIR', base_work_dir), **kwargs)
+
+    response = Response(stream_with_context(json.dumps(result) + '\n' for result in results),
+                        mimetype='application/x-ndjson')
+    response.call_on_close(results.close)
+    return response
+
+
+@admitted('som_reanalysis')
+def som_reanalysis(paths, filter_clusters=True, pose_hits=False, poses=None, smartcyp_score_label=None, **kwargs):
+    """
+    Recompute a SOM prediction from the results stored by a previous
+    SOM prediction run without repeating the docking.
+
+    :param paths:                docking results directories or docking pose
+                                 paths of the SOM prediction
+    :type paths:                 :py:list
+    :param filter_clusters:      make prediction for clustered docking results
+                                 only
+    :type filter_clusters:       :py:bool
+    :param pose_hits:            include the docking poses in which each atom
+                                 was identified as SOM
+    :type pose_hits:             :py:bool
+    :param poses:                restrict prediction to these docking pose
+                                 paths
+    :type poses:                 :py:list
+    :param smartcyp_score_label: SMARTCyp output 'score' values to use for
+                                 prediction
+    :type smartcyp_score_label:  :py:str
+    :param kwargs:               adjusted clustering parameters
+    :type kwargs:                :py:dict
+
+    :return:                     combined SOM prediction
+    :rtype:                      :py:dict
+    """
+
+    sompred = CombinedPrediction(base_work_dir=os.environ.get('BASE_WORK_DIR'), **kwargs)
+
+    try:
+        prediction = sompred.reanalyse(paths, filter_clusters=filter_clusters, pose_hits=pose_hits, poses=poses,
+                                       smartcyp_score_label=smartcyp_score_label)
+    except MDStudioException as error:
+        return repr(error), 401
+
+    if prediction:
+        return prediction
+
+    return 'SOM reanalysis failed', 401
+
+
+def server_sent_event(event, data):
+    """
+    Format a server-sent event (SSE) with JSON data
+
+    :param event:   event type
+    :type event:    :py:str
+    :param data:    JSON serializable event data
+
+    :return:        event stream message
+    :rtype:         :py:str
+    """
+
+    return 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data))
+
+
+def docking_event_stream(docking, protein, ligand):
+    """
+    Run a PLANTS docking in a separate thread and generate its progress as
+    server-sent events: 'score' and 'pose' events while PLANTS is running
+    and a final 'result' event with the docking results or 'failed' event.
+    The docking is cancelled if the client stops reading the stream.
+
+    The REST service patches the standard library for gevent at startup:
+    while this request waits for PLANTS or docking events, other requests
+    are served. CPU bound processing of the results still blocks all
+    requests until it finished.
+
+    :param docking:     PLANTS docking
+    :type docking:      :mdstudio_smartcyp:plants_run:PlantsDocking
+    :param protein:     protein structure
+    :type protein:      :py:str
+    :param ligand:      ligand structure
+    :type ligand:       :py:str
+    """
+
+    events = Queue()
+    control = JobControl()
+
+    def run():
+        result = None
+        try:
+            with control:
+                if docking.run(protein, ligand, progress=events.put):
+                    result = docking.get_results()
+        except MDStudioException as error:
+            events.put({'event': 'failed', 'error': repr(error)})
+            return
+        except Exception as error:
+            events.put({'event': 'failed', 'error': str(error)})
+            raise
+
+        if result:
+            events.put({'event': 'result', 'result': result})
+        else:
+            events.put({'event': 'failed', 'error': 'PLANTS docking failed'})
+
+    thread = Thread(target=run)
+    thread.start()
+
+    try:
+        while True:
+            event = events.get()
+            name = event.pop('event')
+            yield server_sent_event(name, event)
+            if name in ('result', 'failed'):
+                break
+    finally:
+        if thread.is_alive():
+            control.cancel()
+            thread.join()
+
+
+@admitted('docking')
+def plants_docking(protein_file, ligand_file, base_work_dir=None, progress=False, **kwargs):
     """
     Run a REST based PLANTS docking run
 
+    With `progress` the docking poses and improvements of the best score
+    are streamed as server-sent events while PLANTS is running, followed by
+    the docking results, see `docking_event_stream`.
+
     :param protein_file:    protein structure MOL2 file
     :type protein_file:     :py:str
     :param ligand_file:     ligand structure MOL2 file
@@ -73,6 +334,8 @@ def plants_docking(protein_file, ligand_file, base_work_dir=None, **kwargs):
     :param base_work_dir:   optional work directory to (temporary) store PLANTS
                             docking results.
     :type base_work_dir:    :py:str
+    :param progress:        stream docking progress as server-sent events
+    :type progress:         :py:bool
 
     :return:                PLANTS docking statistics (content of features.csv)
                             file.
@@ -89,8 +352,11 @@ def plants_docking(protein_file, ligand_file, base_work_dir=None, **kwargs):
     else:
         return 'Unsupported protein file structure: {0}'.format(type(ligand_file)), 401
 
-    # Run docking
+    # Run docking, admitted until the docking finished or the progress stream is closed
     docking = PlantsDocking(base_work_dir=os.environ.get('BASE_WORK_DIR', base_work_dir), **kwargs)
+    if progress:
+        return Response(stream_with_context(docking_event_stream(docking, protein_file, ligand_file)),
+                        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
     results = None
     try:
@@ -105,6 +371,7 @@ def plants_docking(protein_file, ligand_file, base_work_dir=None, **kwargs):
     return 'PLANTS docking failed', 401
 
 
+@admitted('docking_statistics')
 def plants_docking_statistics(paths=None, **kwargs):
     """
     Return PLANTS docking statistics for particular docking solutions run previously.
@@ -130,11 +397,17 @@ def plants_docking_statistics(paths=None, **kwargs):
     return 'PLANTS docking failed', 401
 
 
-def plants_docking_structures(paths=None, output_format='mol2', include_protein=False, **kwargs):
+@admitted('docking_structures')
+def plants_docking_structures(paths=None, output_format='mol2', include_protein=False, stream=False, archive=None,
+                              **kwargs):
     """
     Return PLANTS docking statistics for particular docking solutions run previously.
     Clustering will also be redone and optionally adjusted.
 
+    PDB ensembles are always streamed using chunked transfer, MOL2 ensembles
+    if `stream` is enabled. An `archive` returns the individual structure
+    files as streamed tar or zip archive.
+
     :param paths:           list of docking solution paths
     :type paths:            :py:list
     :param output_format:   return ensemble in MOL2 or PDB format
@@ -142,24 +415,39 @@ def plants_docking_structures(paths=None, output_format='mol2', include_protein=
     :param include_protein: return ensemble including the protein
                             structure or only the ligand structures
     :type include_protein:  :py:bool
+    :param stream:          stream the MOL2 ensemble
+    :type stream:           :py:bool
+    :param archive:         return structures as 'tar' or 'zip' archive
+    :type archive:          :py:str
 
-    :return:                docking structures as combined Tripos MOL2 file
+    :return:                docking structures as combined Tripos MOL2 file,
+                            streamed ensemble or archive
     :rtype:                 :py:str
     """
 
     docking = PlantsDocking(base_work_dir=os.environ.get('BASE_WORK_DIR'), **kwargs)
 
+    stream = stream or output_format == 'pdb'
     try:
-        results = docking.get_structures(paths, output_format=output_format, include_protein=include_protein)
+        results = docking.get_structures(paths, output_format=output_format, include_protein=include_protein,
+                                         stream=stream, archive=archive)
     except MDStudioException as error:
         return repr(error), 401
 
+    if archive:
+        return Response(stream_with_context(results), mimetype=archive_mimetypes[archive],
+                        headers={'Content-Disposition': 'attachment; filename=structures.{0}'.format(archive)})
+
+    if stream:
+        return Response(stream_with_context(results), mimetype='chemical/x-{0}'.format(output_format))
+
     if results:
         return results
 
     return 'PLANTS docking failed', 401
 
 
+@admitted('smartcyp')
 def smartcyp_prediction(ligand_file=None, smiles=None, output_format='json', noempcorr=False, output_png=False):
     """
     Run a REST based SMARTCyp prediction for a molecule
@@ -193,15 +481,16 @@ def smartcyp_prediction(ligand_file=None, smiles=None, output_format='json', noe
     # Validate path_file_object: valid SMILES or InChI strings
     path_file_object = mol_validate_file_object(path_file_object)
 
-    # Run SMARTCyp
+    # Run SMARTCyp as interactive workload
     smartcyp = SmartCypRunner()
     try:
-        result_dict = smartcyp.run(path_file_object['content'],
-                                   is_smiles=path_file_object['extension'] == 'smi',
-                                   input_format=path_file_object.get('extension', 'mol2'),
-                                   output_format=output_format,
-                                   noempcorr=noempcorr,
-                                   output_png=output_png)
+        with Workload('interactive'):
+            result_dict = smartcyp.run(path_file_object['content'],
+                                       is_smiles=path_file_object['extension'] == 'smi',
+                                       input_format=path_file_object.get('extension', 'mol2'),
+                                       output_format=output_format,
+                                       noempcorr=noempcorr,
+                                       output_png=output_png)
     except Exception as e:
         return str(e), 500
     finally:
@@ -210,6 +499,7 @@ def smartcyp_prediction(ligand_file=None, smiles=None, output_format='json', noe
     return result_dict
 
 
+@admitted('spores')
 def spores_run(mol, spores_mode='complete', input_format='mol2', base_work_dir=None):
     """
     Perform a SPORES (Structure PrOtonation and REcognition System) structure preparation.
@@ -242,7 +532,8 @@ def spores_run(mol, spores_mode='complete', input_format='mol2', base_work_dir=N
 
     spores = SporesRunner(base_work_dir=os.environ.get('BASE_WORK_DIR', base_work_dir))
     try:
-        result_dict = spores.run(path_file_object['content'], mode=spores_mode, input_format=input_format)
+        with Workload('interactive'):
+            result_dict = spores.run(path_file_object['content'], mode=spores_mode, input_format=input_format)
     except Exception as e:
         return str(e), 500
     finally:
@@ -252,3 +543,147 @@ def spores_run(mol, spores_mode='complete', input_format='mol2', base_work_dir=N
         return 'SPORES processing of file {0} failed'.format(path_file_object['path']), 401
 
     return result_dict['content']
+
+
+def upload_file_object(upload, extension='mol2'):
+    """
+    Convert an uploaded file to a path_file object as used in WAMP requests
+
+    :param upload:      uploaded file
+    :type upload:       :werkzeug:FileStorage
+    :param extension:   default file extension
+    :type extension:    :py:str
+
+    :return:            path_file object
+    :rtype:             :py:dict
+    """
+
+    if '.' in os.path.basename(upload.filename or ''):
+        extension = upload.filename.split('.')[-1]
+
+    return {'content': upload.read().decode('utf-8'), 'extension': extension, 'path': None, 'encoding': 'utf8'}
+
+
+def submit_job(endpoint, request):
+    """
+    Submit an asynchronous job
+
+    :param endpoint:    endpoint to run the request for
+    :type endpoint:     :py:str
+    :param request:     endpoint request
+    :type request:      :py:dict
+
+    :return:            job with status 202 Accepted and the job location
+    """
+
+    try:
+        job = job_manager.submit(endpoint, request)
+    except Overloaded as error:
+        return overloaded_response(error)
+
+    return job, 202, {'Location': '/jobs/{0}'.format(job['job_id'])}
+
+
+def plants_docking_submit(protein_file, ligand_file, **kwargs):
+    """
+    Submit a PLANTS docking run as asynchronous job. Accepts the parameters
+    of `plants_docking`.
+
+    :param protein_file:    protein structure MOL2 file
+    :type protein_file:     :py:str
+    :param ligand_file:     ligand structure MOL2 file
+    :type ligand_file:      :py:str
+
+    :return:                submitted job
+    :rtype:                 :py:dict
+    """
+
+    for upload in (protein_file, ligand_file):
+        if not isinstance(upload, FileStorage):
+            return 'Unsupported structure file: {0}'.format(type(upload)), 401
+
+    return submit_job('docking', dict(kwargs, protein_file=upload_file_object(protein_file),
+                                      ligand_file=upload_file_object(ligand_file)))
+
+
+def som_prediction_submit(ligand_file, **kwargs):
+    """
+    Submit a SOM prediction run as asynchronous job. Accepts the parameters
+    of `som_prediction`.
+
+    :param ligand_file:     ligand structure MOL2 file
+    :type ligand_file:      :py:str
+
+    :return:                submitted job
+    :rtype:                 :py:dict
+    """
+
+    if not isinstance(ligand_file, FileStorage):
+        return 'Unsupported ligand file structure: {0}'.format(type(ligand_file)), 401
+
+    return submit_job('som_prediction', dict(kwargs, ligand_file=upload_file_object(ligand_file)))
+
+
+def job_status(job_id):
+    """
+    Return the status of an asynchronous job
+
+    :param job_id:  job ID
+    :type job_id:   :py:str
+
+    :return:        job status
+    :rtype:         :py:dict
+    """
+
+    try:
+        job = job_manager.status(job_id)
+    except MDStudioException as error:
+        return repr(error), 404
+
+    if job is None:
+        return 'Unknown job: {0}'.format(job_id), 404
+
+    return job
+
+
+def job_result(job_id):
+    """
+    Return the result of a completed asynchronous job
+
+    :param job_id:  job ID
+    :type job_id:   :py:str
+
+    :return:        PLANTS docking or SOM prediction results
+    :rtype:         :py:dict
+    """
+
+    job = job_status(job_id)
+    if not isinstance(job, dict):
+        return job
+
+    if job['status'] != 'completed':
+        return 'Job {0} is {1}'.format(job_id, job['status']), 409
+
+    return job_manager.result(job_id)
+
+
+def job_cancel(job_id):
+    """
+    Cancel an asynchronous job, killing its running processes
+
+    :param job_id:  job ID
+    :type job_id:   :py:str
+
+    :return:        job status
+    :rtype:         :py:dict
+    """
+
+    try:
+        job = job_manager.cancel(job_id)
+    except MDStudioException as error:
+        return repr(error), 404
+
+    if job is None:
+        return 'Unknown job: {0}'.format(job_id), 404
+
+    return job
@@ -0,0 +1,743 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scheduling of the external PLANTS, SMARTCyp and SPORES processes
+
+Runners start their processes in CPU slots of the `job_scheduler` by
+workload priority, asynchronous jobs control their processes through a
+`JobControl` and requests to the WAMP and REST endpoints are admitted by
+the `admission_controller`.
+"""
+
+import os
+import time
+import heapq
+import shutil
+import logging
+import itertools
+import subprocess
+import multiprocessing
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Event, Thread, Lock, Condition, local
+
+from mdstudio_smartcyp.utils import MDStudioException
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(MDStudioException):
+    """
+    Request rejected by the `AdmissionController`, the service is over
+    capacity. Retry after `retry_after` seconds.
+    """
+
+    def __init__(self, message, retry_after=1):
+        self.retry_after = retry_after
+        super(Overloaded, self).__init__(message)
+
+
+class JobCancelled(MDStudioException):
+    """
+    Work stopped because the asynchronous job it belongs to was cancelled
+    """
+
+
+class RunnerBaseClass(object):
+
+    # Name of the `job_scheduler` slot pool and scheduling priority of the
+    # external processes started by `cmd_runner`. The priority of the
+    # current `Workload` class is used if not set.
+    tool = None
+    priority = None
+
+    # Wall time in seconds of the last process run by `cmd_runner`,
+    # excluding the time waiting for a slot
+    runtime = None
+
+    def delete(self):
+        """
+        Remove the temporary working directory
+        """
+
+        # Remove the temporary directory again
+        self.log.debug('Remove working directory: {0}'.format(self.workdir))
+
+        shutil.rmtree(self.workdir)
+        self.workdir = None
+
+    def cmd_runner(self, cmd, output_callback=None):
+        """
+        Common Command Line Interface runner
+
+        :param cmd:             CLI commands
+        :type cmd:              :py:list
+        :param output_callback: function called with every line the process
+                                writes to stdout while it is running
+        :type output_callback:  :py:function
+
+        :return:                subprocess stdout and stderr pipes
+        """
+
+        # Run cli command once a slot for the tool is available. Processes of
+        # a cancelled job are killed and their slot released.
+        # TODO: add timeout to prevent infinite jobs
+        was_successfull = True
+        priority = self.priority if self.priority is not None else Workload.current_priority()
+        control = JobControl.current()
+        with job_scheduler.slot(self.tool or self.__class__.__name__.lower(), priority=priority,
+                                cancel=control.cancelled if control else None):
+            self.log.info('Execute cli process: {0}'.format(' '.join(cmd)))
+            try:
+                process = subprocess.Popen(cmd, cwd=self.workdir,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE)
+            except subprocess.CalledProcessError as err:
+                self.log.error('Process failed:', err)
+                was_successfull = False
+            else:
+                self.log.info('Process returncode: {0}'.format(process.returncode))
+                if control:
+                    control.register(process)
+                start = time.time()
+                try:
+                    if output_callback is None:
+                        output, errors = process.communicate()
+                    else:
+                        output, errors = self._stream_output(process, output_callback)
+                finally:
+                    self.runtime = time.time() - start
+                    if control:
+                        control.unregister(process)
+
+                if errors:
+                    self.log.error(errors.decode('utf-8'))
+                if output:
+                    self.log.info(output.decode('utf-8'))
+
+        if control:
+            control.check()
+
+        return was_successfull
+
+    def _stream_output(self, process, output_callback):
+        """
+        Pass stdout of a running process line by line to a callback while
+        collecting stderr in a separate thread
+
+        :return:    stdout and stderr of the process
+        :rtype:     :py:tuple
+        """
+
+        errors = []
+        reader = Thread(target=lambda: errors.append(process.stderr.read()))
+        reader.daemon = True
+        reader.start()
+
+        output = []
+        for line in iter(process.stdout.readline, b''):
+            output.append(line)
+            try:
+                output_callback(line.decode('utf-8', 'replace').rstrip())
+            except Exception as error:
+                self.log.error('Process output callback failed: {0}'.format(error))
+
+        process.wait()
+        reader.join()
+
+        return b''.join(output), b''.join(errors)
+
+
+def available_cpus():
+    """
+    Number of CPUs available to the process
+
+    The CPU count is limited by the CPU affinity of the process and by the
+    cgroup (v2 or v1) CPU quota when running in a container.
+
+    :return:    number of available CPUs, at least 1
+    :rtype:     :py:int
+    """
+
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            fields = cpu_max.read().split()
+        if fields[0] != 'max':
+            quota = float(fields[0]) / float(fields[1])
+    except (IOError, OSError, IndexError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as cfs_quota:
+                with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as cfs_period:
+                    quota = float(cfs_quota.read()) / float(cfs_period.read())
+        except (IOError, OSError, ValueError, ZeroDivisionError):
+            pass
+
+    if quota is not None and quota > 0:
+        cpus = min(cpus, int(quota + 0.5) or 1)
+
+    return max(cpus, 1)
+
+
+class JobScheduler(object):
+    """
+    Thread-safe scheduler limiting the number of concurrently running
+    external processes per tool and in total.
+
+    All processes draw from a budget of `cpus` slots, the available CPUs by
+    default, so that PLANTS, SMARTCyp and SPORES processes together never
+    oversubscribe the CPUs. Every tool (PLANTS, SMARTCyp, SPORES) has its own
+    pool of slots within that budget, sized to the budget by default, that
+    may be configured smaller to keep CPUs free for the other tools.
+    Jobs wait for a slot in a queue ordered by priority, highest first, and
+    in order of submission (FIFO) within the same priority. The order holds
+    across tools for the shared budget. A number of `reserved` slots is only
+    used by jobs with a positive priority, such as those of the
+    'interactive' `Workload`, so they do not wait for long running bulk
+    jobs. Running jobs are not preempted: a bulk process keeps its slot
+    until it exits, higher priority jobs are only placed ahead of it in the
+    queue. Queue depth and wait times are reported by `stats`.
+    """
+
+    def __init__(self, cpus=None, slots=None, reserved=None):
+        """
+
+        :param cpus:        number of slots shared by all tools, the number
+                            of available CPUs by default
+        :type cpus:         :py:int
+        :param slots:       default number of slots per tool, all `cpus` by
+                            default
+        :type slots:        :py:int
+        :param reserved:    number of slots, in total and by default per
+                            tool, reserved for jobs with a positive priority,
+                            a quarter of the slots by default
+        :type reserved:     :py:int
+        """
+
+        self.cpus = cpus or available_cpus()
+        self.slots = min(slots or self.cpus, self.cpus)
+        self.reserved = min(reserved if reserved is not None else self.cpus // 4, self.cpus - 1)
+
+        self._total = self._new_pool(self.cpus, self.reserved)
+        self._pools = {}
+        self._order = itertools.count()
+        self._condition = Condition()
+
+    @staticmethod
+    def _new_pool(slots, reserved):
+
+        return {'slots': slots, 'reserved': reserved, 'running': 0, 'queue': [], 'jobs': 0, 'wait_time': 0.0,
+                'max_wait_time': 0.0}
+
+    def _pool(self, tool):
+
+        if tool not in self._pools:
+            self._pools[tool] = self._new_pool(self.slots, min(self.reserved, self.slots - 1))
+
+        return self._pools[tool]
+
+    @staticmethod
+    def _available(pool, job):
+
+        # Bulk jobs leave the reserved slots free
+        return pool['running'] < pool['slots'] - (pool['reserved'] if job[0] >= 0 else 0)
+
+    def _can_start(self, pool, job):
+
+        if pool['queue'][0] != job or not self._available(pool, job) or not self._available(self._total, job):
+            return False
+
+        # Jobs of other tools that are first in line take the shared slots first
+        return not any([other is not pool and other['queue'] and other['queue'][0] < job and
+                        self._available(other, other['queue'][0]) for other in self._pools.values()])
+
+    def configure(self, tool, slots, reserved=None):
+        """
+        Change the number of slots of a tool
+
+        :param tool:        tool name
+        :type tool:         :py:str
+        :param slots:       number of concurrently running jobs, at most
+                            the `cpus` shared by all tools
+        :type slots:        :py:int
+        :param reserved:    number of slots reserved for jobs with a
+                            positive priority, unchanged by default
+        :type reserved:     :py:int
+        """
+
+        if slots < 1:
+            raise MDStudioException('Job scheduler requires at least one slot for {0}'.format(tool))
+
+        with self._condition:
+            pool = self._pool(tool)
+            slots = min(slots, self.cpus)
+            reserved = pool['reserved'] if reserved is None else reserved
+            if reserved >= slots:
+                raise MDStudioException('Job scheduler requires at least one unreserved slot for {0}'.format(tool))
+
+            pool['slots'] = slots
+            pool['reserved'] = reserved
+            self._condition.notify_all()
+
+    def acquire(self, tool, priority=0, cancel=None):
+        """
+        Wait for a free slot of a tool
+
+        :param tool:        tool name
+        :type tool:         :py:str
+        :param priority:    job priority, higher priority jobs start first
+        :type priority:     :py:int
+        :param cancel:      event to stop waiting on, see `interrupt`
+        :type cancel:       :py:threading.Event
+
+        :return:            time in seconds waited for the slot
+        :rtype:             :py:float
+        :raises:            JobCancelled, if the cancel event is set
+        """
+
+        start = time.time()
+        with self._condition:
+            pool = self._pool(tool)
+            job = (-priority, next(self._order))
+            heapq.heappush(pool['queue'], job)
+
+            while not self._can_start(pool, job):
+                if cancel is not None and cancel.is_set():
+                    pool['queue'].remove(job)
+                    heapq.heapify(pool['queue'])
+                    self._condition.notify_all()
+                    raise JobCancelled('Job cancelled while waiting for a {0} slot'.format(tool))
+                self._condition.wait()
+
+            heapq.heappop(pool['queue'])
+            wait_time = time.time() - start
+            for counter in (pool, self._total):
+                counter['running'] += 1
+                counter['jobs'] += 1
+                counter['wait_time'] += wait_time
+                counter['max_wait_time'] = max(counter['max_wait_time'], wait_time)
+
+            # The next job in the queue may start as well if slots are left
+            self._condition.notify_all()
+
+        return wait_time
+
+    def interrupt(self):
+        """
+        Wake up all waiting jobs to check their cancel event
+        """
+
+        with self._condition:
+            self._condition.notify_all()
+
+    def release(self, tool):
+        """
+        Release a slot of a tool
+
+        :param tool:    tool name
+        :type tool:     :py:str
+        """
+
+        with self._condition:
+            self._pool(tool)['running'] -= 1
+            self._total['running'] -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, tool, priority=0, cancel=None):
+        """
+        Context manager running a job in a slot of a tool
+
+        :param tool:        tool name
+        :type tool:         :py:str
+        :param priority:    job priority, higher priority jobs start first
+        :type priority:     :py:int
+        :param cancel:      event to stop waiting on
+        :type cancel:       :py:threading.Event
+        """
+
+        wait_time = self.acquire(tool, priority=priority, cancel=cancel)
+        if wait_time > 1:
+            logger.info('Waited {0:.1f} sec. for a {1} job slot'.format(wait_time, tool))
+
+        try:
+            yield
+        finally:
+            self.release(tool)
+
+    def stats(self):
+        """
+        :return:    slots, running and queued jobs and wait times per tool
+                    and for the slots shared by all tools as 'total'
+        :rtype:     :py:dict
+        """
+
+        with self._condition:
+            pools = dict(self._pools)
+            pools['total'] = dict(self._total, queue=sum([pool['queue'] for pool in self._pools.values()], []))
+
+            return dict([(tool, {'slots': pool['slots'], 'reserved': pool['reserved'], 'running': pool['running'],
+                                 'queued': len(pool['queue']),
+                                 'jobs': pool['jobs'], 'max_wait_time': pool['max_wait_time'],
+                                 'mean_wait_time': pool['wait_time'] / pool['jobs'] if pool['jobs'] else 0.0})
+                         for tool, pool in pools.items()])
+
+
+class Workload(object):
+    """
+    Workload class of the calling thread
+
+    Interactive requests (single SMARTCyp predictions, info and structure
+    retrieval) are separated from bulk requests (docking, SOM predictions
+    and library screening). External processes started by a runner without
+    its own priority are scheduled by the `job_scheduler` with the priority
+    of the workload class of the thread they are started from. Threads
+    without a workload class are considered bulk. Bulk work is
+    deprioritized, not preempted, see `JobScheduler`.
+
+    Use as context manager or function decorator:
+    ::
+        with Workload('interactive'):
+            smartcyp.run(ligand)
+    """
+
+    classes = {'interactive': 10, 'bulk': 0}
+    _local = local()
+
+    def __init__(self, name):
+        """
+        :param name:    workload class name
+        :type name:     :py:str
+        """
+
+        if name not in self.classes:
+            raise MDStudioException('Unsupported workload class: {0}'.format(name))
+
+        self.name = name
+        self._previous = []
+
+    def __enter__(self):
+
+        self._previous.append(getattr(self._local, 'name', None))
+        self._local.name = self.name
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self._local.name = self._previous.pop()
+
+    def __call__(self, func):
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Workload(self.name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    @classmethod
+    def current(cls):
+        """
+        :return:    workload class name of the calling thread
+        :rtype:     :py:str
+        """
+
+        return getattr(cls._local, 'name', None) or 'bulk'
+
+    @classmethod
+    def current_priority(cls):
+        """
+        :return:    scheduling priority of the workload class of the calling
+                    thread
+        :rtype:     :py:int
+        """
+
+        return cls.classes[cls.current()]
+
+
+class JobControl(object):
+    """
+    Cancellation control of an asynchronous job
+
+    The control is active in the thread that runs the job while used as
+    context manager, and in worker threads started through
+    `propagate_context`. External processes started by runners in these
+    threads are registered with the control. Cancelling kills the running
+    processes, which releases their `job_scheduler` slots, stops jobs
+    waiting for a slot and makes any further runner call raise
+    `JobCancelled`.
+    """
+
+    _local = local()
+
+    def __init__(self):
+
+        self.cancelled = Event()
+        self._processes = set()
+        self._lock = Lock()
+        self._previous = local()
+
+    def __enter__(self):
+
+        # Worker threads enter the same control concurrently, keep the
+        # previous control per thread
+        if not hasattr(self._previous, 'stack'):
+            self._previous.stack = []
+        self._previous.stack.append(getattr(self._local, 'control', None))
+        self._local.control = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self._local.control = self._previous.stack.pop()
+
+    @classmethod
+    def current(cls):
+        """
+        :return:    job control of the calling thread or None
+        :rtype:     :mdstudio_smartcyp:scheduling:JobControl
+        """
+
+        return getattr(cls._local, 'control', None)
+
+    def register(self, process):
+        """
+        Register a running process, killed directly if already cancelled
+
+        :param process: external process
+        :type process:  :py:subprocess.Popen
+        """
+
+        with self._lock:
+            self._processes.add(process)
+            if self.cancelled.is_set():
+                process.kill()
+
+    def unregister(self, process):
+        """
+        :param process: external process
+        :type process:  :py:subprocess.Popen
+        """
+
+        with self._lock:
+            self._processes.discard(process)
+
+    def cancel(self):
+        """
+        Cancel the job, kill its running processes
+        """
+
+        with self._lock:
+            self.cancelled.set()
+            for process in self._processes:
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+
+        job_scheduler.interrupt()
+
+    def check(self):
+        """
+        :raises: JobCancelled, if the job was cancelled
+        """
+
+        if self.cancelled.is_set():
+            raise JobCancelled('Job cancelled')
+
+
+def propagate_context(func):
+    """
+    Run a function in a worker thread with the `Workload` class and
+    `JobControl` of the thread creating the wrapper
+
+    :param func:    function to run in a worker thread
+    :type func:     :py:function
+
+    :return:        wrapped function
+    :rtype:         :py:function
+    """
+
+    workload = Workload.current()
+    control = JobControl.current()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with Workload(workload):
+            if control is None:
+                return func(*args, **kwargs)
+            with control:
+                return func(*args, **kwargs)
+
+    return wrapper
+
+
+def scheduler_info():
+    """
+    :return: job scheduler slots, queue depth and wait times per tool
+    :rtype:  :py:dict
+    """
+
+    return job_scheduler.stats()
+
+
+class AdmissionController(object):
+    """
+    Admission control bounding the estimated work accepted per endpoint
+
+    Every request is admitted with an estimated amount of work, e.g. the
+    number of dockings it runs, and counts against the maximum work of its
+    endpoint until it is released. Requests that would exceed the maximum
+    are rejected with an `Overloaded` exception instead of being queued, so
+    clients back off rather than time out and retry. The suggested retry
+    time is the mean time per unit of work of recently completed requests.
+    """
+
+    def __init__(self, max_work=None):
+        """
+
+        :param max_work:    default maximum work accepted per endpoint, four
+                            times the available CPUs by default. 0 does not
+                            limit.
+        :type max_work:     :py:int
+        """
+
+        self.max_work = max_work if max_work is not None else 4 * available_cpus()
+
+        self._endpoints = {}
+        self._lock = Lock()
+
+    def _endpoint(self, endpoint):
+
+        if endpoint not in self._endpoints:
+            self._endpoints[endpoint] = {'max_work': self.max_work, 'work': 0, 'admitted': 0, 'rejected': 0,
+                                         'unit_time': None}
+
+        return self._endpoints[endpoint]
+
+    def configure(self, endpoint=None, max_work=None):
+        """
+        Change the maximum work accepted by an endpoint or the default for
+        all endpoints
+
+        :param endpoint:    endpoint name, all endpoints by default
+        :type endpoint:     :py:str
+        :param max_work:    maximum work, 0 does not limit
+        :type max_work:     :py:int
+        """
+
+        with self._lock:
+            if endpoint is None:
+                self.max_work = max_work
+                for state in self._endpoints.values():
+                    state['max_work'] = max_work
+            else:
+                self._endpoint(endpoint)['max_work'] = max_work
+
+    def acquire(self, endpoint, cost=1, force=False):
+        """
+        Admit a request to an endpoint
+
+        :param endpoint:    endpoint name
+        :type endpoint:     :py:str
+        :param cost:        estimated work of the request
+        :type cost:         :py:int
+        :param force:       admit regardless of capacity, for work accepted
+                            before such as recovered jobs
+        :type force:        :py:bool
+
+        :return:            admission time to pass on to `release`
+        :rtype:             :py:float
+        :raises:            Overloaded, endpoint over capacity
+        """
+
+        with self._lock:
+            state = self._endpoint(endpoint)
+
+            # A single request is always admitted to an idle endpoint
+            if not force and state['max_work'] and state['work'] and state['work'] + cost > state['max_work']:
+                state['rejected'] += 1
+                retry_after = int(min(max(state['unit_time'] or 10, 1), 600) + 0.5)
+                raise Overloaded('{0} is over capacity ({1} of {2} queued), retry after {3} sec.'.format(
+                    endpoint, state['work'], state['max_work'], retry_after), retry_after=retry_after)
+
+            state['work'] += cost
+            state['admitted'] += 1
+
+        return time.time()
+
+    def release(self, endpoint, cost=1, start=None):
+        """
+        Release the work of an admitted request
+
+        :param endpoint:    endpoint name
+        :type endpoint:     :py:str
+        :param cost:        estimated work of the request as admitted
+        :type cost:         :py:int
+        :param start:       admission time returned by `acquire`
+        :type start:        :py:float
+        """
+
+        with self._lock:
+            state = self._endpoint(endpoint)
+            state['work'] -= cost
+
+            # Exponential moving average of the time per unit of work
+            if start is not None and cost > 0:
+                unit_time = (time.time() - start) / cost
+                state['unit_time'] = unit_time if state['unit_time'] is None else \
+                    0.8 * state['unit_time'] + 0.2 * unit_time
+
+    @contextmanager
+    def admit(self, endpoint, cost=1):
+        """
+        Context manager admitting a request for the duration of the context
+
+        :param endpoint:    endpoint name
+        :type endpoint:     :py:str
+        :param cost:        estimated work of the request
+        :type cost:         :py:int
+        :raises:            Overloaded, endpoint over capacity
+        """
+
+        start = self.acquire(endpoint, cost=cost)
+        try:
+            yield
+        finally:
+            self.release(endpoint, cost=cost, start=start)
+
+    def stats(self):
+        """
+        :return:    accepted and maximum work, admitted and rejected requests
+                    and mean time per unit of work by endpoint
+        :rtype:     :py:dict
+        """
+
+        with self._lock:
+            return dict([(endpoint, {'work': state['work'], 'max_work': state['max_work'],
+                                     'utilization': float(state['work']) / state['max_work'] if state['max_work']
+                                     else 0.0, 'admitted': state['admitted'], 'rejected': state['rejected'],
+                                     'unit_time': state['unit_time'] or 0.0})
+                         for endpoint, state in self._endpoints.items()])
+
+
+def admission_info():
+    """
+    :return: admission control state by endpoint
+    :rtype:  :py:dict
+    """
+
+    return admission_controller.stats()
+
+
+# Scheduler of the external processes of all runners
+job_scheduler = JobScheduler()
+
+# Admission control of the WAMP and REST endpoints
+admission_controller = AdmissionController()
@@ -15,7 +15,8 @@ import base64
 
 from mdstudio_smartcyp import (__smartcyp_version__, __smartcyp_citation__, __supported_models__, __smartcyp_path__,
                                __module__)
-from mdstudio_smartcyp.utils import prepare_work_dir, RunnerBaseClass, renumber_smartcyp_atoms
+from mdstudio_smartcyp.utils import prepare_work_dir, renumber_smartcyp_atoms
+from mdstudio_smartcyp.scheduling import RunnerBaseClass
 
 logger = logging.getLogger(__module__)
 
@@ -42,6 +43,8 @@ class SmartCypRunner(RunnerBaseClass):
     to structured JSON.
     """
 
+    tool = 'smartcyp'
+
     def __init__(self, log=logger, base_work_dir=None):
         """
         Implement class __init__
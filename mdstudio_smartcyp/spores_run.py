@@ -12,7 +12,8 @@ import logging
 import os
 
 from mdstudio_smartcyp import __module__, __spores_path__, __spores_version__, __spores_citation__
-from mdstudio_smartcyp.utils import prepare_work_dir, RunnerBaseClass
+from mdstudio_smartcyp.utils import prepare_work_dir
+from mdstudio_smartcyp.scheduling import RunnerBaseClass
 
 logger = logging.getLogger(__module__)
 
@@ -33,6 +34,8 @@ def spores_version_info():
 
 class SporesRunner(RunnerBaseClass):
 
+    tool = 'spores'
+
     def __init__(self, log=logger, base_work_dir=None, exec_path=None):
 
         self.log = log
@@ -0,0 +1,1041 @@
+# -*- coding: utf-8 -*-
+
+"""
+Storage of docking runs and in-memory result caches
+
+Docking poses of completed runs are packed in a single `PoseArchive` and
+the other run files are compressed at rest by the `run_packer`. Structures
+and run files are read transparently from plain or packed runs, also when
+streamed as ensemble or archive. Recently used results are kept in
+`ResultCache` stores and intermediate results are persisted by an
+`ArtifactWriter`.
+"""
+
+import os
+import re
+import copy
+import glob
+import gzip
+import json
+import time
+import shutil
+import struct
+import hashlib
+import tarfile
+import zipfile
+import logging
+import numpy
+
+from collections import OrderedDict
+from io import BytesIO
+from threading import Thread, Lock
+
+from mdstudio_smartcyp.utils import (parse_tripos, pdb_template, mol2_to_pdb_string, Queue, StringIO,
+                                     MDStudioException)
+
+logger = logging.getLogger(__name__)
+atom_record_regex = re.compile(r'^(\s*\S+\s+\S+)(\s+\S+)(\s+\S+)(\s+\S+)(.*)$')
+pose_file_regex = re.compile(r'_entry_\d+_conf_\d+\.mol2$')
+POSE_ARCHIVE = 'poses.bin'
+PACKED_SUFFIX = '.gz'
+
+
+def protein_pdb_block(protein):
+    """
+    PDB atom records of a protein structure in Tripos MOL2 format.
+
+    The atom records are formatted once per protein conformation and
+    stored in the `pdb_block_cache` by content hash.
+
+    :param protein: Tripos MOL2 protein file path
+    :type protein:  :py:str
+
+    :return:        PDB atom records
+    :rtype:         :py:str
+    """
+
+    content = read_structure(protein)
+
+    key = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    block = pdb_block_cache.get(key)
+    if block is None:
+        block = mol2_to_pdb_string(parse_tripos(content))
+        pdb_block_cache.set(key, block)
+
+    return block
+
+
+def iter_multi_mol2(mol2_file_paths, protein=None, chunk_size=65536):
+    """
+    Generate a multi-molecule MOL2 file by concatenating single MOL2 files.
+
+    Files are read and yielded in chunks of at most `chunk_size` characters
+    to be written to file or streamed as response without building the
+    ensemble in memory. Packed docking poses are regenerated one at a time.
+
+    :param mol2_file_paths: single MOL2 file paths
+    :type mol2_file_paths:  :py:list
+    :param protein:         optional protein MOL2 file path to start with
+    :type protein:          :py:str
+    :param chunk_size:      maximum chunk size
+    :type chunk_size:       :py:int
+
+    :return:                multi-mol2 file chunks
+    :rtype:                 :py:str generator
+    """
+
+    paths = [path for path in mol2_file_paths if structure_exists(path)]
+    if protein:
+        paths.insert(0, protein)
+
+    for path in paths:
+        if not os.path.exists(path):
+            yield read_structure(path)
+            continue
+
+        with open(path, 'r') as singlemol2:
+            for chunk in iter(lambda: singlemol2.read(chunk_size), ''):
+                yield chunk
+
+
+def create_multi_mol2(mol2_file_paths, protein=None):
+    """
+    Create a multi-molecule MOL2 file by concatenating
+    single MOL2 files.
+
+    :param mol2_file_paths: single MOL2 file paths
+    :type mol2_file_paths:  :py:list
+
+    :return:                multi-mol2 file
+    :rtype:                 :py:str
+    """
+
+    return ''.join(iter_multi_mol2(mol2_file_paths, protein=protein))
+
+
+class _ArchiveStream(object):
+    """
+    Write-only file object collecting the output of an archive writer to be
+    yielded as chunks.
+    """
+
+    def __init__(self):
+
+        self.chunks = []
+
+    def write(self, data):
+
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+
+        pass
+
+    def drain(self):
+
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def iter_structure_archive(mol2_file_paths, archive='tar', output_format='mol2', protein=None):
+    """
+    Generate a tar or zip archive of individual structure files.
+
+    The archive is yielded as byte chunks after every added file. MOL2 files
+    are copied into the archive from disk in blocks, packed docking poses and
+    PDB files are generated one at a time. The protein is added once as
+    separate 'protein' file.
+
+    :param mol2_file_paths: single MOL2 file paths
+    :type mol2_file_paths:  :py:list
+    :param archive:         archive format as 'tar' or 'zip'
+    :type archive:          :py:str
+    :param output_format:   structure file format as MOL2 or PDB
+    :type output_format:    :py:str
+    :param protein:         optional protein MOL2 file path
+    :type protein:          :py:str
+
+    :return:                archive chunks
+    :rtype:                 :py:bytes generator
+    """
+
+    if archive not in ('tar', 'zip'):
+        raise MDStudioException('Unsupported archive format: {0}'.format(archive))
+
+    paths = [path for path in mol2_file_paths if structure_exists(path)]
+    if protein:
+        paths.insert(0, protein)
+
+    stream = _ArchiveStream()
+    if archive == 'tar':
+        writer = tarfile.open(fileobj=stream, mode='w|')
+    else:
+        writer = zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_DEFLATED)
+
+    try:
+        for path in paths:
+            name = os.path.basename(path)
+            if output_format == 'mol2' and os.path.exists(path):
+                if archive == 'tar':
+                    writer.add(path, arcname=name)
+                else:
+                    writer.write(path, arcname=name)
+            else:
+                if output_format == 'mol2':
+                    content = read_structure(path)
+                elif path == protein:
+                    name = '{0}.pdb'.format(os.path.splitext(name)[0])
+                    content = protein_pdb_block(path) + 'END\n'
+                else:
+                    name = '{0}.pdb'.format(os.path.splitext(name)[0])
+                    content = create_multi_pdb([path])
+                content = content.encode('utf-8')
+
+                if archive == 'tar':
+                    info = tarfile.TarInfo(name=name)
+                    info.size = len(content)
+                    info.mtime = time.time()
+                    writer.addfile(info, BytesIO(content))
+                else:
+                    writer.writestr(name, content)
+
+            for chunk in stream.drain():
+                yield chunk
+    finally:
+        writer.close()
+
+    for chunk in stream.drain():
+        yield chunk
+
+
+def iter_multi_pdb(mol2_file_paths, protein=None):
+    """
+    Generate a multi-molecule PDB file by converting independent MOL2 files
+    to PDB format as consecutive MODEL records.
+
+    The file is generated in chunks to be written to a file or streamed as
+    response without building the full ensemble in memory. The protein atom
+    records are formatted once using `protein_pdb_block`. Ligand records are
+    formatted using a `pdb_template` shared by all poses with identical atoms.
+
+    :param mol2_file_paths: single MOL2 file paths
+    :type mol2_file_paths:  :py:list
+    :param protein:         optional protein MOL2 file path to include in
+                            every MODEL
+    :type protein:          :py:str
+
+    :return:                multi MODEL PDB file chunks
+    :rtype:                 :py:str generator
+    """
+
+    prot_pdb = None
+    if protein:
+        prot_pdb = protein_pdb_block(protein)
+
+    template = None
+    topology = None
+    is_multi_pdb = len(mol2_file_paths) > 1
+    for model, path in enumerate(mol2_file_paths, start=1):
+
+        if is_multi_pdb:
+            yield 'MODEL {0}\n'.format(model)
+        if prot_pdb:
+            yield prot_pdb
+            yield 'TER\n'
+
+        atoms = parse_tripos(read_structure(path)).atoms
+
+        pose_topology = atoms[['atom_id', 'atom_name', 'subst_id', 'subst_name']].tolist()
+        if pose_topology != topology:
+            template = pdb_template(atoms, record='HETATM', chain='B')
+            topology = pose_topology
+
+        yield template % tuple(numpy.column_stack((atoms['x'], atoms['y'], atoms['z'])).ravel().tolist())
+
+        if is_multi_pdb:
+            yield 'ENDMDL\n'
+    yield 'END\n'
+
+
+def create_multi_pdb(mol2_file_paths, protein=None):
+    """
+    Create a multi-molecule PDB file by converting independent MOL2 files
+    to PDB format and concatenating them in a single multi MODEL PDB file
+
+    :param mol2_file_paths: single MOL2 file paths
+    :type mol2_file_paths:  :py:list
+
+    :return:                multi MODEL PDB file
+    :rtype:                 :py:str
+    """
+
+    return ''.join(iter_multi_pdb(mol2_file_paths, protein=protein))
+
+
+def crop_protein(protein, center, radius, cofactors=('HEM', )):
+    """
+    Crop a protein structure in Tripos MOL2 format to the residues with at
+    least one atom within `radius` of `center`.
+
+    Residues are kept whole and cofactors, identified by substructure name
+    prefix, are always kept. Atoms and bonds are renumbered. Cropped
+    structures are stored in the `cropped_protein_cache` by protein content
+    hash, center and radius.
+
+    :param protein:     Tripos MOL2 protein file
+    :type protein:      :py:str
+    :param center:      binding site center coordinates
+    :type center:       :py:list
+    :param radius:      crop radius
+    :type radius:       :py:float
+    :param cofactors:   substructure name prefixes of residues to keep
+    :type cofactors:    :py:tuple
+
+    :return:            cropped Tripos MOL2 protein file
+    :rtype:             :py:str
+    """
+
+    key = '{0}-{1}-{2}-{3}'.format(hashlib.sha1(protein.encode('utf-8')).hexdigest(),
+                                   ','.join([str(float(c)) for c in center]), float(radius), ','.join(cofactors))
+    cropped = cropped_protein_cache.get(key)
+    if cropped is not None:
+        return cropped
+
+    mol2 = parse_tripos(protein)
+    atoms = numpy.sort(mol2.atoms, order='atom_id')
+    bonds = numpy.sort(mol2.bonds, order='bond_id')
+
+    xyz = numpy.column_stack((atoms['x'], atoms['y'], atoms['z']))
+    inside = ((xyz - numpy.asarray(center, dtype='f8')) ** 2).sum(axis=1) <= radius ** 2
+    if not inside.any():
+        logger.warning('No protein atoms within {0} of binding site center, protein not cropped'.format(radius))
+        return protein
+
+    # Keep whole residues and cofactors
+    keep = numpy.isin(atoms['subst_id'], atoms['subst_id'][inside])
+    for cofactor in cofactors:
+        keep |= numpy.char.startswith(atoms['subst_name'], cofactor)
+
+    atoms = atoms[keep]
+    id_trans = numpy.zeros(mol2.atoms['atom_id'].max() + 1, dtype='i4')
+    id_trans[atoms['atom_id']] = numpy.arange(1, len(atoms) + 1)
+    bonds = bonds[(id_trans[bonds['b_start']] > 0) & (id_trans[bonds['b_end']] > 0)]
+
+    header = mol2.lines[mol2.sections['MOLECULE'][0]:mol2.sections['MOLECULE'][0] + 4]
+    header += [''] * (4 - len(header))
+
+    cropped_mol = StringIO()
+    cropped_mol.write('@<TRIPOS>MOLECULE\n{0}\n'.format(header[0]))
+    cropped_mol.write('{0} {1} 1\n'.format(len(atoms), len(bonds)))
+    cropped_mol.write('{0}\n{1}\n\n'.format(header[2] or 'PROTEIN', header[3] or 'NO_CHARGES'))
+
+    cropped_mol.write('@<TRIPOS>ATOM\n')
+    for i, atom in enumerate(atoms.tolist(), start=1):
+        cropped_mol.write('{0:>7}  {1:8}{2:9.4f} {3:9.4f} {4:9.4f} {5:<5}{6:>4}  {7:8} {8:9.4f}\n'.format(i, *atom[1:]))
+
+    cropped_mol.write('@<TRIPOS>BOND\n')
+    bond_records = zip(id_trans[bonds['b_start']].tolist(), id_trans[bonds['b_end']].tolist(), bonds['b_type'].tolist())
+    for i, bond in enumerate(bond_records, start=1):
+        cropped_mol.write('{0:>6}{1:>6}{2:>6} {3:>4}\n'.format(i, *bond))
+
+    cropped_mol.seek(0)
+    cropped = cropped_mol.read()
+    cropped_protein_cache.set(key, cropped)
+
+    logger.debug('Cropped protein from {0} to {1} atoms'.format(len(mol2.atoms), len(atoms)))
+
+    return cropped
+
+
+class PoseArchive(object):
+    """
+    Compact binary archive of all docking poses of a PLANTS run
+
+    All poses of a docking run share the same atoms and differ in their
+    coordinates only. The archive stores a single MOL2 text template with
+    the coordinates as fixed-width placeholders and the coordinates of all
+    poses as one float64 block that is memory mapped on reading. MOL2 text
+    is regenerated on demand.
+
+    File layout: 8 byte magic, little-endian uint64 header size, JSON header
+    padded to 8 byte alignment, coordinates (poses x atoms x 3).
+
+    Poses that can not be regenerated from the template byte for byte are
+    stored verbatim in the header.
+    """
+
+    magic = b'SMCYPOSE'
+
+    def __init__(self, path):
+        """
+        :param path: pose archive file path
+        :type path:  :py:str
+        """
+
+        self.path = path
+        with open(path, 'rb') as archive:
+            if archive.read(8) != self.magic:
+                raise MDStudioException('Not a docking pose archive: {0}'.format(path))
+            header_size = struct.unpack('<Q', archive.read(8))[0]
+            self.header = json.loads(archive.read(header_size).decode('utf-8'))
+
+        self.names = self.header['poses']
+        self._index = dict([(name, i) for i, name in enumerate(self.names)])
+
+        shape = (len(self.names), self.header['atoms'], 3)
+        if numpy.prod(shape):
+            self.coordinates = numpy.memmap(path, dtype='<f8', mode='r', offset=16 + header_size, shape=shape)
+        else:
+            self.coordinates = numpy.zeros(shape)
+
+    def __contains__(self, name):
+
+        return name in self._index
+
+    def __len__(self):
+
+        return len(self.names)
+
+    def mol2(self, name):
+        """
+        Regenerate the Tripos MOL2 file of a docking pose
+
+        :param name:    pose name, the pose file name without extension
+        :type name:     :py:str
+
+        :return:        Tripos MOL2 file
+        :rtype:         :py:str
+        """
+
+        if name in self.header['verbatim']:
+            return self.header['verbatim'][name]
+
+        xyz = self.coordinates[self._index[name]]
+        return (self.header['template'] % tuple(xyz.ravel().tolist())).replace('\0', name)
+
+    def xyz(self, name):
+        """
+        :param name:    pose name, the pose file name without extension
+        :type name:     :py:str
+
+        :return:        pose coordinates
+        :rtype:         :numpy:ndarray
+        """
+
+        if name in self.header['verbatim']:
+            return parse_tripos(self.header['verbatim'][name]).coordinates
+
+        return numpy.array(self.coordinates[self._index[name]])
+
+    @staticmethod
+    def template(name, mol2):
+        """
+        MOL2 text template of a pose with coordinate placeholders matching
+        the fixed-width coordinate fields and the pose name replaced by a
+        null character.
+
+        :param name:    pose name
+        :type name:     :py:str
+        :param mol2:    pose Tripos MOL2 file
+        :type mol2:     :py:str
+
+        :return:        template
+        :rtype:         :py:str
+        """
+
+        mol2 = parse_tripos(mol2)
+        start, end = mol2.sections.get('ATOM', (0, 0))
+
+        template = []
+        for i, line in enumerate(mol2.lines):
+            match = atom_record_regex.match(line) if start <= i < end else None
+            if match:
+                fields = match.groups()
+                line = fields[0].replace('%', '%%')
+                for field in fields[1:4]:
+                    decimals = len(field.strip().split('.')[1]) if '.' in field else 0
+                    line += '%{0}.{1}f'.format(len(field), decimals)
+                line += fields[4].replace('%', '%%')
+            else:
+                line = line.replace('%', '%%')
+            template.append(line.replace(name, '\0'))
+
+        return '\n'.join(template)
+
+    @classmethod
+    def pack(cls, path, poses):
+        """
+        Write docking poses to a new pose archive
+
+        :param path:    pose archive file path
+        :type path:     :py:str
+        :param poses:   (pose name, Tripos MOL2) tuples
+        :type poses:    :py:list
+
+        :return:        pose archive
+        :rtype:         :mdstudio_smartcyp:storage:PoseArchive
+        """
+
+        template = None
+        atoms = 0
+        verbatim = {}
+        coordinates = []
+        for name, mol2 in poses:
+
+            xyz = parse_tripos(mol2).coordinates
+            if template is None:
+                template = cls.template(name, mol2)
+                atoms = len(xyz)
+
+            # Keep poses that do not round-trip through the template as is
+            if len(xyz) != atoms or (template % tuple(xyz.ravel().tolist())).replace('\0', name) != mol2:
+                verbatim[name] = mol2
+                xyz = numpy.zeros((atoms, 3))
+            coordinates.append(xyz)
+
+        header = json.dumps({'poses': [name for name, mol2 in poses], 'atoms': atoms, 'template': template or '',
+                             'verbatim': verbatim}).encode('utf-8')
+        header += b' ' * (-len(header) % 8)
+
+        tmp_path = '{0}.tmp'.format(path)
+        with open(tmp_path, 'wb') as archive:
+            archive.write(cls.magic)
+            archive.write(struct.pack('<Q', len(header)))
+            archive.write(header)
+            archive.write(numpy.array(coordinates, dtype='<f8').reshape(-1).tobytes())
+        os.rename(tmp_path, path)
+
+        return cls(path)
+
+
+def pack_poses(workdir, remove=True):
+    """
+    Pack the docking pose MOL2 files in a PLANTS docking directory into a
+    single `PoseArchive` named `POSE_ARCHIVE`.
+
+    :param workdir: PLANTS docking directory
+    :type workdir:  :py:str
+    :param remove:  remove the pose MOL2 files once packed
+    :type remove:   :py:bool
+
+    :return:        pose archive or None if there are no poses
+    :rtype:         :mdstudio_smartcyp:storage:PoseArchive
+    """
+
+    paths = sorted([path for path in glob.glob(os.path.join(workdir, '*_entry_*_conf_*.mol2'))
+                    if pose_file_regex.search(path)])
+    if not paths:
+        return None
+
+    poses = []
+    for path in paths:
+        with open(path, 'r') as pose_file:
+            poses.append((os.path.splitext(os.path.basename(path))[0], pose_file.read()))
+
+    archive = PoseArchive.pack(os.path.join(workdir, POSE_ARCHIVE), poses)
+    logger.info('Packed {0} docking poses in {1}, {2} stored verbatim'.format(len(poses), archive.path,
+                                                                             len(archive.header['verbatim'])))
+    if remove:
+        for path in paths:
+            os.remove(path)
+
+    return archive
+
+
+def open_pose_archive(workdir):
+    """
+    Open the `PoseArchive` of a docking directory. Open archives are kept
+    in a small least-recently-used store.
+
+    :param workdir: PLANTS docking directory
+    :type workdir:  :py:str
+
+    :return:        pose archive or None if the directory has no archive
+    :rtype:         :mdstudio_smartcyp:storage:PoseArchive
+    """
+
+    path = os.path.join(workdir, POSE_ARCHIVE)
+    try:
+        key = (path, os.path.getmtime(path))
+    except OSError:
+        return None
+
+    with _pose_archive_lock:
+        archive = _pose_archives.pop(key, None)
+        if archive is None:
+            archive = PoseArchive(path)
+        _pose_archives[key] = archive
+        while len(_pose_archives) > 32:
+            _pose_archives.popitem(last=False)
+
+    return archive
+
+
+def _archived_pose(path):
+
+    archive = open_pose_archive(os.path.dirname(path))
+    name = os.path.splitext(os.path.basename(path))[0]
+    if archive is not None and name in archive:
+        return archive, name
+
+    return None, None
+
+
+def structure_exists(path):
+    """
+    :param path:    structure file path, docking poses may be packed in the
+                    `PoseArchive` of their docking directory
+    :type path:     :py:str
+
+    :return:        structure exists as file or packed pose
+    :rtype:         :py:bool
+    """
+
+    return run_file_exists(path) or _archived_pose(path)[0] is not None
+
+
+def read_structure(path):
+    """
+    Read a structure file or regenerate a packed docking pose
+
+    :param path:    structure file path, docking poses may be packed in the
+                    `PoseArchive` of their docking directory and other files
+                    compressed by `pack_run`
+    :type path:     :py:str
+
+    :return:        structure file content
+    :rtype:         :py:str
+    """
+
+    if not os.path.exists(path):
+        archive, name = _archived_pose(path)
+        if archive is not None:
+            return archive.mol2(name)
+
+    try:
+        return read_run_file(path)
+    except IOError:
+
+        # Pose packed by the `run_packer` since the check
+        archive, name = _archived_pose(path)
+        if archive is None:
+            raise
+        return archive.mol2(name)
+
+
+def structure_coordinates(path):
+    """
+    Atom coordinates of a MOL2 structure file or packed docking pose
+
+    :param path:    structure file path
+    :type path:     :py:str
+
+    :return:        atom coordinates
+    :rtype:         :numpy:ndarray
+    """
+
+    archive, name = _archived_pose(path)
+    if archive is not None and not os.path.exists(path):
+        return archive.xyz(name)
+
+    return parse_tripos(read_structure(path)).coordinates
+
+
+def pack_run(workdir, min_size=1024, exclude=(POSE_ARCHIVE, )):
+    """
+    Compress the files of a completed docking run at rest.
+
+    Every file in the docking directory of at least `min_size` bytes is
+    replaced by a gzip compressed copy with the `PACKED_SUFFIX` appended to
+    the file name. The pose archive, which is memory mapped on reading,
+    files that are compressed already and files staged from the blob store
+    by `stage_input` are left as is. Packed files remain
+    available by their original path through `read_run_file`.
+
+    :param workdir:     docking directory
+    :type workdir:      :py:str
+    :param min_size:    minimum file size in bytes to compress
+    :type min_size:     :py:int
+    :param exclude:     file names to leave uncompressed
+    :type exclude:      :py:tuple
+
+    :return:            names of the packed files
+    :rtype:             :py:list
+    """
+
+    packed = []
+    for name in sorted(os.listdir(workdir)):
+        path = os.path.join(workdir, name)
+        if name in exclude or os.path.splitext(name)[1] in ('.gz', '.pdf', '.tar', '.zip', '.tmp') or \
+                not os.path.isfile(path) or os.path.getsize(path) < min_size or os.stat(path).st_nlink > 1:
+            continue
+
+        tmp_path = '{0}{1}.tmp'.format(path, PACKED_SUFFIX)
+        with open(path, 'rb') as infile:
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as outfile:
+                shutil.copyfileobj(infile, outfile)
+        os.rename(tmp_path, path + PACKED_SUFFIX)
+        os.remove(path)
+        packed.append(name)
+
+    if packed:
+        logger.info('Packed {0} files in {1}'.format(len(packed), workdir))
+
+    return packed
+
+
+def pack_results(workdir):
+    """
+    Pack a completed docking run: the docking poses into a `PoseArchive` by
+    `pack_poses` and the other run files by `pack_run`. Called through the
+    `run_packer` to keep compression out of the response time.
+
+    :param workdir: docking directory
+    :type workdir:  :py:str
+    """
+
+    try:
+        pack_poses(workdir)
+        pack_run(workdir)
+    except (IOError, OSError, ValueError) as error:
+        logger.error('Unable to pack docking results in {0}: {1}'.format(workdir, error))
+
+
+def run_file_exists(path):
+    """
+    :param path:    file path in a docking directory
+    :type path:     :py:str
+
+    :return:        file exists as is or packed by `pack_run`
+    :rtype:         :py:bool
+    """
+
+    return os.path.isfile(path) or os.path.isfile(path + PACKED_SUFFIX)
+
+
+def read_run_file(path):
+    """
+    Read a file from a docking directory that may be packed by `pack_run`.
+
+    Unpacked content is kept in the `run_file_cache` keyed by path and
+    modification time of the packed file to serve recently used runs from
+    memory. A plain file takes precedence over a packed one.
+
+    :param path:    file path in a docking directory
+    :type path:     :py:str
+
+    :return:        file content
+    :rtype:         :py:str
+    """
+
+    try:
+        with open(path, 'r') as plain_file:
+            return plain_file.read()
+    except IOError:
+        pass
+
+    packed_path = path + PACKED_SUFFIX
+    try:
+        key = (packed_path, os.path.getmtime(packed_path))
+    except OSError:
+        raise IOError('No such file: {0}'.format(path))
+
+    content = run_file_cache.get(key)
+    if content is None:
+        with gzip.open(packed_path, 'rb') as packed_file:
+            content = packed_file.read().decode('utf-8')
+        run_file_cache.set(key, content)
+
+    return content
+
+
+def import_plants_csv(result_dir, structures=None, files=('features.csv', 'ranking.csv')):
+    """
+    Import PLANTS results csv files
+
+    :param result_dir: PLANTS results directory
+    :type result_dir:  :py:str
+    :param structures: only import files in structure selection, import all
+                       by default
+    :type structures:  :py:list
+    :param files:      CSV files to import
+    :type files:       :py:list, py:tuple
+
+    :return:           docking results
+    :rtype:            :py:dict
+    """
+
+    results = {}
+    docking_dir_name = os.path.basename(result_dir)
+    for resultcsv in files:
+        resultcsv = os.path.join(result_dir, resultcsv)
+        if run_file_exists(resultcsv):
+
+            header = []
+            for line in read_run_file(resultcsv).splitlines():
+
+                line = line.strip().split(',')
+                if not header:
+                    header = line
+                    continue
+
+                # Only import structure selection if needed
+                mol2 = line[0]
+                path = os.path.join(result_dir, '{0}.mol2'.format(mol2))
+                if structures is not None and path not in structures:
+                    continue
+
+                row = {}
+                for i, val in enumerate(line[1:]):
+
+                    if not len(val):
+                        row[header[i]] = None
+
+                    elif '.' in val:
+                        row[header[i]] = float(val)
+
+                    else:
+                        row[header[i]] = int(val)
+
+                row['PATH'] = os.path.join(docking_dir_name, '{0}.mol2'.format(mol2))
+                results[mol2] = row
+            break
+
+    return results
+
+
+class ResultCache(object):
+    """
+    Thread-safe in-memory result store with least-recently-used (LRU) and
+    time-to-live (TTL) eviction.
+
+    Values are deep copied on storage and retrieval so callers can not
+    modify stored results, unless `copy_values` is disabled for values that
+    are treated as read-only by their users. Cache hits, misses and
+    evictions are counted and reported by `stats`.
+    """
+
+    def __init__(self, max_size=256, ttl=0, copy_values=True):
+        """
+
+        :param max_size:    maximum number of stored results. 0 disables
+                            the cache
+        :type max_size:     :py:int
+        :param ttl:         maximum time in seconds results are stored.
+                            0 will not expire results
+        :type ttl:          :py:int
+        :param copy_values: deep copy values on storage and retrieval
+        :type copy_values:  :py:bool
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.copy_values = copy_values
+
+        self._store = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+
+        return len(self._store)
+
+    def configure(self, max_size=None, ttl=None):
+        """
+        Change cache size and time-to-live, evicting results if needed
+
+        :param max_size:    maximum number of stored results
+        :type max_size:     :py:int
+        :param ttl:         maximum time in seconds results are stored
+        :type ttl:          :py:int
+        """
+
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+
+            self._evict()
+
+    def _expired(self, timestamp):
+
+        return self.ttl > 0 and time.time() - timestamp > self.ttl
+
+    def _evict(self):
+
+        for key in [key for key, (timestamp, value) in self._store.items() if self._expired(timestamp)]:
+            del self._store[key]
+            self.evictions += 1
+
+        while len(self._store) > max(self.max_size, 0):
+            self._store.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        """
+        Return stored result for key
+
+        :param key: result key
+        :type key:  :py:str
+
+        :return:    stored result or None if not stored or expired
+        """
+
+        with self._lock:
+            if key in self._store:
+                timestamp, value = self._store.pop(key)
+                if not self._expired(timestamp):
+                    self._store[key] = (timestamp, value)
+                    self.hits += 1
+                    return copy.deepcopy(value) if self.copy_values else value
+
+                self.evictions += 1
+
+            self.misses += 1
+
+    def set(self, key, value):
+        """
+        Store result for key, evicting the least recently used results
+        if the cache is full
+
+        :param key:   result key
+        :type key:    :py:str
+        :param value: result to store
+        """
+
+        if self.max_size <= 0:
+            return
+
+        if self.copy_values:
+            value = copy.deepcopy(value)
+
+        with self._lock:
+            self._store.pop(key, None)
+            self._store[key] = (time.time(), value)
+            self._evict()
+
+    def clear(self):
+        """
+        Remove all stored results and reset statistics
+        """
+
+        with self._lock:
+            self._store.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        :return: cache size, configuration and hit/miss statistics
+        :rtype:  :py:dict
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._store), 'max_size': self.max_size, 'ttl': self.ttl, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class ArtifactWriter(object):
+    """
+    Persistence of intermediate result files
+
+    Supported modes:
+
+    * off:   artifacts are not written
+    * sync:  artifacts are written directly by the caller
+    * async: write-behind, artifacts are queued and written by a background
+             writer thread so the caller does not wait for file system IO
+    """
+
+    modes = ('off', 'sync', 'async')
+
+    def __init__(self, mode='sync'):
+        """
+
+        :param mode:    persistence mode: off, sync or async
+        :type mode:     :py:str
+        """
+
+        self.mode = None
+        self.configure(mode)
+
+        self.queue = Queue()
+        self.proc = None
+        self._lock = Lock()
+
+    def configure(self, mode):
+        """
+        Change persistence mode
+
+        :param mode:    persistence mode: off, sync or async
+        :type mode:     :py:str
+        """
+
+        if mode not in self.modes:
+            raise MDStudioException('Unsupported artifact persistence mode: {0}'.format(mode))
+        self.mode = mode
+
+    def write(self, func, *args, **kwargs):
+        """
+        Persist artifacts by calling `func` according to the persistence mode
+
+        :param func:    function writing the artifacts
+        :type func:     :py:function
+        :param args:    function arguments
+        :param kwargs:  function keyword arguments
+        """
+
+        if self.mode == 'off':
+            return
+
+        if self.mode == 'sync':
+            func(*args, **kwargs)
+            return
+
+        with self._lock:
+            if self.proc is None or not self.proc.is_alive():
+                self.proc = Thread(target=self._writer)
+                self.proc.daemon = True
+                self.proc.start()
+
+        self.queue.put((func, args, kwargs))
+
+    def flush(self):
+        """
+        Block until all queued artifacts are written
+        """
+
+        self.queue.join()
+
+    def _writer(self):
+
+        while True:
+            func, args, kwargs = self.queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception as error:
+                logger.error('Failed to write artifacts: {0}'.format(error))
+            finally:
+                self.queue.task_done()
+
+
+# PDB atom records of protein conformations used by `protein_pdb_block`
+pdb_block_cache = ResultCache(max_size=16)
+
+# Binding site cropped proteins used by `crop_protein`
+cropped_protein_cache = ResultCache(max_size=32)
+
+# Unpacked files of recently used docking runs used by `read_run_file`
+run_file_cache = ResultCache(max_size=32)
+
+# Packing of completed docking runs by `pack_results`, configured from the command line by __main__
+run_packer = ArtifactWriter(mode='async')
+
+# Open docking pose archives used by `open_pose_archive`
+_pose_archives = OrderedDict()
+_pose_archive_lock = Lock()
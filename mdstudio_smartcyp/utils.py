@@ -6,21 +6,28 @@ MDStudio_SMARTCyp utility functions
 
 import os
 import sys
-import subprocess
 import logging
 import re
 import tempfile
 import shutil
 import glob
 import time
+import json
+import hashlib
+import numpy
 
+from collections import OrderedDict
 from threading import Event, Thread
 
 # Library and function compatibility
 if sys.version_info[0] < 3:
     from cStringIO import StringIO
+    from Queue import Queue, Empty
+    string_types = basestring
 else:
     from io import StringIO
+    from queue import Queue, Empty
+    string_types = str
 
 logger = logging.getLogger(__name__)
 smiles_regex = re.compile('^([^J][A-Za-z0-9@+\-\[\]\(\)\\\/%=#$]+)$')
@@ -42,6 +49,12 @@ molmass = {'Ru': 101.072, 'Re': 186.2071, 'Rf': 267.0, 'Rg': 282.0, 'Ra': 226.0,
            'Yb': 173.0451, 'Db': 268.0, 'Dy': 162.5001, 'Ds': 281.0, 'I': 126.904473, 'U': 238.028913, 'Y': 88.905842,
            'Ac': 227.0, 'Ag': 107.86822, 'Ir': 192.2173, 'Am': 243.0, 'Al': 26.98153857, 'As': 74.9215956,
            'Ar': 39.9481, 'Au': 196.9665695, 'At': 210.0, 'In': 114.8181}
+TRIPOS_ATOM_DTYPE = numpy.dtype([('atom_id', 'i4'), ('atom_name', 'U16'), ('x', 'f8'), ('y', 'f8'), ('z', 'f8'),
+                                 ('atom_type', 'U8'), ('subst_id', 'i4'), ('subst_name', 'U16'), ('charge', 'f8')])
+TRIPOS_BOND_DTYPE = numpy.dtype([('bond_id', 'i4'), ('b_start', 'i4'), ('b_end', 'i4'), ('b_type', 'U4')])
+BLOB_STORE = 'blobs'
+JOB_STORE = 'jobs'
+FINISHED_JOB_STATES = ('completed', 'failed', 'cancelled')
 
 
 class MDStudioException(Exception):
@@ -54,54 +67,6 @@ class MDStudioException(Exception):
         return self.message
 
 
-class RunnerBaseClass(object):
-
-    def delete(self):
-        """
-        Remove the temporary working directory
-        """
-
-        # Remove the temporary directory again
-        self.log.debug('Remove working directory: {0}'.format(self.workdir))
-
-        shutil.rmtree(self.workdir)
-        self.workdir = None
-
-    def cmd_runner(self, cmd):
-        """
-        Common Command Line Interface runner
-
-        :param cmd:      CLI commands
-        :type cmd:       :py:list
-        :param workdir:  working directory to run command in
-        :type workdir:   :py:str
-
-        :return:         subprocess stdout and stderr pipes
-        """
-
-        # Run cli command
-        # TODO: add timeout to prevent infinite jobs
-        was_successfull = True
-        self.log.info('Execute cli process: {0}'.format(' '.join(cmd)))
-        try:
-            process = subprocess.Popen(cmd, cwd=self.workdir,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError as err:
-            self.log.error('Process failed:', err)
-            was_successfull = False
-        else:
-            self.log.info('Process returncode: {0}'.format(process.returncode))
-            output, errors = process.communicate()
-
-            if errors:
-                self.log.error(errors.decode('utf-8'))
-            if output:
-                self.log.info(output.decode('utf-8'))
-
-        return was_successfull
-
-
 def _schema_to_data(schema, data=None, defdict=None):
 
     default_data = defdict or {}
@@ -122,10 +87,58 @@ def _schema_to_data(schema, data=None, defdict=None):
     return default_data
 
 
+def rotatable_bond_count(mol2):
+    """
+    Count the rotatable bonds in a Tripos MOL2 structure: single bonds
+    between two non-terminal heavy atoms that are not part of a ring.
+
+    :param mol2:    Tripos MOL2 file as string or as returned by
+                    `parse_tripos`
+    :type mol2:     :py:str
+
+    :return:        rotatable bond count
+    :rtype:         :py:int
+    """
+
+    mol2 = parse_tripos(mol2)
+    heavy = set(atom_id for atom_id, atom_type in zip(mol2.atoms['atom_id'].tolist(), mol2.atoms['atom_type'].tolist())
+                if atom_type.split('.')[0] != 'H')
+    bonds = [(start, end, bond_type) for start, end, bond_type in
+             zip(mol2.bonds['b_start'].tolist(), mol2.bonds['b_end'].tolist(), mol2.bonds['b_type'].tolist())
+             if start in heavy and end in heavy]
+
+    neighbours = dict((atom, set()) for atom in heavy)
+    for start, end, bond_type in bonds:
+        neighbours[start].add(end)
+        neighbours[end].add(start)
+
+    def in_ring(start, end):
+
+        # The bond is in a ring if its atoms are connected without it
+        visited = set([start])
+        stack = [atom for atom in neighbours[start] if atom != end]
+        while stack:
+            atom = stack.pop()
+            if atom == end:
+                return True
+            if atom not in visited:
+                visited.add(atom)
+                stack.extend(neighbours[atom] - visited)
+
+        return False
+
+    return sum(1 for start, end, bond_type in bonds if bond_type == '1' and len(neighbours[start]) > 1 and
+               len(neighbours[end]) > 1 and not in_ring(start, end))
+
+
 def atom_count(mol2_file):
     """
     Get atom count from Tripos MOL2 header
 
+    Only the lines up to the first ATOM section are read, the atom records
+    of large protein files are left untouched. The full file is only parsed
+    if the MOLECULE section does not define the atom count.
+
     :param mol2_file: mol2 file
     :type mol2_file:  :py:str
 
@@ -133,28 +146,29 @@ def atom_count(mol2_file):
     :rtype:           :py:int
     """
 
-    atomcount = 0
+    header = []
     with open(mol2_file, 'r') as infile:
-        for line in infile.readlines():
-
+        for line in infile:
             if line.startswith('@<TRIPOS>ATOM'):
                 break
+            header.append(line)
 
-            line = line.strip().split()
-            if len(line) and line[0].isdigit():
-                atomcount = int(line[0])
-                break
+    count = parse_tripos(''.join(header)).atom_count
+    if count:
+        return count
 
-    return atomcount
+    with open(mol2_file, 'r') as infile:
+        return parse_tripos(infile.read()).atom_count
 
 
-def hydrophobic_atom_count(mol2_dict, hphob_types=('C.1', 'C.2', 'C.3', 'C.ar', 'S.3')):
+def hydrophobic_atom_count(mol2, hphob_types=('C.1', 'C.2', 'C.3', 'C.ar', 'S.3')):
     """
     Calculate the number of hydrophobic atoms in a Tripos MOL2 file based on
     SYBYL atom types in `hphob_types`.
 
-    :param mol2_dict:   Tripos MOL2 atom records as returned by `parse_tripos_atom`
-    :type mol2_dict:    :py:dict
+    :param mol2:        parsed Tripos MOL2 as returned by `parse_tripos` or
+                        atom records as returned by `parse_tripos_atom`
+    :type mol2:         :mdstudio_smartcyp:utils:TriposMol2
     :param hphob_types: hydrophic atoms as SYBYL atom type
     :type hphob_types:  :py:tuple, :py:list
 
@@ -162,28 +176,33 @@ def hydrophobic_atom_count(mol2_dict, hphob_types=('C.1', 'C.2', 'C.3', 'C.ar',
     :rtype:             :py:int
     """
 
-    return sum([1 for atoms in mol2_dict.values() if atoms['atom_type'] in hphob_types])
+    return int(numpy.isin(tripos_atom_array(mol2)['atom_type'], hphob_types).sum())
 
 
-def molecular_weight(mol2_dict):
+def molecular_weight(mol2):
     """
     Calculate the molecular weight of a ligand based on the atom elements
     contained in the Tripos MOL2 SYBYL atom types.
 
-    :param mol2_dict:   Tripos MOL2 atom records as returned by `parse_tripos_atom`
-    :type mol2_dict:    :py:dict
+    :param mol2:        parsed Tripos MOL2 as returned by `parse_tripos` or
+                        atom records as returned by `parse_tripos_atom`
+    :type mol2:         :mdstudio_smartcyp:utils:TriposMol2
 
     :return:            molecular weight
     :rtype:             :py:float
     """
 
-    mol_weight = 0.0
-    for atom in mol2_dict.values():
-        element = atom['atom_type'].split('.')[0]
-        if element in molmass:
-            mol_weight += molmass[element]
-        else:
+    elements, inverse = numpy.unique([atom_type.split('.')[0] for atom_type in tripos_atom_array(mol2)['atom_type']],
+                                     return_inverse=True)
+
+    masses = []
+    for element in elements.tolist():
+        if element not in molmass:
             logging.warning('Unknown element: {0}'.format(element))
+        masses.append(molmass.get(element, 0.0))
+
+    # Sum in atom order for results identical to per-atom accumulation
+    mol_weight = sum(numpy.array(masses)[inverse].tolist(), 0.0)
 
     return mol_weight
 
@@ -283,6 +302,101 @@ def prepare_work_dir(path=None, prefix='', suffix='', create=True):
     return path
 
 
+def stage_input(content, path, store=None):
+    """
+    Stage input file content at path from a content-addressed blob store.
+
+    Every unique content is written once to the blob store, named by its
+    SHA1 hash, and hard linked to the target path. The link count of a blob
+    is the reference count used by `prune_blobs` to remove blobs no longer
+    staged in any working directory. The content is written to path
+    directly if the file system does not support hard links.
+
+    Staged blobs are read-only as they are shared between directories.
+
+    :param content: file content
+    :type content:  :py:str
+    :param path:    target file path
+    :type path:     :py:str
+    :param store:   blob store directory, `BLOB_STORE` next to the
+                    directory of path by default
+    :type store:    :py:str
+
+    :return:        blob path or None if content was written to path
+    :rtype:         :py:str
+    """
+
+    if store is None:
+        store = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(path))), BLOB_STORE)
+
+    content = content.encode('utf-8')
+    blob = os.path.join(store, hashlib.sha1(content).hexdigest())
+
+    # A blob may be pruned in between writing and linking, retry once
+    for attempt in range(2):
+        try:
+            if not os.path.isfile(blob):
+                if not os.path.isdir(store):
+                    os.makedirs(store)
+
+                tmp_path = '{0}.{1}.tmp'.format(blob, os.getpid())
+                with open(tmp_path, 'wb') as blob_file:
+                    blob_file.write(content)
+                os.chmod(tmp_path, 0o444)
+                os.rename(tmp_path, blob)
+
+            os.link(blob, path)
+            return blob
+        except OSError as error:
+            logger.debug('Unable to stage {0} from blob store: {1}'.format(path, error))
+
+    with open(path, 'wb') as outfile:
+        outfile.write(content)
+
+
+def blob_references(blob):
+    """
+    :param blob:    blob store file path
+    :type blob:     :py:str
+
+    :return:        number of working directories the blob is staged in
+    :rtype:         :py:int
+    """
+
+    return os.stat(blob).st_nlink - 1
+
+
+def prune_blobs(store, max_age=0):
+    """
+    Remove blobs from a blob store that are no longer staged in any working
+    directory for at least `max_age` seconds.
+
+    :param store:   blob store directory
+    :type store:    :py:str
+    :param max_age: minimum time in seconds since a blob was last
+                    (un)linked
+    :type max_age:  :py:int
+
+    :return:        removed blob paths
+    :rtype:         :py:list
+    """
+
+    removed = []
+    for blob in glob.glob(os.path.join(store, '*')):
+        if blob.endswith('.tmp'):
+            continue
+
+        try:
+            stat = os.stat(blob)
+            if stat.st_nlink == 1 and time.time() - stat.st_ctime >= max_age:
+                os.remove(blob)
+                removed.append(blob)
+        except OSError:
+            continue
+
+    return removed
+
+
 def renumber_smartcyp_atoms(mol2, smartcyp_results):
     """
     Check SMARTCyp atom numbering with respect ot mol2 input file
@@ -290,7 +404,8 @@ def renumber_smartcyp_atoms(mol2, smartcyp_results):
     SMARTCyp strips protons and renumbers atoms. This function maps
     the renumbered atoms to the original inout file numbering.
 
-    :param mol2:             Tripos MOL2 file as string
+    :param mol2:             Tripos MOL2 file as string or as returned by
+                             `parse_tripos`
     :type mol2:              :py:str
     :param smartcyp_results: SMARTCyp results
     :type smartcyp_results:  :pandas:DataFrame
@@ -299,193 +414,394 @@ def renumber_smartcyp_atoms(mol2, smartcyp_results):
     :rtype:                  :pandas:DataFrame
     """
 
-    mol2 = parse_tripos_atom(mol2)
+    atoms = numpy.sort(parse_tripos(mol2).atoms, order='atom_id')
+    atoms = atoms[atoms['atom_type'] != 'H']
 
-    renumber_idi = []
-    renumber_idx = []
-    for atom in sorted(mol2.keys()):
-
-        data = mol2[atom]
-        if data['atom_type'] != 'H':
-
-            renumber_idi.append(atom)
-            renumber_idx.append('{0}.{1}'.format(data['atom_name'], atom))
-
-    if len(renumber_idi) != len(smartcyp_results):
+    if len(atoms) != len(smartcyp_results):
         logging.error('Unable to renumber SMARTCyp results. Atom count does not match: {0} vs {1}'.format(
-            len(renumber_idi), len(smartcyp_results)))
+            len(atoms), len(smartcyp_results)))
         return smartcyp_results
 
-    smartcyp_results['Atom_id'] = renumber_idi
-    smartcyp_results.index = renumber_idx
+    smartcyp_results['Atom_id'] = atoms['atom_id'].tolist()
+    smartcyp_results.index = ['{0}.{1}'.format(name, atom_id) for name, atom_id in
+                              zip(atoms['atom_name'].tolist(), atoms['atom_id'].tolist())]
 
     return smartcyp_results
 
 
-def parse_tripos_atom(mol2):
+class TriposMol2(object):
     """
-    Parse Tripos MOL2 ATOM records to a dictionary
+    Columnar representation of a single Tripos MOL2 structure
+
+    The file is scanned once to locate the record sections. ATOM and BOND
+    records are parsed on first access to NumPy structured arrays using the
+    `TRIPOS_ATOM_DTYPE` and `TRIPOS_BOND_DTYPE` field layout and are reused
+    by all utility functions that accept a parsed structure.
+
+    :ivar sections: (start, end) line offsets of the records in each
+                    '@<TRIPOS>' section keyed by section name
+    :vartype sections: :py:collections.OrderedDict
+    """
+
+    def __init__(self, mol2):
+        """
+        :param mol2: Tripos MOL2 file as string
+        :type mol2:  :py:str
+        """
+
+        self.lines = mol2.split('\n')
+        self.sections = OrderedDict()
+
+        section = None
+        for i, line in enumerate(self.lines):
+            if line.startswith('@<TRIPOS>'):
+                if section:
+                    self.sections[section] = (self.sections[section][0], i)
+                section = line.strip()[9:]
+                if section in self.sections:
+                    section = None
+                    break
+                self.sections[section] = (i + 1, len(self.lines))
+
+        if section:
+            self.sections[section] = (self.sections[section][0], len(self.lines))
+
+        self._atoms = None
+        self._bonds = None
+
+    def __len__(self):
+
+        return len(self.atoms)
+
+    def records(self, section):
+        """
+        Non-empty records of a Tripos section split in fields
+
+        :param section: section name, e.g. 'ATOM'
+        :type section:  :py:str
+
+        :return:        records
+        :rtype:         :py:list
+        """
+
+        start, end = self.sections.get(section, (0, 0))
+        return [fields for fields in (line.split() for line in self.lines[start:end]) if fields]
+
+    @property
+    def atom_count(self):
+        """
+        Atom count from the MOLECULE section header, falls back to the number
+        of ATOM records when the header does not define it.
+
+        :rtype: :py:int
+        """
+
+        header = self.records('MOLECULE')
+        if len(header) > 1 and header[1][0].isdigit():
+            return int(header[1][0])
+
+        return len(self.atoms)
+
+    @property
+    def atoms(self):
+        """
+        ATOM records as NumPy structured array
+
+        :rtype: :numpy:ndarray
+        """
+
+        if self._atoms is None:
+            defaults = ('', 0.0, 0.0, 0.0, '', 0, '', 0.0)
+            self._atoms = numpy.array([tuple([int(fields[0])] + fields[1:9] + list(defaults[len(fields) - 1:]))
+                                       for fields in self.records('ATOM')], dtype=TRIPOS_ATOM_DTYPE)
+
+        return self._atoms
+
+    @property
+    def bonds(self):
+        """
+        BOND records as NumPy structured array
+
+        :rtype: :numpy:ndarray
+        """
+
+        if self._bonds is None:
+            self._bonds = numpy.array([(int(fields[0]), int(fields[1]), int(fields[2]), fields[3])
+                                       for fields in self.records('BOND')], dtype=TRIPOS_BOND_DTYPE)
+
+        return self._bonds
+
+    @property
+    def coordinates(self):
+        """
+        Atom coordinates as (N, 3) array
+
+        :rtype: :numpy:ndarray
+        """
+
+        atoms = self.atoms
+        return numpy.column_stack((atoms['x'], atoms['y'], atoms['z']))
+
+
+def parse_tripos(mol2):
+    """
+    Parse a Tripos MOL2 structure to its columnar `TriposMol2` representation.
+
+    Already parsed structures are returned as is so functions can accept
+    both the MOL2 string and the parsed structure and a file is only parsed
+    once per request.
 
     :param mol2:    Tripos MOL2 file as string
     :type mol2:     :py:str
 
-    :return:        Tripos atom records
-    :rtype:         :py:dict
+    :return:        parsed structure
+    :rtype:         :mdstudio_smartcyp:utils:TriposMol2
     """
 
-    read = False
-    atom_dict = {}
-    headers = ('atom_name', 'x', 'y', 'z', 'atom_type', 'subst_id', 'subst_name', 'charge')
-    for line in mol2.split('\n'):
+    if isinstance(mol2, TriposMol2):
+        return mol2
+
+    return TriposMol2(mol2)
 
-        if line.startswith('@<TRIPOS>ATOM'):
-            read = True
-            continue
 
-        if line.startswith('@<TRIPOS>BOND'):
-            read = False
-            break
+def tripos_atom_array(mol2):
+    """
+    Tripos MOL2 ATOM records as NumPy structured array
+
+    :param mol2:    Tripos MOL2 file as string, as returned by `parse_tripos`,
+                    atom records as returned by `parse_tripos_atom` or as
+                    structured array
+    :type mol2:     :py:str
+
+    :return:        atom records
+    :rtype:         :numpy:ndarray
+    """
+
+    if isinstance(mol2, numpy.ndarray):
+        return mol2
 
-        if read:
-            line = line.split()
-            if line:
-                atom_dict[int(line[0])] = dict(zip(headers, line[1:]))
+    if isinstance(mol2, dict):
+        return numpy.array([(atom_id, ) + tuple(mol2[atom_id][field] for field in TRIPOS_ATOM_DTYPE.names[1:])
+                            for atom_id in mol2], dtype=TRIPOS_ATOM_DTYPE)
 
-    for value in atom_dict.values():
-        for key in ('charge', 'x', 'y', 'z'):
-            value[key] = float(value[key])
-        value['subst_id'] = int(value['subst_id'])
+    return parse_tripos(mol2).atoms
 
-    return atom_dict
+
+def parse_tripos_atom(mol2):
+    """
+    Parse Tripos MOL2 ATOM records to a dictionary
+
+    :param mol2:    Tripos MOL2 file as string or as returned by `parse_tripos`
+    :type mol2:     :py:str
+
+    :return:        Tripos atom records
+    :rtype:         :py:dict
+    """
+
+    atoms = parse_tripos(mol2).atoms
+    headers = TRIPOS_ATOM_DTYPE.names[1:]
+
+    return dict((record[0], dict(zip(headers, record[1:]))) for record in atoms.tolist())
 
 
 def parse_tripos_bond(mol2):
     """
     Parse Tripos MOL2 BOND records to a dictionary
 
-    :param mol2:    Tripos MOL2 file as string
+    :param mol2:    Tripos MOL2 file as string or as returned by `parse_tripos`
     :type mol2:     :py:str
 
     :return:        Tripos bond records
     :rtype:         :py:dict
     """
 
-    read = False
-    bond_dict = {}
-    headers = ('b_start', 'b_end', 'b_type')
-    for line in mol2.split('\n'):
+    bonds = parse_tripos(mol2).bonds
+    headers = TRIPOS_BOND_DTYPE.names[1:]
 
-        if line.startswith('@<TRIPOS>BOND'):
-            read = True
-            continue
+    return dict((record[0], dict(zip(headers, record[1:]))) for record in bonds.tolist())
+
+
+def read_molecules(source, fmt=None, start=0):
+    """
+    Read molecules one at a time from a multi-molecule Tripos MOL2 or SDF
+    file or stream.
+
+    Only the current molecule is held in memory. Every molecule is yielded
+    with the byte offset of its first line in the source so that batch jobs
+    can be indexed and resumed from that offset using `start`.
+
+    :param source:  file path or file-like object opened in binary or text
+                    mode. Resuming from `start` requires a binary stream.
+    :type source:   :py:str
+    :param fmt:     structure format, 'mol2' or 'sdf'. Derived from the file
+                    extension for file paths, 'mol2' otherwise.
+    :type fmt:      :py:str
+    :param start:   byte offset to start reading from
+    :type start:    :py:int
+
+    :return:        byte offset, molecule name and single molecule string
+    :rtype:         :py:tuple generator
+    """
 
-        if line.startswith('@<TRIPOS>') and read:
-            read = False
-            break
+    if isinstance(source, string_types):
+        fmt = fmt or os.path.splitext(source)[-1].lstrip('.').lower()
+        with open(source, 'rb') as stream:
+            for molecule in read_molecules(stream, fmt=fmt, start=start):
+                yield molecule
+        return
+
+    fmt = fmt or 'mol2'
+    if fmt not in ('mol2', 'sdf'):
+        raise MDStudioException('Unsupported molecule file format: {0}'.format(fmt))
+
+    # Move to start offset, skip ahead for streams that can not seek
+    offset = start
+    if start:
+        if hasattr(source, 'seekable') and source.seekable():
+            source.seek(start)
+        else:
+            while start > 0:
+                chunk = source.read(min(start, 1 << 20))
+                if not chunk:
+                    break
+                start -= len(chunk)
+
+    sentinel = source.read(0)
+    binary = isinstance(sentinel, bytes)
+
+    molecule = []
+    mol_offset = offset
+    for line in iter(source.readline, sentinel):
+
+        line_offset = offset
+        if binary:
+            offset += len(line)
+            line = line.decode('utf-8')
+        else:
+            offset += len(line.encode('utf-8'))
 
-        if read:
-            line = line.split()
-            if line:
-                bond_dict[int(line[0])] = dict(zip(headers, line[1:]))
+        if fmt == 'mol2':
+            if line.startswith('@<TRIPOS>MOLECULE'):
+                if len(molecule) > 1:
+                    yield mol_offset, molecule[1].strip(), ''.join(molecule).rstrip('\n') + '\n'
+                molecule = []
+                mol_offset = line_offset
+            if molecule or line.startswith('@<TRIPOS>MOLECULE'):
+                molecule.append(line.replace('\r\n', '\n'))
 
-    for value in bond_dict.values():
-        for key in ('b_start', 'b_end'):
-            value[key] = int(value[key])
+        else:
+            if not molecule:
+                mol_offset = line_offset
+            molecule.append(line.replace('\r\n', '\n'))
+            if line.startswith('$$$$'):
+                if len(molecule) > 1:
+                    yield mol_offset, molecule[0].strip(), ''.join(molecule)
+                molecule = []
 
-    return bond_dict
+    if fmt == 'mol2' and len(molecule) > 1:
+        yield mol_offset, molecule[1].strip(), ''.join(molecule).rstrip('\n') + '\n'
+    elif fmt == 'sdf' and any(line.strip() for line in molecule):
+        yield mol_offset, molecule[0].strip(), ''.join(molecule).rstrip('\n') + '\n$$$$\n'
 
 
-def mol2_to_pdb(mol2, record='ATOM', chain='A'):
+def split_multi_mol2(mol2):
+    """
+    Split a multi-molecule Tripos MOL2 file into single molecules
 
-    pdb = []
-    for atom_id, values in mol2.items():
-        atom = [record]
-        atom.append(atom_id)
-        atom.append(values['atom_name'])
-        atom.append(values['subst_name'][0:3])
-        atom.append(chain)
-        atom.append(values['subst_id'])
-        atom.append(values['x'])
-        atom.append(values['y'])
-        atom.append(values['z'])
-        atom.append('1.00')
+    :param mol2:    Tripos MOL2 file as string
+    :type mol2:     :py:str
 
-        pdb.append(atom)
+    :return:        molecule name and single molecule MOL2 string
+    :rtype:         :py:tuple generator
+    """
 
-    return pdb
+    for offset, name, molecule in read_molecules(StringIO(mol2), fmt='mol2'):
+        yield name, molecule
 
 
-def create_multi_mol2(mol2_file_paths, protein=None):
+def mol2_hash(mol2):
     """
-    Create a multi-molecule MOL2 file by concatenating
-    single MOL2 files.
+    Content hash of a Tripos MOL2 structure based on its ATOM and BOND
+    records only. Molecule name, comments and field formatting do not
+    change the hash.
 
-    :param mol2_file_paths: single MOL2 file paths
-    :type mol2_file_paths:  :py:list
+    :param mol2:    Tripos MOL2 file as string or as returned by `parse_tripos`
+    :type mol2:     :py:str
 
-    :return:                multi-mol2 file
-    :rtype:                 :py:str
+    :return:        SHA1 hex digest
+    :rtype:         :py:str
     """
 
-    multimol2 = StringIO()
-    if protein:
+    mol2 = parse_tripos(mol2)
 
-        with open(protein, 'r') as singleprotein:
-            multimol2.write(singleprotein.read())
+    records = []
+    for section in ('ATOM', 'BOND'):
+        if section in mol2.sections:
+            records.append('@<TRIPOS>{0}'.format(section))
+            records.extend([' '.join(fields) for fields in mol2.records(section)])
 
-    for path in mol2_file_paths:
-        if os.path.exists(path):
+    return hashlib.sha1('\n'.join(records).encode('utf-8')).hexdigest()
 
-            with open(path, 'r') as singlemol2:
-                multimol2.write(singlemol2.read())
 
-    multimol2.seek(0)
-    return multimol2.read()
+def mol2_to_pdb(mol2, record='ATOM', chain='A'):
 
+    atoms = tripos_atom_array(mol2)
 
-def create_multi_pdb(mol2_file_paths, protein=None):
-    """
-    Create a multi-molecule PDB file by converting independent MOL2 files
-    to PDB format and concatenating them in a single multi MODEL PDB file
+    return [[record, atom_id, atom_name, subst_name[0:3], chain, subst_id, x, y, z, '1.00'] for
+            atom_id, atom_name, x, y, z, atom_type, subst_id, subst_name, charge in atoms.tolist()]
 
-    :param mol2_file_paths: single MOL2 file paths
-    :type mol2_file_paths:  :py:list
 
-    :return:                multi MODEL PDB file
-    :rtype:                 :py:str
+def pdb_template(mol2, record='ATOM', chain='A'):
     """
+    Fixed-width PDB atom records template for a Tripos MOL2 structure
+
+    All fields except the atom coordinates are formatted. The coordinates
+    of any structure sharing the same atoms are formatted in one go by
+    substituting them in the template, as flat sequence of x, y, z values:
 
-    prot_pdb = None
-    if protein:
+        pdb_template(atoms) % tuple(xyz.ravel().tolist())
 
-        with open(protein, 'r') as singleprotein:
-            prot_mol2 = parse_tripos_atom(singleprotein.read())
-            prot_pdb = mol2_to_pdb(prot_mol2)
+    :param mol2:    Tripos MOL2 as returned by `parse_tripos` or atom records
+                    as returned by `parse_tripos_atom`
+    :type mol2:     :mdstudio_smartcyp:utils:TriposMol2
+    :param record:  PDB record type, ATOM or HETATM
+    :type record:   :py:str
+    :param chain:   PDB chain identifier
+    :type chain:    :py:str
 
-    multi_pdb = StringIO()
-    is_multi_pdb = len(mol2_file_paths) > 1
-    for model, path in enumerate(mol2_file_paths, start=1):
+    :return:        PDB atom records template
+    :rtype:         :py:str
+    """
 
-        if is_multi_pdb:
-            multi_pdb.write('MODEL {0}\n'.format(model))
-        if prot_pdb:
-            for line in prot_pdb:
-                multi_pdb.write('{0:6}{1:>5} {2:^5}{3:>3} {4}{5:>4}    {6:8.3f}{7:8.3f}{8:8.3f}  {9:6}\n'.format(*line))
-            multi_pdb.write('TER\n')
+    atoms = tripos_atom_array(mol2)
 
-        with open(path, 'r') as singlemol2:
-            lig_mol2 = parse_tripos_atom(singlemol2.read())
-            lig_pdb = mol2_to_pdb(lig_mol2, record='HETATM', chain='B')
+    return ''.join(['{0:6}{1:>5} {2:^5}{3:>3} {4}{5:>4}    '.format(record, atom_id, atom_name, subst_name[0:3], chain,
+                                                                   subst_id).replace('%', '%%') +
+                    '%8.3f%8.3f%8.3f  1.00  \n' for atom_id, atom_name, subst_id, subst_name in
+                    zip(atoms['atom_id'].tolist(), atoms['atom_name'].tolist(), atoms['subst_id'].tolist(),
+                        atoms['subst_name'].tolist())])
 
-            for line in lig_pdb:
-                multi_pdb.write('{0:6}{1:>5} {2:^5}{3:>3} {4}{5:>4}    {6:8.3f}{7:8.3f}{8:8.3f}  {9:6}\n'.format(*line))
 
-        if is_multi_pdb:
-            multi_pdb.write('ENDMDL\n')
-    multi_pdb.write('END\n')
+def mol2_to_pdb_string(mol2, record='ATOM', chain='A'):
+    """
+    Convert Tripos MOL2 atom records to PDB atom records
+
+    :param mol2:    Tripos MOL2 as returned by `parse_tripos` or atom records
+                    as returned by `parse_tripos_atom`
+    :type mol2:     :mdstudio_smartcyp:utils:TriposMol2
+    :param record:  PDB record type, ATOM or HETATM
+    :type record:   :py:str
+    :param chain:   PDB chain identifier
+    :type chain:    :py:str
+
+    :return:        PDB atom records
+    :rtype:         :py:str
+    """
 
-    multi_pdb.seek(0)
-    return multi_pdb.read()
+    atoms = tripos_atom_array(mol2)
+    xyz = numpy.column_stack((atoms['x'], atoms['y'], atoms['z']))
+
+    return pdb_template(atoms, record=record, chain=chain) % tuple(xyz.ravel().tolist())
 
 
 def merge_protein_ligand_mol2(protein, ligand, name='system'):
@@ -493,10 +809,12 @@ def merge_protein_ligand_mol2(protein, ligand, name='system'):
     Merge a protein and ligand structure in Tripos MOL2 format together
     as one structure system.
 
-    :param protein:    Tripos MOL2 file of the protein as string
-    :type protein:     :py:str
-    :param protein:    Tripos MOL2 file of the ligand as string
+    :param protein:    Tripos MOL2 file of the protein as string or as
+                       returned by `parse_tripos`
     :type protein:     :py:str
+    :param ligand:     Tripos MOL2 file of the ligand as string or as
+                       returned by `parse_tripos`
+    :type ligand:      :py:str
     :param name:       new system name
     :type name:        :py:str
 
@@ -504,15 +822,19 @@ def merge_protein_ligand_mol2(protein, ligand, name='system'):
     :rtype:            :py:str
     """
 
-    prot_atom = parse_tripos_atom(protein)
-    prot_bond = parse_tripos_bond(protein)
-    lig_atom = parse_tripos_atom(ligand)
-    lig_bond = parse_tripos_bond(ligand)
+    protein = parse_tripos(protein)
+    ligand = parse_tripos(ligand)
+
+    # Ligand atoms and bonds are renumbered following the protein records
+    prot_atom = numpy.sort(protein.atoms, order='atom_id')
+    lig_atom = numpy.sort(ligand.atoms, order='atom_id')
+    prot_bond = numpy.sort(protein.bonds, order='bond_id')
+    lig_bond = numpy.sort(ligand.bonds, order='bond_id')
 
-    # Stats
     total_atoms = len(prot_atom) + len(lig_atom)
     total_bonds = len(prot_bond) + len(lig_bond)
-    id_trans_dict = {}
+    id_trans = numpy.zeros(lig_atom['atom_id'].max() + 1 if len(lig_atom) else 1, dtype='i4')
+    id_trans[lig_atom['atom_id']] = numpy.arange(len(prot_atom) + 1, total_atoms + 1)
 
     merged_mol = StringIO()
     merged_mol.write('@<TRIPOS>MOLECULE\n{0}\n'.format(name))
@@ -520,85 +842,54 @@ def merge_protein_ligand_mol2(protein, ligand, name='system'):
     merged_mol.write('SMALL\nGASTEIGER\n\n')
 
     merged_mol.write('@<TRIPOS>ATOM\n')
-    for i, a in enumerate(sorted(prot_atom.keys()), start=1):
-        merged_mol.write('{0:>7}  {1:8}{2:9.4f} {3:9.4f} {4:9.4f} {5:<5}{6:>4}  {7:8} {8:9.4f}\n'.format(i,
-            prot_atom[a]['atom_name'], prot_atom[a]['x'], prot_atom[a]['y'], prot_atom[a]['z'],
-            prot_atom[a]['atom_type'], prot_atom[a]['subst_id'], prot_atom[a]['subst_name'], prot_atom[a]['charge']))
-
-    for i, a in enumerate(sorted(lig_atom.keys()), start=i+1):
-        id_trans_dict[a] = i
-        merged_mol.write('{0:>7}  {1:8}{2:9.4f} {3:9.4f} {4:9.4f} {5:<5}{6:>4}  {7:8} {8:9.4f}\n'.format(i,
-            lig_atom[a]['atom_name'], lig_atom[a]['x'], lig_atom[a]['y'], lig_atom[a]['z'], lig_atom[a]['atom_type'],
-            lig_atom[a]['subst_id'], lig_atom[a]['subst_name'], lig_atom[a]['charge']))
+    for i, atom in enumerate(numpy.concatenate((prot_atom, lig_atom)).tolist(), start=1):
+        merged_mol.write('{0:>7}  {1:8}{2:9.4f} {3:9.4f} {4:9.4f} {5:<5}{6:>4}  {7:8} {8:9.4f}\n'.format(i, *atom[1:]))
 
     merged_mol.write('@<TRIPOS>BOND\n')
-    for i, a in enumerate(sorted(prot_bond.keys()), start=1):
-        merged_mol.write('{0:>6}{1:>6}{2:>6} {3:>4}\n'.format(i, prot_bond[a]['b_start'], prot_bond[a]['b_end'],
-                                                              prot_bond[a]['b_type']))
+    for i, bond in enumerate(prot_bond.tolist(), start=1):
+        merged_mol.write('{0:>6}{1:>6}{2:>6} {3:>4}\n'.format(i, *bond[1:]))
 
-    for i, a in enumerate(sorted(lig_bond.keys()), start=i+1):
-        merged_mol.write('{0:>6}{1:>6}{2:>6} {3:>4}\n'.format(i, id_trans_dict[lig_bond[a]['b_start']],
-                                                              id_trans_dict[lig_bond[a]['b_end']],
-                                                              lig_bond[a]['b_type']))
+    lig_bond_records = zip(id_trans[lig_bond['b_start']].tolist(), id_trans[lig_bond['b_end']].tolist(),
+                           lig_bond['b_type'].tolist())
+    for i, bond in enumerate(lig_bond_records, start=len(prot_bond) + 1):
+        merged_mol.write('{0:>6}{1:>6}{2:>6} {3:>4}\n'.format(i, *bond))
 
     merged_mol.seek(0)
     return merged_mol.read()
 
 
-def import_plants_csv(result_dir, structures=None, files=('features.csv', 'ranking.csv')):
+def prune_jobs(store, max_age=0):
     """
-    Import PLANTS results csv files
+    Remove asynchronous jobs finished more than `max_age` seconds ago from
+    a job store together with their result.
 
-    :param result_dir: PLANTS results directory
-    :type result_dir:  :py:str
-    :param structures: only import files in structure selection, import all
-                       by default
-    :type structures:  :py:list
-    :param files:      CSV files to import
-    :type files:       :py:list, py:tuple
+    :param store:   job store directory
+    :type store:    :py:str
+    :param max_age: minimum time in seconds since the job finished
+    :type max_age:  :py:int
 
-    :return:           docking results
-    :rtype:            :py:dict
+    :return:        removed job files
+    :rtype:         :py:list
     """
 
-    results = {}
-    docking_dir_name = os.path.basename(result_dir)
-    for resultcsv in files:
-        resultcsv = os.path.join(result_dir, resultcsv)
-        if os.path.isfile(resultcsv):
-
-            header = []
-            with open(resultcsv, 'r') as csv_file:
-                for line in csv_file.readlines():
-
-                    line = line.strip().split(',')
-                    if not header:
-                        header = line
-                        continue
-
-                    # Only import structure selection if needed
-                    mol2 = line[0]
-                    path = os.path.join(result_dir, '{0}.mol2'.format(mol2))
-                    if structures is not None and path not in structures:
-                        continue
-
-                    row = {}
-                    for i, val in enumerate(line[1:]):
-
-                        if not len(val):
-                            row[header[i]] = None
-
-                        elif '.' in val:
-                            row[header[i]] = float(val)
+    removed = []
+    for path in glob.glob(os.path.join(store, '*.json')):
+        if path.endswith('.result.json'):
+            continue
 
-                        else:
-                            row[header[i]] = int(val)
+        try:
+            with open(path) as job_file:
+                job = json.load(job_file)
+        except (IOError, OSError, ValueError):
+            continue
 
-                    row['PATH'] = os.path.join(docking_dir_name, '{0}.mol2'.format(mol2))
-                    results[mol2] = row
-            break
+        if job.get('status') in FINISHED_JOB_STATES and time.time() - (job.get('finished') or 0) >= max_age:
+            for job_path in (path, '{0}.result.json'.format(path[:-len('.json')])):
+                if os.path.exists(job_path):
+                    os.remove(job_path)
+                    removed.append(job_path)
 
-    return results
+    return removed
 
 
 class PeriodicCleanup(object):
@@ -606,6 +897,8 @@ class PeriodicCleanup(object):
     Asynchronous periodic cleanup class checking a base working directory for
     result directories starting with 'docking-' that are more then
     `result_storage_time` hours old every `period` seconds and removing them.
+    Input blobs no longer referenced by any results directory for the same
+    time are removed from the blob store, as are finished asynchronous jobs.
     """
 
     def __init__(self, base_work_dir, result_storage_time, period=60):
@@ -660,3 +953,11 @@ class PeriodicCleanup(object):
 
                         logging.info('Periodic cleanup, remove: {0}'.format(dockdir))
                         shutil.rmtree(dockdir)
+
+            # Remove input blobs no longer staged in any results directory
+            for blob in prune_blobs(os.path.join(self.base_work_dir, BLOB_STORE), max_age=self.result_storage_time):
+                logging.info('Periodic cleanup, remove: {0}'.format(blob))
+
+            # Remove finished asynchronous jobs and their results
+            for job in prune_jobs(os.path.join(self.base_work_dir, JOB_STORE), max_age=self.result_storage_time):
+                logging.info('Periodic cleanup, remove: {0}'.format(job))
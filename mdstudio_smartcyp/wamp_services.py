@@ -7,16 +7,27 @@ WAMP service methods the module exposes.
 """
 
 import os
+import itertools
+import tempfile
 
+from functools import wraps
+from io import BytesIO
 from autobahn.wamp import RegisterOptions
+from autobahn.wamp.exception import ApplicationError
+from twisted.internet import reactor, threads, defer
+from twisted.python.threadpool import ThreadPool
 from mdstudio.api.endpoint import endpoint
 from mdstudio.component.session import ComponentSession
 
-from mdstudio_smartcyp.combined_prediction import CombinedPrediction
+from mdstudio_smartcyp.combined_prediction import (CombinedPrediction, multi_isoform_prediction, batch_som_prediction,
+                                                   som_cache_info)
 from mdstudio_smartcyp.smartcyp_run import SmartCypRunner, smartcyp_version_info
 from mdstudio_smartcyp.plants_run import PlantsDocking, plants_version_info
 from mdstudio_smartcyp.spores_run import spores_version_info, SporesRunner
-from mdstudio_smartcyp.utils import mol_validate_file_object, MDStudioException
+from mdstudio_smartcyp.jobs import job_manager
+from mdstudio_smartcyp.utils import mol_validate_file_object, read_molecules, FINISHED_JOB_STATES, MDStudioException
+from mdstudio_smartcyp.scheduling import (scheduler_info, admission_info, admission_controller, available_cpus,
+                                          Workload, Overloaded)
 
 
 def encoder(file_path):
@@ -35,6 +46,91 @@ def encode_file(d):
     return d
 
 
+# Maximum number of worker threads per workload class
+lane_threads = {'interactive': 8, 'bulk': max(2, available_cpus())}
+_lanes = {}
+
+
+def lane_pool(name):
+    """
+    Thread pool of a workload class, started on first use and stopped at
+    reactor shutdown.
+
+    :param name:    workload class name
+    :type name:     :py:str
+
+    :return:        thread pool
+    :rtype:         :twisted:python:threadpool:ThreadPool
+    """
+
+    if name not in _lanes:
+        pool = ThreadPool(minthreads=0, maxthreads=lane_threads[name], name='{0}-lane'.format(name))
+        pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+        _lanes[name] = pool
+
+    return _lanes[name]
+
+
+def workload_lane(name):
+    """
+    Run a WAMP endpoint method in the dedicated thread pool of a `Workload`
+    class instead of the reactor thread. Interactive requests are not queued
+    behind long running bulk requests and external processes started by
+    interactive requests are scheduled first.
+
+    :param name:    workload class name, 'interactive' or 'bulk'
+    :type name:     :py:str
+    """
+
+    def decorator(func):
+
+        @wraps(func)
+        def wrapper(self, request, claims):
+            return threads.deferToThreadPool(reactor, lane_pool(name), Workload(name)(func), self, request, claims)
+
+        return wrapper
+
+    return decorator
+
+
+def admitted(endpoint, cost=None):
+    """
+    Admit WAMP endpoint requests through the `admission_controller` until
+    the endpoint method, or the Deferred it returns, completes. Over
+    capacity, requests fail immediately with an ApplicationError
+    'mdstudio_smartcyp.error.overloaded' carrying the suggested
+    `retry_after` time in seconds.
+
+    :param endpoint:    endpoint name
+    :type endpoint:     :py:str
+    :param cost:        function estimating the work of a request, 1 by
+                        default
+    :type cost:         :py:function
+    """
+
+    def decorator(func):
+
+        @wraps(func)
+        def wrapper(self, request, claims):
+            work = cost(request) if cost else 1
+            try:
+                start = admission_controller.acquire(endpoint, cost=work)
+            except Overloaded as error:
+                raise ApplicationError('mdstudio_smartcyp.error.overloaded', error.message,
+                                       retry_after=error.retry_after)
+
+            def release(result):
+                admission_controller.release(endpoint, cost=work, start=start)
+                return result
+
+            return defer.maybeDeferred(func, self, request, claims).addBoth(release)
+
+        return wrapper
+
+    return decorator
+
+
 class SmartCypWampApi(ComponentSession):
     """
     WAMP SMARTCyp endpoint methods
@@ -59,6 +155,8 @@ class SmartCypWampApi(ComponentSession):
         return {'status': 'failed'}
 
     @endpoint('smartcyp', 'smartcyp_request', 'smartcyp_response', options=RegisterOptions(invoke=u'roundrobin'))
+    @admitted('smartcyp')
+    @workload_lane('interactive')
     def smartcyp_prediction(self, request, claims):
         """
         Run a SMARTCyp prediction for a molecule
@@ -100,11 +198,16 @@ class SmartCypWampApi(ComponentSession):
         return {'status': 'failed'}
 
     @endpoint('docking', 'docking_request', 'docking_response', options=RegisterOptions(invoke='roundrobin'))
+    @admitted('docking')
+    @workload_lane('bulk')
     def plants_docking(self, request, claims):
         """
         Perform a PLANTS (Protein-Ligand ANT System) molecular docking.
         For a detail description of the input see the file:
         schemas/endpoints/docking-request.v1.json
+
+        If a 'progress_topic' is defined, docking poses and improvements of
+        the best score are published to it while PLANTS is running.
         """
 
         # Validate input path_file object for protein and ligand file
@@ -113,14 +216,18 @@ class SmartCypWampApi(ComponentSession):
 
         # Run docking
         base_dir = os.environ.get('BASE_WORK_DIR', request.get('base_work_dir'))
+        progress_topic = request.get('progress_topic')
 
-        for drop_key in ('protein_file', 'ligand_file', 'base_work_dir'):
+        for drop_key in ('protein_file', 'ligand_file', 'base_work_dir', 'progress_topic'):
             if drop_key in request:
                 del request[drop_key]
 
         docking = PlantsDocking(log=self.log, base_work_dir=base_dir, **request)
 
-        if docking.run(protein_file['content'], ligand_file['content']):
+        def progress(event):
+            reactor.callFromThread(self.publish, progress_topic, event)
+
+        if docking.run(protein_file['content'], ligand_file['content'], progress=progress if progress_topic else None):
             return {'status': 'completed', 'result': docking.get_results()}
 
         self.log.error('PLANTS docking failed')
@@ -128,6 +235,8 @@ class SmartCypWampApi(ComponentSession):
 
     @endpoint('docking_statistics', 'docking_statistics_request', 'docking_statistics_response',
               options=RegisterOptions(invoke='roundrobin'))
+    @admitted('docking_statistics')
+    @workload_lane('interactive')
     def plants_docking_statistics(self, request, claims):
         """
         Return PLANTS docking statistics for particular docking solutions run previously.
@@ -154,19 +263,36 @@ class SmartCypWampApi(ComponentSession):
 
     @endpoint('docking_structures', 'docking_structures_request', 'docking_structures_response',
               options=RegisterOptions(invoke='roundrobin'))
+    @admitted('docking_structures')
+    @workload_lane('interactive')
     def plants_docking_structures(self, request, claims):
         """
         Return PLANTS docked structures
+
+        If an 'archive' format is requested, the structure files are streamed
+        to a tar or zip archive in the docking directory and the archive path
+        is returned instead of the structures content.
         """
 
         base_dir = os.environ.get('BASE_WORK_DIR', request.get('base_work_dir'))
         docking = PlantsDocking(log=self.log, base_work_dir=base_dir)
 
+        archive = request.get('archive')
         try:
             results = docking.get_structures(structures=request.get('paths'),
                                              output_format=request.get('output_format', 'mol2'),
                                              include_protein=request.get('include_protein', False),
-                                             create_ensemble=request.get('create_ensemble', True))
+                                             create_ensemble=request.get('create_ensemble', True),
+                                             archive=archive)
+
+            if archive:
+                archive_file, archive_path = tempfile.mkstemp(prefix='structures-', suffix='.{0}'.format(archive),
+                                                              dir=docking.workdir)
+                with os.fdopen(archive_file, 'wb') as archive_file:
+                    for chunk in results:
+                        archive_file.write(chunk)
+
+                return {'status': 'completed', 'result': [encoder(archive_path)]}
         except MDStudioException as error:
             self.log.error(repr(error))
             return {'status': 'failed'}
@@ -195,6 +321,8 @@ class SmartCypWampApi(ComponentSession):
         return {'status': 'failed'}
 
     @endpoint('spores', 'spores_request', 'spores_response', options=RegisterOptions(invoke='roundrobin'))
+    @admitted('spores')
+    @workload_lane('interactive')
     def spores_run(self, request, claims):
         """
         Perform a SPORES (Structure PrOtonation and REcognition System) structure preparation.
@@ -216,8 +344,116 @@ class SmartCypWampApi(ComponentSession):
 
         return {'status': 'completed', 'result': result_dict}
 
+    @endpoint('som_cache_info', 'som_cache_info_request', 'som_cache_info_response',
+              options=RegisterOptions(invoke=u'roundrobin'))
+    def som_cache_info(self, request, claims):
+        """
+        Returns size, configuration and hit rate of the SOM prediction
+        result cache.
+        """
+
+        return {'status': 'completed', 'info': som_cache_info()}
+
+    @endpoint('scheduler_info', 'scheduler_info_request', 'scheduler_info_response',
+              options=RegisterOptions(invoke=u'roundrobin'))
+    def scheduler_info(self, request, claims):
+        """
+        Returns slots, queue depth and wait times of the job scheduler of
+        the PLANTS, SMARTCyp and SPORES processes of this service.
+        """
+
+        return {'status': 'completed', 'info': scheduler_info()}
+
+    @endpoint('admission_info', 'admission_info_request', 'admission_info_response',
+              options=RegisterOptions(invoke=u'roundrobin'))
+    def admission_info(self, request, claims):
+        """
+        Returns the admission control state of the endpoints of this
+        service: accepted and maximum work, admitted and rejected requests
+        and mean time per unit of work.
+        """
+
+        return {'status': 'completed', 'info': admission_info()}
+
+    def submit_job(self, endpoint, request):
+        """
+        Submit an asynchronous job, rejected over capacity by an
+        ApplicationError 'mdstudio_smartcyp.error.overloaded' as in
+        `admitted`
+        """
+
+        try:
+            job = job_manager.submit(endpoint, request)
+        except Overloaded as error:
+            raise ApplicationError('mdstudio_smartcyp.error.overloaded', error.message,
+                                   retry_after=error.retry_after)
+
+        return {'status': 'completed', 'job': job}
+
+    @endpoint('docking_submit', 'docking_request', 'job_response', options=RegisterOptions(invoke='roundrobin'))
+    def docking_submit(self, request, claims):
+        """
+        Submit a PLANTS docking as asynchronous job. Returns the job with
+        the job ID to query with 'job_status', 'job_result' and 'job_cancel'
+        """
+
+        return self.submit_job('docking', request)
+
+    @endpoint('som_prediction_submit', 'som_prediction_request', 'job_response',
+              options=RegisterOptions(invoke='roundrobin'))
+    def som_prediction_submit(self, request, claims):
+        """
+        Submit a SOM prediction as asynchronous job. Returns the job with
+        the job ID to query with 'job_status', 'job_result' and 'job_cancel'
+        """
+
+        return self.submit_job('som_prediction', request)
+
+    @endpoint('job_status', 'job_request', 'job_response', options=RegisterOptions(invoke=u'roundrobin'))
+    def job_status(self, request, claims):
+        """
+        Returns the status of an asynchronous job
+        """
+
+        job = job_manager.status(request['job_id'])
+        if job is None:
+            return {'status': 'failed'}
+
+        return {'status': 'completed', 'job': job}
+
+    @endpoint('job_result', 'job_request', 'job_response', options=RegisterOptions(invoke=u'roundrobin'))
+    def job_result(self, request, claims):
+        """
+        Returns the status of an asynchronous job and the result once the
+        job completed. The request status is 'pending' for queued or running
+        jobs and 'failed' for unknown, failed or cancelled jobs.
+        """
+
+        job = job_manager.status(request['job_id'])
+        if job is None:
+            return {'status': 'failed'}
+
+        if job['status'] != 'completed':
+            return {'status': 'failed' if job['status'] in FINISHED_JOB_STATES else 'pending', 'job': job}
+
+        return {'status': 'completed', 'job': job, 'result': job_manager.result(request['job_id'])}
+
+    @endpoint('job_cancel', 'job_request', 'job_response', options=RegisterOptions(invoke=u'roundrobin'))
+    def job_cancel(self, request, claims):
+        """
+        Cancel an asynchronous job, killing its running processes
+        """
+
+        job = job_manager.cancel(request['job_id'])
+        if job is None:
+            return {'status': 'failed'}
+
+        return {'status': 'completed', 'job': job}
+
     @endpoint('som_prediction', 'som_prediction_request', 'som_prediction_response',
               options=RegisterOptions(invoke='roundrobin'))
+    @admitted('som_prediction', cost=lambda request: len(request['cyp']) if isinstance(request['cyp'], list) else 1)
+    @workload_lane('bulk')
     def som_prediction(self, request, claims):
         """
         Run a REST based SOM prediction run
@@ -228,11 +464,95 @@ class SmartCypWampApi(ComponentSession):
 
         # Run combined structure/reactivity prediction
         base_dir = os.environ.get('BASE_WORK_DIR', request.get('base_work_dir'))
-        sompred = CombinedPrediction(base_work_dir=base_dir, **request)
-        prediction = sompred.run(ligand_file, filter_clusters=request['filter_clusters'])
+        config = dict([(key, value) for key, value in request.items() if key not in
+                       ('ligand_file', 'base_work_dir', 'cyp', 'filter_clusters', 'pose_hits')])
+
+        if isinstance(request['cyp'], list):
+            prediction = multi_isoform_prediction(ligand_file['content'], request['cyp'], log=self.log,
+                                                  base_work_dir=base_dir, filter_clusters=request['filter_clusters'],
+                                                  pose_hits=request.get('pose_hits', False), **config)
+        else:
+            sompred = CombinedPrediction(log=self.log, base_work_dir=base_dir, cyp=request['cyp'], **config)
+            prediction = sompred.run(ligand_file['content'], filter_clusters=request['filter_clusters'],
+                                     pose_hits=request.get('pose_hits', False))
 
         if prediction:
             return {'status': 'completed', 'output': prediction}
 
         self.log.error('SOM prediction failed')
         return {'status': 'failed'}
+
+    @endpoint('som_reanalysis', 'som_reanalysis_request', 'som_reanalysis_response',
+              options=RegisterOptions(invoke='roundrobin'))
+    @admitted('som_reanalysis')
+    @workload_lane('interactive')
+    def som_reanalysis(self, request, claims):
+        """
+        Recompute a SOM prediction from the results stored by a previous
+        'som_prediction' run. Docking is not repeated.
+        """
+
+        base_dir = os.environ.get('BASE_WORK_DIR', request.get('base_work_dir'))
+        config = dict([(key, value) for key, value in request.items() if key in
+                       ('min_cluster_size', 'threshold', 'criterion')])
+
+        sompred = CombinedPrediction(log=self.log, base_work_dir=base_dir, **config)
+        try:
+            prediction = sompred.reanalyse(request['paths'], filter_clusters=request.get('filter_clusters', True),
+                                           pose_hits=request.get('pose_hits', False), poses=request.get('poses'),
+                                           smartcyp_score_label=request.get('smartcyp_score_label'))
+        except MDStudioException as error:
+            self.log.error(repr(error))
+            return {'status': 'failed'}
+
+        if prediction:
+            return {'status': 'completed', 'output': prediction}
+
+        self.log.error('SOM reanalysis failed')
+        return {'status': 'failed'}
+
+    @endpoint('som_prediction_batch', 'som_prediction_batch_request', 'som_prediction_batch_response',
+              options=RegisterOptions(invoke='roundrobin'))
+    @admitted('som_prediction_batch', cost=lambda request: request['max_workers'])
+    @workload_lane('bulk')
+    def som_prediction_batch(self, request, claims):
+        """
+        Run a SOM prediction for a library of ligands in multi MOL2 format.
+
+        Ligands are predicted concurrently by at most 'max_workers'. The
+        response is only returned once the whole library is predicted. If a
+        'progress_topic' is defined, the result for every ligand is published
+        to it as soon as it completes and the response lists the index,
+        offset, name and status per ligand without the SOM prediction
+        'output', so large libraries are not held in memory. Libraries
+        referred to by 'path' are read from disk one ligand at a time
+        starting from 'start_offset'.
+        """
+
+        # Stream ligand library from file or from path_file content
+        ligand_file = request['ligand_file']
+        if ligand_file.get('content') is None and ligand_file.get('path') and os.path.exists(ligand_file['path']):
+            ligands = read_molecules(ligand_file['path'], fmt='mol2', start=request['start_offset'])
+        else:
+            ligands = read_molecules(BytesIO((ligand_file.get('content') or '').encode('utf-8')), fmt='mol2',
+                                     start=request['start_offset'])
+
+        first = next(ligands, None)
+        if first is None:
+            self.log.error('No ligand structures in batch SOM prediction request')
+            return {'status': 'failed'}
+
+        base_dir = os.environ.get('BASE_WORK_DIR', request.get('base_work_dir'))
+        config = dict([(key, value) for key, value in request.items() if key not in
+                       ('ligand_file', 'base_work_dir', 'max_workers', 'start_offset', 'progress_topic')])
+        progress_topic = request.get('progress_topic')
+
+        results = []
+        for result in batch_som_prediction(itertools.chain([first], ligands), log=self.log, base_work_dir=base_dir,
+                                           max_workers=request['max_workers'], **config):
+            if progress_topic:
+                reactor.callFromThread(self.publish, progress_topic, result)
+                result = dict([(key, value) for key, value in result.items() if key != 'output'])
+            results.append(result)
+
+        return {'status': 'completed', 'result': sorted(results, key=lambda result: result['index'])}
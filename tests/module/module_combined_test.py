@@ -7,13 +7,19 @@ Unit tests for combined SMARTCyp and PLANTS Cyp SOM prediction
 """
 
 import os
+import json
 import glob
 import shutil
 import unittest
 import platform
+import pandas
+import numpy
 
 from mdstudio_smartcyp import __package_path__
-from mdstudio_smartcyp.combined_prediction import CombinedPrediction
+from mdstudio_smartcyp.combined_prediction import (CombinedPrediction, multi_isoform_prediction, batch_som_prediction,
+                                                   read_hemecoor, som_result_cache, protein_topology,
+                                                   protein_topologies, build_topology)
+from mdstudio_smartcyp.utils import parse_tripos, parse_tripos_atom, prepare_work_dir, BLOB_STORE, MDStudioException
 from mdstudio_smartcyp.plants_run import PlantsDocking
 from tests.module.unittest_baseclass import UnittestPythonCompatibility
 
@@ -41,13 +47,287 @@ class CombinedPredictionTest(UnittestPythonCompatibility):
     @classmethod
     def tearDownClass(cls):
         """
-        Remove all created docking result dirs
+        Remove all created docking result dirs and input blob store
         """
 
-        for dockdir in glob.glob(os.path.join(FILEPATH, 'docking-*/')):
+        for dockdir in glob.glob(os.path.join(FILEPATH, 'docking-*/')) + [os.path.join(FILEPATH, BLOB_STORE)]:
             if os.path.isdir(dockdir):
                 shutil.rmtree(dockdir)
 
+    def test_select_poses(self):
+        """
+        Only poses assigned to a cluster are selected when filtering clusters
+        """
+
+        som = CombinedPrediction(base_work_dir=FILEPATH)
+        results = pandas.DataFrame({'CLUSTER': [1, 0, 2, 0], 'POSE': [1, 2, 3, 4],
+                                    'PATH': ['docking-x/_entry_00001_conf_{0}.mol2'.format(i) for i in range(1, 5)]})
+
+        self.assertListEqual(list(som.select_poses(results, filter_clusters=True)['POSE']), [1, 3])
+        self.assertListEqual(list(som.select_poses(results, filter_clusters=False)['POSE']), [1, 2, 3, 4])
+
+    def test_cyp_conformations(self):
+        """
+        Ensemble docking uses all unique conformations of the isoform
+        """
+
+        self.assertEqual(len(CombinedPrediction(cyp='3A4').cyp_conformations()), 3)
+        self.assertEqual(len(CombinedPrediction(cyp='1A2', explicit_oxygen=True).cyp_conformations()), 1)
+
+    def test_topology(self):
+        """
+        Protein topology is build once per conformation, ligand topology
+        and pose coordinates match
+        """
+
+        protein = CombinedPrediction(cyp='1A2').cyp_conformations()[0]
+        topology, xyz = protein_topology(protein)
+
+        self.assertEqual(len(topology), len(parse_tripos_atom(protein)))
+        hits = protein_topologies.hits
+        self.assertIs(protein_topology(protein)[0], topology)
+        self.assertEqual(protein_topologies.hits, hits + 1)
+        self.assertFalse(xyz.flags.writeable)
+        self.assertTrue('attype' in topology.columns)
+
+        topology, xyz = build_topology(self.ligand, record='HETATM', chain='B')
+        self.assertEqual(len(topology), len(parse_tripos_atom(self.ligand)))
+        self.assertEqual(xyz.shape, (len(topology), 3))
+        self.assertAlmostEqual(xyz[0][0], parse_tripos_atom(self.ligand)[1]['x'] / 10, places=4)
+
+    def test_eval_heme_coordination(self):
+        """
+        Heme coordinating ligand atoms of docking poses do not depend on
+        the number of poses evaluated together
+        """
+
+        som = CombinedPrediction(base_work_dir=FILEPATH, cyp='1A2')
+        protein = som.cyp_conformations()[0]
+        protein_atoms = parse_tripos_atom(protein)
+        ligand_atoms = parse_tripos_atom(self.ligand)
+
+        # Poses with a ligand atom placed on the distal side of the heme iron
+        heme = dict((atom['atom_name'], numpy.array([atom['x'], atom['y'], atom['z']]))
+                    for atom in protein_atoms.values() if atom['subst_name'].startswith('HEM'))
+        normal = numpy.cross(heme['NC'] - heme['NA'], heme['ND'] - heme['NB'])
+        normal *= numpy.sign(numpy.dot([-0.989, 3.261, 0.826] - heme['FE'], normal)) / numpy.linalg.norm(normal)
+
+        workdir = prepare_work_dir(path=FILEPATH, prefix='docking-')
+        docking = PlantsDocking(base_work_dir=FILEPATH)
+        paths = []
+        for pose, (serial, distance) in enumerate(((2, 3.5), (13, 3.2), (2, 12.0), (7, 3.0), (11, 3.4)), start=1):
+            atom = ligand_atoms[serial]
+            shift = heme['FE'] + normal * distance - numpy.array([atom['x'], atom['y'], atom['z']])
+            lines = []
+            for line in self.ligand.splitlines():
+                fields = line.split()
+                if len(fields) > 5 and fields[0].isdigit() and int(fields[0]) in ligand_atoms and '.' in fields[2]:
+                    xyz = numpy.array([float(value) for value in fields[2:5]]) + shift
+                    line = '{0:>7} {1:<8}{2:>10.4f}{3:>10.4f}{4:>10.4f} '.format(fields[0], fields[1], *xyz) + \
+                        ' '.join(fields[5:])
+                lines.append(line)
+            paths.append(os.path.join(os.path.basename(workdir), 'ligand_entry_00001_conf_{0:02d}.mol2'.format(pose)))
+            with open(os.path.join(FILEPATH, paths[-1]), 'w') as mol2:
+                mol2.write('\n'.join(lines) + '\n')
+
+        selection = pandas.DataFrame({'PATH': paths, 'POSE': range(1, len(paths) + 1)})
+        lig_mol2 = parse_tripos(self.ligand)
+        hemecoor = som.eval_heme_coordination(docking, protein, selection, lig_mol2)
+        self.assertEqual(sorted(set(hemecoor[('pose', '')])), [2, 4, 5])
+
+        for size in (1, 2):
+            chunks = [som.eval_heme_coordination(docking, protein, selection[start:start + size], lig_mol2)
+                      for start in range(0, len(selection), size)]
+            self.assertTrue(pandas.concat(chunks, ignore_index=True).equals(hemecoor))
+
+    def test_combine_docking_smartcyp(self):
+        """
+        Docking SOM counts are aggregated over unique atom/pose pairs and
+        normalized, per-pose hits are only returned on request
+        """
+
+        som = CombinedPrediction(base_work_dir=FILEPATH)
+        som.smartcyp_results = pandas.DataFrame({'Atom_id': [1, 2, 3], 'Energy': [50.0, 999.0, 100.0]},
+                                                index=['C.1', 'C.2', 'C.3'])
+        som.docking_results = pandas.DataFrame({'POSE': [1, 2], 'PATH': ['docking-x/a_1.mol2', 'docking-x/a_2.mol2']})
+
+        hemecoor = pandas.DataFrame({('source', 'serial'): [1, 1, 1, 3], ('pose', ''): [1, 1, 2, 2]})
+        combined = som.combine_docking_smartcyp(hemecoor, 2)
+
+        self.assertListEqual(list(combined.columns), ['Docking', 'SMARTCyp'])
+        self.assertListEqual(list(combined['Docking']), [1.0, 0.0, 0.5])
+        self.assertEqual(combined.loc['C.3', 'SMARTCyp'], 0.5)
+
+        combined = som.combine_docking_smartcyp(hemecoor, 2, pose_hits=True)
+        self.assertListEqual(combined.loc['C.1', 'Poses'], ['docking-x/a_1.mol2', 'docking-x/a_2.mol2'])
+        self.assertListEqual(combined.loc['C.2', 'Poses'], [])
+
+    def test_reanalyse(self):
+        """
+        SOM prediction is recomputed from stored artifacts without docking
+        """
+
+        workdir = os.path.join(FILEPATH, 'docking-reanalyse')
+        os.mkdir(workdir)
+
+        som = CombinedPrediction(base_work_dir=FILEPATH)
+        som.smartcyp_results = pandas.DataFrame({'Atom_id': [1, 2, 3], 'Energy': [50.0, 999.0, 100.0]},
+                                                index=['C.1', 'C.2', 'C.3'])
+        results = pandas.DataFrame({'CLUSTER': [1, 1], 'POSE': [1, 2], 'EVALUATED': [True, True],
+                                    'PATH': ['docking-reanalyse/a_1.mol2', 'docking-reanalyse/a_2.mol2']})
+        hemecoor = pandas.DataFrame({('source', 'serial'): [1, 1, 3], ('pose', ''): [1, 2, 2]})
+
+        docking = PlantsDocking(base_work_dir=FILEPATH)
+        docking.workdir = workdir
+        som.store_artifacts(docking, results, hemecoor)
+
+        # Stored heme coordination is read back as is
+        self.assertListEqual(list(read_hemecoor(os.path.join(workdir, 'hemecoor.csv')).columns),
+                             list(hemecoor.columns))
+        with open(os.path.join(workdir, 'som_config.json')) as config_file:
+            self.assertEqual(json.load(config_file)['cyp'], '3A4')
+
+        prediction = CombinedPrediction(base_work_dir=FILEPATH).reanalyse(['docking-reanalyse'])
+        self.assertDictEqual(prediction['C.3'], {'Docking': 0.5, 'SMARTCyp': 0.5})
+
+        prediction = CombinedPrediction(base_work_dir=FILEPATH).reanalyse('docking-reanalyse/a_1.mol2',
+                                                                          poses=['docking-reanalyse/a_1.mol2'])
+        self.assertEqual(prediction['C.3']['Docking'], 0.0)
+        self.assertTrue(os.path.isfile(os.path.join(workdir, 'prediction.csv')))
+
+        self.assertRaises(MDStudioException, CombinedPrediction(base_work_dir=FILEPATH).reanalyse, FILEPATH)
+
+    def test_prediction_cache(self):
+        """
+        Stored predictions are returned without running SMARTCyp or PLANTS,
+        the cache key depends on ligand and configuration
+        """
+
+        atoms = parse_tripos_atom(self.ligand)
+        som = CombinedPrediction(base_work_dir=FILEPATH, cyp='2D6')
+        key = som.prediction_key(self.ligand, atoms)
+
+        self.assertEqual(key, CombinedPrediction(base_work_dir='/tmp', cyp='2d6').prediction_key(self.ligand, atoms))
+        self.assertNotEqual(key, som.prediction_key(self.ligand, atoms, pose_hits=True))
+        for config in ({'search_speed': 'speed4'}, {'ensemble_docking': True}):
+            self.assertNotEqual(key, CombinedPrediction(cyp='2D6', **config).prediction_key(self.ligand, atoms))
+
+        som_result_cache.clear()
+        som_result_cache.set(key, {'C.1': {'Docking': 1.0, 'SMARTCyp': 1.0}})
+        try:
+            self.assertDictEqual(som.run(self.ligand), {'C.1': {'Docking': 1.0, 'SMARTCyp': 1.0}})
+            self.assertDictEqual(multi_isoform_prediction(self.ligand, ['2D6'], base_work_dir=FILEPATH),
+                                 {'2D6': {'C.1': {'Docking': 1.0, 'SMARTCyp': 1.0}}})
+            self.assertEqual(som_result_cache.stats()['hits'], 2)
+        finally:
+            som_result_cache.clear()
+
+    def test_multi_isoform_unsupported(self):
+        """
+        Multi isoform prediction fails without running SMARTCyp if none of
+        the isoforms is supported
+        """
+
+        self.assertIsNone(multi_isoform_prediction(self.ligand, ['9Z9', '8Y8'], base_work_dir=FILEPATH))
+
+    @unittest.skipIf(not os.path.exists(PLANTS_EXEC), 'This test requires proprietary software')
+    def test_multi_isoform_prediction(self):
+        """
+        Prediction for multiple isoforms returns results keyed by isoform
+        """
+
+        prediction = multi_isoform_prediction(self.ligand, ['3A4', '2D6'], base_work_dir=FILEPATH)
+
+        self.assertItemsEqual(prediction.keys(), ['3A4', '2D6'])
+        for isoform_prediction in prediction.values():
+            self.assertTrue(all(['Docking' in i for i in isoform_prediction.values()]))
+
+    def test_batch_empty(self):
+        """
+        Batch prediction without ligands yields no results
+        """
+
+        self.assertListEqual(list(batch_som_prediction([], base_work_dir=FILEPATH)), [])
+
+    @unittest.skipIf(not os.path.exists(PLANTS_EXEC), 'This test requires proprietary software')
+    def test_batch_prediction(self):
+        """
+        Batch prediction returns a result for every ligand, duplicates
+        share the same prediction
+        """
+
+        ligands = [('lig1', self.ligand), ('lig2', self.ligand)]
+        results = list(batch_som_prediction(ligands, max_workers=2, base_work_dir=FILEPATH))
+
+        self.assertItemsEqual([result['name'] for result in results], ['lig1', 'lig2'])
+        self.assertTrue(all([result['status'] == 'completed' for result in results]))
+        self.assertIs(results[0]['output'], results[1]['output'])
+
+    def test_batch_failed_ligand(self):
+        """
+        A ligand raising an error is reported as failed, the other ligands
+        in the batch are still predicted
+        """
+
+        def run(sompred, ligand, **kwargs):
+            if ' C2 ' in ligand:
+                raise ValueError('Invalid ligand')
+            return {1: {'SMARTCyp': 1.0}}
+
+        mol2 = '@<TRIPOS>MOLECULE\nlig{0}\n1 0 0\nSMALL\nNO_CHARGES\n\n@<TRIPOS>ATOM\n' \
+               '      1 C{0}         0.0000    0.0000    0.0000 C.3       1 LIG1        0.0000\n'
+        ligands = [('lig{0}'.format(i), mol2.format(i)) for i in range(1, 5)]
+
+        original = CombinedPrediction.run
+        CombinedPrediction.run = run
+        try:
+            results = list(batch_som_prediction(ligands, max_workers=1, base_work_dir=FILEPATH))
+        finally:
+            CombinedPrediction.run = original
+
+        results = dict([(result['name'], result) for result in results])
+        self.assertItemsEqual(results.keys(), ['lig1', 'lig2', 'lig3', 'lig4'])
+        self.assertEqual(results['lig2']['status'], 'failed')
+        self.assertEqual(results['lig2']['error'], 'Invalid ligand')
+        self.assertTrue(all([results[name]['status'] == 'completed' for name in ('lig1', 'lig3', 'lig4')]))
+
+    def test_ensemble_docking_cleanup(self):
+        """
+        Dockings of all ensemble conformations are removed if one of them
+        raises
+        """
+
+        deleted = []
+
+        class Docking(object):
+
+            def delete(self):
+                deleted.append(self)
+
+        class FailingPrediction(CombinedPrediction):
+
+            def run_docking(self, protein, ligand):
+                if protein == self.cyp_conformations()[0]:
+                    raise MDStudioException('PLANTS docking failed')
+                return Docking(), None
+
+        som = FailingPrediction(base_work_dir=FILEPATH, cyp='2D6', ensemble_docking=True)
+        self.assertRaises(MDStudioException, som.run, self.ligand, smartcyp_results=pandas.DataFrame(),
+                          use_cache=False)
+        self.assertEqual(len(deleted), len(som.cyp_conformations()) - 1)
+
+    @unittest.skipIf(not os.path.exists(PLANTS_EXEC), 'This test requires proprietary software')
+    def test_ensemble_docking_prediction(self):
+        """
+        Ensemble docking pools poses of all isoform conformations
+        """
+
+        som = CombinedPrediction(base_work_dir=FILEPATH, cyp='2D6', ensemble_docking=True)
+        prediction = som.run(self.ligand, filter_clusters=False)
+
+        self.assertTrue(all(['Docking' in i for i in prediction.values()]))
+        self.assertEqual(len(som.docking_results['POSE'].unique()), len(som.docking_results))
+
     @unittest.skipIf(not os.path.exists(PLANTS_EXEC), 'This test requires proprietary software')
     def test_a_som_prediction(self):
         """
@@ -56,7 +336,7 @@ class CombinedPredictionTest(UnittestPythonCompatibility):
         """
 
         som = CombinedPrediction(base_work_dir=FILEPATH)
-        prediction = som.run(self.ligand)
+        prediction = som.run(self.ligand, pose_hits=True)
 
         self.assertTrue(all(['Docking' in i for i in  prediction.values()]))
         self.assertTrue(all(['SMARTCyp' in i for i in  prediction.values()]))
@@ -70,7 +350,7 @@ class CombinedPredictionTest(UnittestPythonCompatibility):
             poses = []
             for val in self.__class__.prediction.values():
                 if val['Docking'] == 1.0:
-                    poses = [i for i in val.keys() if i not in ('Docking', 'SMARTCyp')]
+                    poses = val['Poses']
                     break
 
             self.assertTrue(len(poses) > 0)
@@ -85,7 +365,7 @@ class CombinedPredictionTest(UnittestPythonCompatibility):
             poses = []
             for val in self.__class__.prediction.values():
                 if val['Docking'] == 1.0:
-                    poses = [i for i in val.keys() if i not in ('Docking', 'SMARTCyp')]
+                    poses = val['Poses']
                     break
 
             docking = PlantsDocking(base_work_dir=FILEPATH)
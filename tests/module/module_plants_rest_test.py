@@ -7,10 +7,13 @@ Unit tests for the REST interface to the PlantsDocking methods
 """
 
 import os
+import time
 import unittest
 import requests
 import random
 
+from multiprocessing.pool import ThreadPool
+
 from mdstudio_smartcyp.plants_run import plants_version_info
 from tests.module.unittest_baseclass import UnittestPythonCompatibility
 
@@ -129,6 +132,72 @@ class PlantsRestTest(UnittestPythonCompatibility):
         rest_poses_response = response.text
         self.assertEqual(count_poses_mulimol(rest_poses_response), len(selection))
 
+    @unittest.skipIf(not test_localhost_connection(), 'MDStudio_SMARTCyp REST service not running on: {0}'.format(URL))
+    def test_docking_progress_concurrent(self):
+        """
+        Other requests are served while a docking progress stream is open.
+        The docking admission is released when the stream is closed.
+        """
+
+        files = {'ligand_file': open(os.path.join(FILEPATH, 'ligand.mol2'), 'rb'),
+                 'protein_file': open(os.path.join(FILEPATH, 'protein.mol2'), 'rb')}
+        data = {'bindingsite_center': [-0.989, 3.261, 0.826], 'progress': True}
+        stream = requests.post('{0}/plants_docking'.format(URL), files=files, data=data, stream=True, timeout=30)
+        self.assertEqual(stream.status_code, 200)
+
+        try:
+            response = requests.get('{0}/plants_docking_info'.format(URL), timeout=10)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(requests.get('{0}/admission_info'.format(URL), timeout=10).json()['docking']['work'], 1)
+        finally:
+            stream.close()
+
+        for _ in range(20):
+            if requests.get('{0}/admission_info'.format(URL), timeout=10).json()['docking']['work'] == 0:
+                break
+            time.sleep(0.5)
+        self.assertEqual(requests.get('{0}/admission_info'.format(URL)).json()['docking']['work'], 0)
+
+    @unittest.skipIf(not test_localhost_connection(), 'MDStudio_SMARTCyp REST service not running on: {0}'.format(URL))
+    def test_docking_concurrent_admission(self):
+        """
+        Concurrent docking requests are admitted side by side while other
+        requests are served. Rejected requests are answered 503 with a
+        Retry-After header.
+        """
+
+        def dock():
+            files = {'ligand_file': open(os.path.join(FILEPATH, 'ligand.mol2'), 'rb'),
+                     'protein_file': open(os.path.join(FILEPATH, 'protein.mol2'), 'rb')}
+            return requests.post('{0}/plants_docking'.format(URL), files=files,
+                                 data={'bindingsite_center': [-0.989, 3.261, 0.826], 'search_speed': 'speed4'})
+
+        pool = ThreadPool(processes=3)
+        try:
+            dockings = [pool.apply_async(dock) for _ in range(3)]
+
+            # Wait for the dockings to be admitted while other requests are served
+            work = 0
+            for _ in range(20):
+                response = requests.get('{0}/admission_info'.format(URL), timeout=10)
+                self.assertEqual(response.status_code, 200)
+                work = response.json().get('docking', {}).get('work', 0)
+                if work > 1:
+                    break
+                time.sleep(0.5)
+            self.assertGreater(work, 1)
+
+            for docking in dockings:
+                response = docking.get(timeout=600)
+                self.assertIn(response.status_code, (200, 503))
+                if response.status_code == 503:
+                    self.assertIn('Retry-After', response.headers)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(requests.get('{0}/admission_info'.format(URL)).json()['docking']['work'], 0)
+
     @unittest.skipIf(not test_localhost_connection(), 'MDStudio_SMARTCyp REST service not running on: {0}'.format(URL))
     def test_docking_get_statistics_noresults(self):
         """
@@ -7,19 +7,41 @@ Unit tests for PlantsDocking methods
 """
 
 import os
+import sys
 import glob
 import shutil
 import unittest
 import platform
 
 from mdstudio_smartcyp import __package_path__
-from mdstudio_smartcyp.plants_run import PlantsDocking
+from mdstudio_smartcyp.plants_run import PlantsDocking, DockingProgress, SearchBudgetPolicy, merge_shards
 from mdstudio_smartcyp.plants_run import MDStudioException
+from mdstudio_smartcyp.utils import prepare_work_dir, BLOB_STORE
+from mdstudio_smartcyp.storage import (open_pose_archive, read_run_file, run_file_exists, import_plants_csv,
+                                       run_packer)
+from mdstudio_smartcyp.scheduling import job_scheduler
 from tests.module.unittest_baseclass import UnittestPythonCompatibility
 
 FILEPATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../files/'))
 PLANTS_EXEC = os.path.join(__package_path__, 'bin/plants_{0}'.format(platform.system().lower()))
 
+# Stand-in for the PLANTS executable writing three poses with fixed scores
+FAKE_PLANTS = """#!{0}
+import os, sys, shutil
+config = dict(line.split(None, 1) for line in open(sys.argv[-1]).read().splitlines() if line.strip()
+              and not line.startswith('#') and len(line.split(None, 1)) == 2)
+output_dir = config['output_dir'].strip()
+if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+with open(os.path.join(output_dir, 'ranking.csv'), 'w') as ranking:
+    ranking.write('TOTAL_SCORE,SCORE_NORM_HEVATOMS\\n')
+    for conf, score in enumerate((-60.1, -58.3, -55.0), start=1):
+        name = 'ligand_entry_00001_conf_{{0:02d}}'.format(conf)
+        shutil.copy(config['ligand_file'].strip(), os.path.join(output_dir, name + '.mol2'))
+        ranking.write('{{0}},{{1}},-3.0\\n'.format(name, score))
+print('best score: -60.1')
+""".format(sys.executable)
+
 
 class PlantsDockingTest(UnittestPythonCompatibility):
 
@@ -44,10 +66,11 @@ class PlantsDockingTest(UnittestPythonCompatibility):
     @classmethod
     def tearDownClass(cls):
         """
-        Remove all created docking result dirs
+        Remove all created docking result dirs and input blob store
         """
 
-        for dockdir in glob.glob(os.path.join(FILEPATH, 'docking-*/')):
+        run_packer.flush()
+        for dockdir in glob.glob(os.path.join(FILEPATH, 'docking-*/')) + [os.path.join(FILEPATH, BLOB_STORE)]:
             if os.path.isdir(dockdir):
                 shutil.rmtree(dockdir)
 
@@ -85,9 +108,11 @@ class PlantsDockingTest(UnittestPythonCompatibility):
         did_run_successfully, plants = self.run_plants()
         self.assertTrue(did_run_successfully)
 
-        outputfiles = glob.glob('{0}/_entry_00001_conf_*.mol2'.format(plants.workdir))
-        self.assertEqual(len(outputfiles), plants.config['cluster_structures'])
-        self.assertEqual(len(outputfiles), len(plants.get_results()))
+        run_packer.flush()
+        poses = open_pose_archive(plants.workdir)
+        self.assertEqual(len(poses), plants.config['cluster_structures'])
+        self.assertEqual(len(poses), len(plants.get_results()))
+        self.assertListEqual(glob.glob('{0}/_entry_00001_conf_*.mol2'.format(plants.workdir)), [])
 
     @unittest.skipIf(not os.path.exists(PLANTS_EXEC), 'This test requires proprietary software')
     def test_plants_docking_get_structures(self):
@@ -177,3 +202,190 @@ class PlantsDockingTest(UnittestPythonCompatibility):
 
         plants = PlantsDocking(base_work_dir=FILEPATH, bindingsite_center=[-0.989, 3.261, 0.826])
         self.assertRaises(MDStudioException, plants.run, self.ligand, self.protein)
+
+    def test_docking_progress(self):
+        """
+        Test docking poses are published once complete and best score
+        improvements parsed from PLANTS output
+        """
+
+        workdir = prepare_work_dir(path=FILEPATH, prefix='docking-')
+        events = []
+        progress = DockingProgress(workdir, events.append)
+
+        progress.output('best score: -56.31')
+        progress.output('best score: -50.02')
+        progress.output('best score: -61.80')
+        self.assertEqual([event['score'] for event in events], [-56.31, -61.8])
+
+        del events[:]
+        shutil.copy(self.ligand_file, os.path.join(workdir, 'ligand_entry_00001_conf_01.mol2'))
+        with open(os.path.join(workdir, 'ranking.csv'), 'w') as ranking:
+            ranking.write('TOTAL_SCORE,SCORE_NORM_HEVATOMS\nligand_entry_00001_conf_01,-61.8,-3.09\n')
+
+        # Pose file size checked on a second poll
+        progress.poll()
+        self.assertEqual(events, [])
+        progress.poll()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['score'], -61.8)
+        self.assertEqual(events[0]['structure'], self.ligand)
+
+        shutil.copy(self.ligand_file, os.path.join(workdir, 'ligand_entry_00001_conf_02.mol2'))
+        progress.stop()
+        self.assertEqual([event['pose'] for event in events],
+                         ['ligand_entry_00001_conf_01', 'ligand_entry_00001_conf_02'])
+        self.assertIsNone(events[1]['score'])
+
+    def test_plants_docking_converge(self):
+        """
+        Test a converged docking stops before running all search shards and
+        merges the shard results as a single docking
+        """
+
+        workdir = prepare_work_dir(path=FILEPATH, prefix='fake-plants-')
+        exec_path = os.path.join(workdir, 'plants')
+        with open(exec_path, 'w') as fake:
+            fake.write(FAKE_PLANTS)
+        os.chmod(exec_path, 0o755)
+
+        events = []
+        job_scheduler.configure('plants', slots=1, reserved=0)
+        try:
+            plants = PlantsDocking(base_work_dir=FILEPATH, bindingsite_center=[-0.989, 3.261, 0.826],
+                                   exec_path=exec_path, converge=1, cluster_structures=4, seed=7)
+            self.assertTrue(plants.run(self.protein, self.ligand, progress=events.append))
+        finally:
+            job_scheduler.configure('plants', slots=job_scheduler.slots)
+            shutil.rmtree(workdir)
+
+        # Every shard searches with its own seed
+        seeds = []
+        for shard in (1, 2):
+            config = read_run_file(os.path.join(plants.workdir, 'plants-shard-{0}.config'.format(shard)))
+            seeds.extend(line.split()[1] for line in config.splitlines() if line.startswith('seed '))
+        self.assertEqual(seeds, ['7', '8'])
+
+        shards = [event for event in events if event['event'] == 'shard']
+        self.assertEqual([event['converged'] for event in shards], [False, True])
+
+        results = plants.get_results(do_cluster=False)
+        self.assertEqual(sorted(results.keys()), ['ligand_entry_00001_conf_{0:02d}'.format(conf)
+                                                  for conf in range(1, 5)])
+        self.assertEqual([results[pose]['TOTAL_SCORE'] for pose in sorted(results)], [-60.1, -60.1, -58.3, -58.3])
+        self.assertEqual(glob.glob(os.path.join(plants.workdir, 'shard-*')), [])
+
+    def test_plants_docking_converge_staged(self):
+        """
+        Test search shards start in stages, at most two at a time, and no
+        shard is started after the docking converged
+        """
+
+        workdir = prepare_work_dir(path=FILEPATH, prefix='fake-plants-')
+        exec_path = os.path.join(workdir, 'plants')
+        with open(exec_path, 'w') as fake:
+            fake.write(FAKE_PLANTS)
+        os.chmod(exec_path, 0o755)
+
+        events = []
+        job_scheduler.configure('plants', slots=4, reserved=0)
+        try:
+            plants = PlantsDocking(base_work_dir=FILEPATH, bindingsite_center=[-0.989, 3.261, 0.826],
+                                   exec_path=exec_path, converge=1, search_speed='speed1', cluster_structures=4)
+            self.assertTrue(plants.run(self.protein, self.ligand, progress=events.append))
+        finally:
+            job_scheduler.configure('plants', slots=job_scheduler.slots)
+            shutil.rmtree(workdir)
+
+        # Shard 3 replaces the unconverged first shard, shard 4 is never started
+        started = [shard for shard in range(1, 5)
+                   if run_file_exists(os.path.join(plants.workdir, 'plants-shard-{0}.config'.format(shard)))]
+        self.assertEqual(started, [1, 2, 3])
+
+        shards = [event for event in events if event['event'] == 'shard']
+        self.assertEqual([event['converged'] for event in shards], [False, True])
+
+    def test_merge_shards(self):
+        """
+        Test merging search shards keeps the best poses and best ranking
+        row per ligand entry
+        """
+
+        workdir = prepare_work_dir(path=FILEPATH, prefix='docking-')
+        shard_dirs = []
+        for shard, scores in enumerate(((-50.0, -40.0, -30.0), (-45.0, -42.0, -35.0)), start=1):
+            shard_dir = os.path.join(workdir, 'shard-{0}'.format(shard))
+            os.makedirs(shard_dir)
+            shard_dirs.append(shard_dir)
+
+            rows = [('ligand_entry_00001_conf_01', scores[0]), ('ligand_entry_00001_conf_02', scores[1]),
+                    ('ligand_entry_00002_conf_01', scores[2])]
+            for csv_file in ('ranking.csv', 'bestranking.csv'):
+                with open(os.path.join(shard_dir, csv_file), 'w') as ranking:
+                    ranking.write('TOTAL_SCORE,SCORE_NORM_HEVATOMS\n')
+                    for name, score in rows:
+                        if csv_file == 'ranking.csv' or name.endswith('conf_01'):
+                            ranking.write('{0},{1},-3.0\n'.format(name, score))
+            for name, score in rows:
+                shutil.copy(self.ligand_file, os.path.join(shard_dir, name + '.mol2'))
+
+        self.assertEqual(merge_shards(workdir, shard_dirs, 2), 4)
+
+        ranking = import_plants_csv(workdir, files=('ranking.csv', ))
+        self.assertEqual(dict((name, row['TOTAL_SCORE']) for name, row in ranking.items()),
+                         {'ligand_entry_00001_conf_01': -50.0, 'ligand_entry_00001_conf_02': -45.0,
+                          'ligand_entry_00002_conf_01': -35.0, 'ligand_entry_00002_conf_02': -30.0})
+
+        best = import_plants_csv(workdir, files=('bestranking.csv', ))
+        self.assertEqual(dict((name, row['TOTAL_SCORE']) for name, row in best.items()),
+                         {'ligand_entry_00001_conf_01': -50.0, 'ligand_entry_00002_conf_01': -35.0})
+        self.assertEqual(len(glob.glob(os.path.join(workdir, '*_entry_*_conf_*.mol2'))), 4)
+        self.assertEqual(glob.glob(os.path.join(workdir, 'shard-*')), [])
+
+    def test_search_budget_policy(self):
+        """
+        Test the search budget follows ligand complexity, quality tier and
+        runtime target and the runtime model is calibrated
+        """
+
+        policy = SearchBudgetPolicy(unit_time=0.1)
+
+        budget = policy.select(self.ligand)
+        self.assertEqual(budget['molecules'], [(13, 2)])
+        self.assertEqual((budget['search_speed'], budget['aco_ants']), ('speed4', 20))
+        self.assertAlmostEqual(budget['predicted_runtime'], 3.9)
+
+        budget = policy.select(self.ligand, quality='thorough')
+        self.assertEqual((budget['search_speed'], budget['aco_ants']), ('speed2', 20))
+
+        budget = policy.select(self.ligand, quality='thorough', target_runtime=3)
+        self.assertEqual((budget['search_speed'], budget['aco_ants']), ('speed4', 10))
+        self.assertRaises(MDStudioException, policy.select, self.ligand, quality='best')
+
+        policy.record(budget, 3.9)
+        self.assertEqual(policy.stats()['runs'], 1)
+        self.assertAlmostEqual(policy.unit_time, 0.12)
+
+    def test_plants_config_search_budget(self):
+        """
+        Test the selected search budget and ACO parameters reach the PLANTS
+        configuration file
+        """
+
+        workdir = prepare_work_dir(path=FILEPATH, prefix='fake-plants-')
+        exec_path = os.path.join(workdir, 'plants')
+        with open(exec_path, 'w') as fake:
+            fake.write(FAKE_PLANTS)
+        os.chmod(exec_path, 0o755)
+
+        try:
+            plants = PlantsDocking(base_work_dir=FILEPATH, bindingsite_center=[-0.989, 3.261, 0.826],
+                                   exec_path=exec_path, search_policy='adaptive', search_quality='fast',
+                                   aco_evap=0.25, aco_sigma=0.5)
+            self.assertTrue(plants.run(self.protein, self.ligand))
+        finally:
+            shutil.rmtree(workdir)
+
+        config = dict(line.split() for line in read_run_file(os.path.join(plants.workdir, 'plants.config'))
+                      .splitlines() if line.startswith(('search_speed ', 'aco_')))
+        self.assertEqual(config, {'search_speed': 'speed4', 'aco_ants': '10', 'aco_evap': '0.25', 'aco_sigma': '0.5'})
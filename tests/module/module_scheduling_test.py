@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: module_scheduling_test.py
+
+Unit tests for the MDStudio_SMARTCyp job scheduler, workload lanes, job
+control and admission control
+"""
+
+import os
+import time
+import logging
+import shutil
+import threading
+
+from mdstudio_smartcyp.utils import prepare_work_dir, MDStudioException
+from mdstudio_smartcyp.scheduling import (available_cpus, JobScheduler, Workload, AdmissionController, Overloaded,
+                                          JobControl, JobCancelled, RunnerBaseClass, job_scheduler)
+from tests.module.unittest_baseclass import UnittestPythonCompatibility
+
+
+class SchedulingTest(UnittestPythonCompatibility):
+
+    tempdirs = []
+
+    def tearDown(self):
+        """
+        tearDown method called after each unittest to cleanup
+        the temporary directories
+        """
+
+        for tmpdir in self.tempdirs:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+
+    def test_job_scheduler(self):
+        """
+        Test jobs wait for a free slot and start by priority and in order of
+        submission, processes of all tools share the CPU slots
+        """
+
+        self.assertTrue(available_cpus() >= 1)
+
+        scheduler = JobScheduler(slots=1)
+        started = []
+
+        def job(name, priority):
+            with scheduler.slot('plants', priority=priority):
+                started.append(name)
+
+        scheduler.acquire('plants')
+        jobs = []
+        for name, priority in (('low1', 0), ('low2', 0), ('high', 1)):
+            jobs.append(threading.Thread(target=job, args=(name, priority)))
+            jobs[-1].start()
+            while scheduler.stats()['plants']['queued'] < len(jobs):
+                time.sleep(0.001)
+
+        self.assertEqual(scheduler.stats()['plants']['running'], 1)
+        scheduler.release('plants')
+        for thread in jobs:
+            thread.join()
+
+        self.assertListEqual(started, ['high', 'low1', 'low2'])
+        stats = scheduler.stats()['plants']
+        self.assertEqual((stats['jobs'], stats['running'], stats['queued']), (4, 0, 0))
+        self.assertRaises(MDStudioException, scheduler.configure, 'plants', 0)
+
+        # Processes of all tools share the CPU slots
+        scheduler = JobScheduler(cpus=2, reserved=0)
+        scheduler.acquire('plants')
+        scheduler.acquire('plants')
+
+        waiting = threading.Thread(target=scheduler.acquire, args=('smartcyp', ))
+        waiting.start()
+        while not scheduler.stats().get('smartcyp', {}).get('queued'):
+            time.sleep(0.001)
+
+        stats = scheduler.stats()
+        self.assertEqual((stats['total']['slots'], stats['total']['running'], stats['total']['queued']), (2, 2, 1))
+        self.assertEqual(stats['plants']['slots'], 2)
+
+        scheduler.release('plants')
+        waiting.join()
+        stats = scheduler.stats()
+        self.assertEqual((stats['plants']['running'], stats['smartcyp']['running'], stats['total']['running']),
+                         (1, 1, 2))
+
+    def test_workload_reserved_slots(self):
+        """
+        Test bulk jobs leave reserved slots free for interactive jobs
+        """
+
+        scheduler = JobScheduler(cpus=2, reserved=1)
+        scheduler.acquire('plants', priority=Workload.current_priority())
+
+        bulk = threading.Thread(target=scheduler.acquire, args=('plants', ))
+        bulk.start()
+        while not scheduler.stats()['plants']['queued']:
+            time.sleep(0.001)
+
+        with Workload('interactive'):
+            self.assertEqual(Workload.current(), 'interactive')
+            scheduler.acquire('plants', priority=Workload.current_priority())
+        self.assertEqual(Workload.current(), 'bulk')
+
+        stats = scheduler.stats()['plants']
+        self.assertEqual((stats['running'], stats['queued']), (2, 1))
+
+        scheduler.release('plants')
+        scheduler.release('plants')
+        bulk.join()
+        self.assertEqual(scheduler.stats()['plants']['running'], 1)
+        self.assertRaises(MDStudioException, Workload, 'batch')
+
+    def test_job_control_cancel(self):
+        """
+        Test cancelling a job kills its running process, releasing the slot,
+        and stops jobs waiting for a slot
+        """
+
+        runner = RunnerBaseClass()
+        runner.log = logging.getLogger(__name__)
+        runner.workdir = prepare_work_dir(prefix='jobs-')
+        runner.tool = 'sleep-test'
+        self.tempdirs.append(runner.workdir)
+
+        errors = []
+        control = JobControl()
+
+        def run():
+            with control:
+                try:
+                    runner.cmd_runner(['sleep', '30'])
+                except JobCancelled as error:
+                    errors.append(error)
+
+        job_scheduler.configure('sleep-test', slots=1, reserved=0)
+        job = threading.Thread(target=run)
+        job.start()
+        while not job_scheduler.stats()['sleep-test']['running']:
+            time.sleep(0.001)
+
+        start = time.time()
+        control.cancel()
+        job.join()
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(job_scheduler.stats()['sleep-test']['running'], 0)
+        self.assertIsNone(JobControl.current())
+
+        # Cancel a job waiting for a slot
+        scheduler = JobScheduler(slots=1, reserved=0)
+        scheduler.acquire('plants')
+        waiting = JobControl()
+        waiting.cancel()
+        self.assertRaises(JobCancelled, scheduler.acquire, 'plants', cancel=waiting.cancelled)
+        self.assertEqual(scheduler.stats()['plants']['queued'], 0)
+
+    def test_admission_controller(self):
+        """
+        Test requests over the maximum work of an endpoint are rejected with
+        a retry time while other endpoints are admitted
+        """
+
+        controller = AdmissionController(max_work=3)
+        start = controller.acquire('docking', cost=2)
+        with controller.admit('docking'):
+            self.assertRaises(Overloaded, controller.acquire, 'docking')
+            controller.acquire('smartcyp', cost=3)
+
+        self.assertTrue(controller.stats()['docking']['unit_time'] >= 0)
+        with self.assertRaises(Overloaded) as rejected:
+            controller.acquire('docking', cost=2)
+        self.assertEqual(rejected.exception.retry_after, 1)
+
+        # A single request is admitted to an idle endpoint
+        controller.release('docking', cost=2, start=start)
+        self.assertTrue(controller.acquire('docking', cost=5) > 0)
+
+        stats = controller.stats()['docking']
+        self.assertEqual((stats['work'], stats['admitted'], stats['rejected']), (5, 3, 2))
+
+        controller.configure(max_work=0)
+        controller.acquire('docking', cost=100)
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: module_storage_test.py
+
+Unit tests for MDStudio_SMARTCyp docking run storage and result caches
+"""
+
+import io
+import os
+import time
+import tarfile
+import zipfile
+import shutil
+
+from mdstudio_smartcyp import __package_path__
+from mdstudio_smartcyp.utils import prepare_work_dir, parse_tripos, mol2_to_pdb, mol2_to_pdb_string, MDStudioException
+from mdstudio_smartcyp.storage import (iter_multi_pdb, iter_multi_mol2, iter_structure_archive, pdb_block_cache,
+                                       pack_poses, open_pose_archive, read_structure, structure_exists,
+                                       structure_coordinates, pack_run, read_run_file, run_file_cache,
+                                       import_plants_csv, crop_protein, ResultCache, ArtifactWriter, pack_results,
+                                       POSE_ARCHIVE)
+from tests.module.unittest_baseclass import UnittestPythonCompatibility
+
+FILEPATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../files/'))
+
+
+class StorageTest(UnittestPythonCompatibility):
+
+    tempdirs = []
+
+    def tearDown(self):
+        """
+        tearDown method called after each unittest to cleanup
+        the temporary directories
+        """
+
+        for tmpdir in self.tempdirs:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+
+    def test_multi_pdb(self):
+        """
+        Test PDB ensemble generation with protein atom records formatted
+        once per conformation
+        """
+
+        ligand = os.path.join(FILEPATH, 'ligand.mol2')
+        protein = os.path.join(FILEPATH, 'protein.mol2')
+        with open(ligand) as ligand_file:
+            atoms = parse_tripos(ligand_file.read())
+        with open(protein) as protein_file:
+            protein_atoms = parse_tripos(protein_file.read())
+
+        line = '{0:6}{1:>5} {2:^5}{3:>3} {4}{5:>4}    {6:8.3f}{7:8.3f}{8:8.3f}  {9:6}\n'
+        self.assertEqual(mol2_to_pdb_string(atoms, record='HETATM', chain='B'),
+                         ''.join([line.format(*atom) for atom in mol2_to_pdb(atoms, record='HETATM', chain='B')]))
+
+        pdb_block_cache.clear()
+        ensemble = ''.join(iter_multi_pdb([ligand, ligand], protein=protein))
+
+        self.assertEqual(len(pdb_block_cache), 1)
+        self.assertEqual(ensemble.count('MODEL'), 2)
+        self.assertEqual(ensemble.count('HETATM'), 2 * len(atoms))
+        self.assertEqual(ensemble.count('ATOM  '), 2 * len(protein_atoms))
+        self.assertTrue(ensemble.endswith('ENDMDL\nEND\n'))
+
+    def test_structure_archive(self):
+        """
+        Test streaming structures as MOL2 ensemble or as tar and zip archive
+        of individual structure files
+        """
+
+        ligand = os.path.join(FILEPATH, 'ligand.mol2')
+        protein = os.path.join(FILEPATH, 'protein.mol2')
+        with open(ligand) as ligand_file:
+            content = ligand_file.read()
+
+        chunks = list(iter_multi_mol2([ligand, ligand], chunk_size=1000))
+        self.assertTrue(all([len(chunk) <= 1000 for chunk in chunks]))
+        self.assertEqual(''.join(chunks), content * 2)
+
+        tar = tarfile.open(fileobj=io.BytesIO(b''.join(iter_structure_archive([ligand], protein=protein))))
+        self.assertListEqual(tar.getnames(), ['protein.mol2', 'ligand.mol2'])
+        self.assertEqual(tar.extractfile('ligand.mol2').read().decode('utf-8'), content)
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(iter_structure_archive([ligand], archive='zip',
+                                                                            output_format='pdb'))))
+        self.assertListEqual(archive.namelist(), ['ligand.pdb'])
+        self.assertTrue(archive.read('ligand.pdb').decode('utf-8').startswith('HETATM'))
+
+        self.assertRaises(MDStudioException, list, iter_structure_archive([ligand], archive='rar'))
+
+    def test_pose_archive(self):
+        """
+        Test packing docking poses into a single pose archive from which the
+        MOL2 files are regenerated byte for byte
+        """
+
+        with open(os.path.join(FILEPATH, 'ligand.mol2')) as ligand_file:
+            ligand = parse_tripos(ligand_file.read())
+
+        workdir = prepare_work_dir(path=FILEPATH, prefix='docking-')
+        self.tempdirs.append(workdir)
+
+        line = '{0:>7} {1:<8}{2:>10.4f}{3:>10.4f}{4:>10.4f} {5:<5} {6:>5} {7:<7} {8:>10.4f}'
+        poses = {}
+        for pose in range(1, 4):
+            name = 'ligand_entry_00001_conf_{0:02d}'.format(pose)
+            lines = ['@<TRIPOS>MOLECULE', name, '20 21 1 0 0', 'SMALL', 'NO_CHARGES', '', '@<TRIPOS>ATOM']
+            for atom in ligand.atoms.tolist():
+                atom = atom[:2] + (atom[2] + pose, ) + atom[3:]
+                lines.append(line.format(*atom))
+            poses[os.path.join(workdir, '{0}.mol2'.format(name))] = '\n'.join(lines) + '\n'
+
+        poses[os.path.join(workdir, 'ligand_entry_00001_conf_04.mol2')] = ligand.lines[0] + '\nverbatim\n'
+        for path, mol2 in poses.items():
+            with open(path, 'w') as pose_file:
+                pose_file.write(mol2)
+
+        archive = pack_poses(workdir)
+        self.assertEqual(len(archive), 4)
+        self.assertListEqual(list(archive.header['verbatim'].keys()), ['ligand_entry_00001_conf_04'])
+        self.assertIs(open_pose_archive(workdir), open_pose_archive(workdir))
+
+        for path, mol2 in poses.items():
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(structure_exists(path))
+            self.assertEqual(read_structure(path), mol2)
+
+        xyz = structure_coordinates(os.path.join(workdir, 'ligand_entry_00001_conf_02.mol2'))
+        self.assertAlmostEqual(xyz[0][0], ligand.atoms['x'][0] + 2)
+        self.assertFalse(structure_exists(os.path.join(workdir, 'ligand_entry_00001_conf_05.mol2')))
+
+    def test_pack_run(self):
+        """
+        Test compressing docking run files at rest that remain readable by
+        their original path
+        """
+
+        workdir = prepare_work_dir(path=FILEPATH, prefix='docking-')
+        self.tempdirs.append(workdir)
+
+        protein = os.path.join(workdir, 'protein.mol2')
+        shutil.copy(os.path.join(FILEPATH, 'protein.mol2'), protein)
+        with open(os.path.join(workdir, 'features.csv'), 'w') as csv_file:
+            csv_file.write('LIGAND_ENTRY,TOTAL_SCORE\n' + ''.join(['ligand_entry_00001_conf_{0:02d},-{0}.5\n'.format(i)
+                                                                   for i in range(1, 100)]))
+        with open(os.path.join(workdir, 'small.txt'), 'w') as small_file:
+            small_file.write('small')
+
+        with open(protein) as protein_file:
+            content = protein_file.read()
+        results = import_plants_csv(workdir)
+
+        self.assertListEqual(pack_run(workdir), ['features.csv', 'protein.mol2'])
+        self.assertListEqual(sorted(os.listdir(workdir)), ['features.csv.gz', 'protein.mol2.gz', 'small.txt'])
+        self.assertTrue(structure_exists(protein))
+        self.assertEqual(read_structure(protein), content)
+        self.assertEqual(read_run_file(os.path.join(workdir, 'small.txt')), 'small')
+        self.assertDictEqual(import_plants_csv(workdir), results)
+
+        hits = run_file_cache.hits
+        self.assertEqual(read_run_file(protein), content)
+        self.assertEqual(run_file_cache.hits, hits + 1)
+
+    def test_pack_results_async(self):
+        """
+        Test packing a completed docking run in the background
+        """
+
+        workdir = prepare_work_dir(path=FILEPATH, prefix='docking-')
+        self.tempdirs.append(workdir)
+
+        shutil.copy(os.path.join(FILEPATH, 'protein.mol2'), os.path.join(workdir, 'protein.mol2'))
+        pose = os.path.join(workdir, 'ligand_entry_00001_conf_01.mol2')
+        shutil.copy(os.path.join(FILEPATH, 'ligand.mol2'), pose)
+        with open(pose) as pose_file:
+            content = pose_file.read()
+
+        packer = ArtifactWriter(mode='async')
+        packer.write(pack_results, workdir)
+        packer.flush()
+
+        self.assertListEqual(sorted(os.listdir(workdir)), sorted([POSE_ARCHIVE, 'protein.mol2.gz']))
+        self.assertEqual(read_structure(pose), content)
+
+    def test_crop_protein(self):
+        """
+        Test cropping a protein to whole binding site residues and cofactors
+        """
+
+        with open(os.path.join(__package_path__, 'data/3UA1_apo_5901.mol2')) as protein_file:
+            protein = parse_tripos(protein_file.read())
+
+        cropped = crop_protein('\n'.join(protein.lines), [-0.989, 3.261, 0.826], 8)
+        self.assertEqual(crop_protein('\n'.join(protein.lines), [-0.989, 3.261, 0.826], 8), cropped)
+
+        cropped = parse_tripos(cropped)
+        self.assertEqual(cropped.atom_count, len(cropped.atoms))
+        self.assertListEqual(cropped.atoms['atom_id'].tolist(), list(range(1, len(cropped.atoms) + 1)))
+        self.assertTrue(cropped.bonds['b_end'].max() <= len(cropped.atoms))
+
+        # Residues are complete and the heme is kept
+        residues = set(cropped.atoms['subst_name'].tolist())
+        self.assertIn('HEM470', residues)
+        for residue in residues:
+            self.assertEqual(sum(cropped.atoms['subst_name'] == residue), sum(protein.atoms['subst_name'] == residue))
+
+    def test_result_cache_lru(self):
+        """
+        Test least recently used results are evicted from a full cache and
+        stored results can not be modified
+        """
+
+        cache = ResultCache(max_size=2)
+        cache.set('a', {'value': 1})
+        cache.set('b', {'value': 2})
+        cache.get('a')['value'] = 3
+        cache.set('c', {'value': 4})
+
+        self.assertDictEqual(cache.get('a'), {'value': 1})
+        self.assertIsNone(cache.get('b'))
+        self.assertDictEqual(cache.stats(), {'size': 2, 'max_size': 2, 'ttl': 0, 'hits': 2, 'misses': 1,
+                                             'evictions': 1, 'hit_rate': 2 / 3.0})
+
+        cache.configure(max_size=0)
+        cache.set('d', 1)
+        self.assertEqual(len(cache), 0)
+
+        # Read-only values are shared without copying
+        value = {'value': 5}
+        cache = ResultCache(max_size=2, copy_values=False)
+        cache.set('e', value)
+        self.assertIs(cache.get('e'), value)
+
+    def test_result_cache_ttl(self):
+        """
+        Test expired results are not returned
+        """
+
+        cache = ResultCache(ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_artifact_writer(self):
+        """
+        Test artifacts are not written, written directly or written behind
+        by a background thread depending on the persistence mode
+        """
+
+        written = []
+
+        writer = ArtifactWriter(mode='off')
+        writer.write(written.append, 'off')
+        self.assertListEqual(written, [])
+
+        writer.configure('sync')
+        writer.write(written.append, 'sync')
+        self.assertListEqual(written, ['sync'])
+
+        writer.configure('async')
+        for i in range(3):
+            writer.write(written.append, i)
+        writer.flush()
+        self.assertListEqual(written, ['sync', 0, 1, 2])
+
+        self.assertRaises(MDStudioException, writer.configure, 'lazy')
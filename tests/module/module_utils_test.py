@@ -6,12 +6,17 @@ file: module_utils_test.py
 Unit tests MDStudio_SMARTCyp utility functions
 """
 
+import io
 import os
 import shutil
 import platform
 
 from mdstudio_smartcyp import __package_path__
-from mdstudio_smartcyp.utils import prepare_work_dir
+from mdstudio_smartcyp.utils import (prepare_work_dir, split_multi_mol2, read_molecules, mol2_hash, parse_tripos,
+                                     parse_tripos_atom, parse_tripos_bond, molecular_weight, hydrophobic_atom_count,
+                                     rotatable_bond_count, atom_count, merge_protein_ligand_mol2, stage_input,
+                                     blob_references, prune_blobs, MDStudioException)
+from mdstudio_smartcyp.storage import pack_run
 from tests.module.unittest_baseclass import UnittestPythonCompatibility
 
 FILEPATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../files/'))
@@ -103,3 +108,117 @@ class UtilsTest(UnittestPythonCompatibility):
         to_create = os.path.join(FILEPATH, 'tmp_user_dir')
 
         self.assertRaises(IOError, prepare_work_dir, path=to_create, create=False)
+
+    def test_split_multi_mol2(self):
+        """
+        Test splitting a multi molecule MOL2 file in single molecules
+        """
+
+        with open(os.path.join(FILEPATH, 'ligand.mol2')) as ligand_file:
+            ligand = ligand_file.read()
+
+        molecules = list(split_multi_mol2(ligand * 3))
+
+        self.assertEqual(len(molecules), 3)
+        self.assertTrue(all([mol == ligand for name, mol in molecules]))
+        self.assertListEqual(list(split_multi_mol2('')), [])
+
+    def test_read_molecules(self):
+        """
+        Test streaming molecules from multi MOL2 and SDF files with byte
+        offsets to resume from
+        """
+
+        with open(os.path.join(FILEPATH, 'ligand.mol2')) as ligand_file:
+            ligand = ligand_file.read()
+
+        library = io.BytesIO((ligand * 3).encode('utf-8'))
+        molecules = list(read_molecules(library))
+
+        self.assertListEqual([offset for offset, name, mol in molecules], [0, len(ligand), 2 * len(ligand)])
+        self.assertTrue(all([mol == ligand for offset, name, mol in molecules]))
+        self.assertEqual(len(list(read_molecules(library, start=molecules[1][0]))), 2)
+
+        sdf = list(read_molecules(os.path.join(FILEPATH, 'ligand.sdf')))
+        self.assertEqual(len(sdf), 1)
+        self.assertTrue(sdf[0][2].endswith('$$$$\n'))
+
+        # Paths decoded from JSON requests are unicode in Python 2
+        self.assertEqual(len(list(read_molecules(u'{0}'.format(os.path.join(FILEPATH, 'ligand.sdf'))))), 1)
+
+        self.assertRaises(MDStudioException, list, read_molecules(library, fmt='pdb'))
+
+    def test_mol2_hash(self):
+        """
+        Test MOL2 content hash independent of molecule name and formatting
+        """
+
+        with open(os.path.join(FILEPATH, 'ligand.mol2')) as ligand_file:
+            ligand = ligand_file.read()
+
+        renamed = ligand.replace('@<TRIPOS>MOLECULE\n', '@<TRIPOS>MOLECULE\nrenamed')
+        reformatted = ligand.replace(' ', '  ')
+
+        self.assertEqual(mol2_hash(ligand), mol2_hash(renamed))
+        self.assertEqual(mol2_hash(ligand), mol2_hash(reformatted))
+        self.assertNotEqual(mol2_hash(ligand), mol2_hash(ligand.replace('O.2', 'O.3')))
+
+    def test_parse_tripos(self):
+        """
+        Test columnar Tripos MOL2 parsing and the record dictionaries and
+        helper functions derived from it
+        """
+
+        with open(os.path.join(FILEPATH, 'ligand.mol2')) as ligand_file:
+            ligand = ligand_file.read()
+
+        mol2 = parse_tripos(ligand)
+        atoms = parse_tripos_atom(ligand)
+        bonds = parse_tripos_bond(ligand)
+
+        self.assertIs(parse_tripos(mol2), mol2)
+        self.assertListEqual(list(mol2.sections.keys())[:3], ['MOLECULE', 'ATOM', 'BOND'])
+        self.assertEqual(mol2.atom_count, len(atoms))
+        self.assertEqual(atom_count(os.path.join(FILEPATH, 'ligand.mol2')), len(atoms))
+        self.assertEqual(len(mol2.bonds), len(bonds))
+        self.assertEqual(mol2.coordinates.shape, (len(atoms), 3))
+        self.assertAlmostEqual(mol2.coordinates[0][0], atoms[1]['x'])
+        self.assertEqual(bonds[1]['b_start'], mol2.bonds['b_start'][0])
+
+        self.assertEqual(molecular_weight(mol2), molecular_weight(atoms))
+        self.assertEqual(hydrophobic_atom_count(mol2), hydrophobic_atom_count(atoms))
+        self.assertEqual(rotatable_bond_count(mol2), 2)
+
+        merged = parse_tripos(merge_protein_ligand_mol2(ligand, ligand))
+        self.assertEqual(merged.atom_count, 2 * len(atoms))
+        self.assertEqual(merged.bonds['b_start'][len(bonds)], bonds[1]['b_start'] + len(atoms))
+
+    def test_stage_input(self):
+        """
+        Test staging the same input in multiple directories from a single
+        reference counted blob
+        """
+
+        store = prepare_work_dir(path=FILEPATH, prefix='blobs-')
+        self.tempdirs.append(store)
+        with open(os.path.join(FILEPATH, 'protein.mol2')) as protein_file:
+            protein = protein_file.read()
+
+        paths = []
+        for i in range(2):
+            workdir = prepare_work_dir(path=FILEPATH, prefix='docking-')
+            self.tempdirs.append(workdir)
+            paths.append(os.path.join(workdir, 'protein.mol2'))
+            blob = stage_input(protein, paths[-1], store=store)
+
+        self.assertEqual(os.stat(paths[0]).st_ino, os.stat(paths[1]).st_ino)
+        self.assertEqual(blob_references(blob), 2)
+        self.assertListEqual(pack_run(os.path.dirname(paths[0])), [])
+        with open(paths[1]) as protein_file:
+            self.assertEqual(protein_file.read(), protein)
+
+        shutil.rmtree(os.path.dirname(paths[0]))
+        self.assertListEqual(prune_blobs(store), [])
+        shutil.rmtree(os.path.dirname(paths[1]))
+        self.assertListEqual(prune_blobs(store, max_age=3600), [])
+        self.assertListEqual(prune_blobs(store), [blob])